@@ -0,0 +1,50 @@
+"""add premium_until and hot path indexes
+
+Revision ID: 42573893fdf7
+Revises: 6d2d3102f190
+Create Date: 2026-10-18 10:12:41.530214
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '42573893fdf7'
+down_revision: Union[str, None] = '6d2d3102f190'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("""
+        create index ix_transaction_user_id_status on "transaction" (user_id, status);
+    """)
+    op.execute("""
+        create index ix_subscription_transaction_id_end_date on subscription (transaction_id, end_date);
+    """)
+    op.execute("""
+        alter table "user" add column premium_until timestamp;
+    """)
+    op.execute("""
+        update "user" set premium_until = (
+            select max(s.end_date)
+            from subscription s
+            join "transaction" t on t.id = s.transaction_id
+            where t.user_id = "user".chat_id and t.status = 'successful'
+        );
+    """)
+
+
+def downgrade() -> None:
+    op.execute("""
+        alter table "user" drop column premium_until;
+    """)
+    op.execute("""
+        drop index ix_subscription_transaction_id_end_date;
+    """)
+    op.execute("""
+        drop index ix_transaction_user_id_status;
+    """)
@@ -0,0 +1,36 @@
+"""create monthly_stats table
+
+Revision ID: ab221e4c02f5
+Revises: 42573893fdf7
+Create Date: 2026-10-18 11:02:17.804512
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'ab221e4c02f5'
+down_revision: Union[str, None] = '42573893fdf7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("""
+        create table monthly_stats (
+            user_id integer references "user",
+            messages integer not null,
+            images integer not null,
+            for_month date not null,
+            primary key (user_id, for_month)
+        );
+    """)
+
+
+def downgrade() -> None:
+    op.execute("""
+        drop table monthly_stats;
+    """)
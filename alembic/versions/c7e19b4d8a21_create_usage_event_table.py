@@ -0,0 +1,42 @@
+"""create usage_event table
+
+Revision ID: c7e19b4d8a21
+Revises: ab221e4c02f5
+Create Date: 2026-10-18 15:26:41.218093
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7e19b4d8a21'
+down_revision: Union[str, None] = 'ab221e4c02f5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # created through SQLAlchemy, so that id is an autoincrementing serial on Postgres,
+    # "id integer primary key" only assigns ids on SQLite
+    op.create_table(
+        'usage_event',
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('user_id', sa.Text, nullable=False),
+        sa.Column('kind', sa.Text, nullable=False),
+        sa.Column('day', sa.Date, nullable=False),
+        sa.Column('amount', sa.Float, nullable=False),
+        sa.Column('detail', sa.Text),
+        sa.Column('cost', sa.Float, nullable=False),
+        sa.Column('created_at', sa.DateTime, nullable=False),
+    )
+    op.create_index('ix_usage_event_user_id_kind_day', 'usage_event', ['user_id', 'kind', 'day'])
+    op.create_index('ix_usage_event_user_id_day', 'usage_event', ['user_id', 'day'])
+
+
+def downgrade() -> None:
+    op.execute("""
+        drop table usage_event;
+    """)
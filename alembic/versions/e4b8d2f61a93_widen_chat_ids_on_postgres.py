@@ -0,0 +1,54 @@
+"""widen chat ids and add identity ids on postgres
+
+Revision ID: e4b8d2f61a93
+Revises: c7e19b4d8a21
+Create Date: 2026-10-18 19:42:07.531204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4b8d2f61a93'
+down_revision: Union[str, None] = 'c7e19b4d8a21'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# columns holding Telegram chat ids, which exceed 2^31
+CHAT_ID_COLUMNS = [('"user"', 'chat_id'), ('daily_stats', 'user_id'), ('monthly_stats', 'user_id'),
+                   ('"transaction"', 'user_id')]
+# tables whose ids are assigned by the database, "id integer primary key" only does so on SQLite
+IDENTITY_TABLES = ['"transaction"', 'subscription']
+
+
+def upgrade() -> None:
+    # SQLite integers are 64 bit and its integer primary keys are assigned already
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table, column in CHAT_ID_COLUMNS:
+        op.execute(f"""
+            alter table {table} alter column {column} type bigint;
+        """)
+    for table in IDENTITY_TABLES:
+        op.execute(f"""
+            alter table {table} alter column id add generated by default as identity;
+        """)
+        op.execute(f"""
+            select setval(pg_get_serial_sequence('{table}', 'id'), coalesce(max(id), 0) + 1, false) from {table};
+        """)
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table in IDENTITY_TABLES:
+        op.execute(f"""
+            alter table {table} alter column id drop identity;
+        """)
+    for table, column in CHAT_ID_COLUMNS:
+        op.execute(f"""
+            alter table {table} alter column {column} type integer;
+        """)
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import logging
+
+
+class AccessPolicy:
+    """
+    Access and budget settings of the bot, parsed once from the ALLOWED_TELEGRAM_USER_IDS,
+    ADMIN_USER_IDS, USER_BUDGETS and GUEST_BUDGET values of the bot configuration,
+    so that checking a user is a set or dict lookup instead of splitting the config strings.
+    """
+
+    def __init__(self, allowed_user_ids: str, admin_user_ids: str, user_budgets: str, guest_budget: float):
+        """
+        :param allowed_user_ids: Comma separated allowed user ids, or '*' to allow everyone
+        :param admin_user_ids: Comma separated admin user ids, or '-' for no admins
+        :param user_budgets: Comma separated budgets in the order of the allowed user ids, or '*' for no limits
+        :param guest_budget: Budget shared by all guest users
+        """
+        self.allow_all = allowed_user_ids == '*'
+        self.allowed_user_ids = frozenset() if self.allow_all else split_ids(allowed_user_ids)
+        self.admin_user_ids = frozenset() if admin_user_ids == '-' else split_ids(admin_user_ids)
+        self.guest_budget = guest_budget
+        self.unlimited_budgets = user_budgets == '*'
+        # budget of every user when everyone is allowed, None if budgets are per allowed user
+        self.default_budget = None
+        self.user_budgets = {}
+        if self.unlimited_budgets:
+            return
+
+        budgets = user_budgets.split(',')
+        if self.allow_all:
+            # same budget for all users, use value in first position of budget list
+            if len(budgets) > 1:
+                logging.warning('multiple values for budgets set with unrestricted user list '
+                                'only the first value is used as budget for everyone.')
+            self.default_budget = float(budgets[0])
+            return
+
+        for user_index, user_id in enumerate(allowed_user_ids.split(',')):
+            user_id = user_id.strip()
+            if not user_id or user_id in self.user_budgets:
+                continue
+            if len(budgets) <= user_index:
+                logging.warning(f'No budget set for user id: {user_id}. Budget list shorter than user list.')
+                self.user_budgets[user_id] = 0.0
+            else:
+                self.user_budgets[user_id] = float(budgets[user_index])
+
+    @classmethod
+    def from_config(cls, config) -> AccessPolicy:
+        """
+        Builds the access policy from the bot configuration, allowing everyone without limits
+        and without admins for the settings it lacks, as the defaults of main.py do.
+        """
+        return cls(config.get('allowed_user_ids', '*'), config.get('admin_user_ids', '-'),
+                   config.get('user_budgets', '*'), config.get('guest_budget', 100.0))
+
+    def is_admin(self, user_id) -> bool:
+        return str(user_id) in self.admin_user_ids
+
+    def is_allowed(self, user_id) -> bool:
+        """
+        Checks if the user may use the bot in private chats, without a group membership check.
+        """
+        return self.allow_all or str(user_id) in self.allowed_user_ids or self.is_admin(user_id)
+
+    def get_user_budget(self, user_id) -> float | None:
+        """
+        Returns the budget of the user, or None if the user is a guest.
+        """
+        if self.unlimited_budgets or self.is_admin(user_id):
+            return float('inf')
+        if self.default_budget is not None:
+            return self.default_budget
+        return self.user_budgets.get(str(user_id))
+
+
+def split_ids(user_ids: str) -> frozenset[str]:
+    return frozenset(user_id.strip() for user_id in user_ids.split(',') if user_id.strip())
@@ -0,0 +1,383 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import json
+from abc import abstractmethod, ABC
+from collections import OrderedDict
+
+import aiosqlite
+import redis.asyncio as redis
+
+
+def dumps(value) -> str:
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+class Conversation:
+    """
+    Chat history of a chat, sent to the model with every request.
+    """
+
+    def __init__(self, history: list[dict], vision=False, last_updated: datetime.datetime | None = None):
+        """
+        :param history: The messages of the chat, starting with the system prompt
+        :param vision: Whether images were sent in the chat, which disables functions
+        :param last_updated: When the chat last sent a request, defaults to now
+        """
+        self.history = history
+        self.vision = vision
+        self.last_updated = last_updated or datetime.datetime.now()
+
+
+class ConversationStore(ABC):
+    """
+    Interface of the stores of the conversations of OpenAIHelper.
+    """
+
+    @abstractmethod
+    async def get(self, chat_id) -> Conversation | None:
+        """
+        Returns the conversation of a chat, or None if there is none.
+        """
+        pass
+
+    @abstractmethod
+    async def save(self, chat_id, conversation: Conversation):
+        """
+        Stores the whole conversation of a chat, replacing the stored one.
+        """
+        pass
+
+    async def append(self, chat_id, conversation: Conversation, *messages: dict):
+        """
+        Adds messages to the end of the history of a conversation and stores them.
+        """
+        conversation.history.extend(messages)
+        await self.save(chat_id, conversation)
+
+    async def replace_prefix(self, chat_id, prefix: list[dict], replacement: list[dict]) -> bool:
+        """
+        Replaces the first messages of the history of a conversation, keeping the messages added since,
+        unless the history no longer starts with them because it was reset or truncated meanwhile.
+        :param prefix: The messages expected at the start of the history
+        :param replacement: The messages replacing them
+        :return: whether the messages were replaced
+        """
+        conversation = await self.get(chat_id)
+        if conversation is None or conversation.history[:len(prefix)] != prefix:
+            return False
+        conversation.history = replacement + conversation.history[len(prefix):]
+        await self.save(chat_id, conversation)
+        return True
+
+    async def sweep(self) -> int:
+        """
+        Drops the conversations older than the maximum conversation age.
+        :return: number of conversations dropped
+        """
+        return 0
+
+    async def stats(self) -> dict | None:
+        """
+        :return: counters of the store, or None if it has none
+        """
+        return None
+
+    async def close(self):
+        pass
+
+
+class SpillFile:
+    """
+    SQLite file holding the conversations a MemoryConversationStore moved out of memory.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: path to the SQLite file, created if missing
+        """
+        self.path = path
+        self.connection = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self) -> aiosqlite.Connection:
+        async with self.lock:
+            if self.connection is None:
+                connection = await aiosqlite.connect(self.path)
+                await connection.execute('PRAGMA journal_mode=WAL')
+                await connection.execute('PRAGMA synchronous=NORMAL')
+                await connection.execute('CREATE TABLE IF NOT EXISTS conversation (chat_id INTEGER PRIMARY KEY, '
+                                         'history TEXT NOT NULL, vision INTEGER NOT NULL, last_updated REAL NOT NULL)')
+                await connection.execute('CREATE INDEX IF NOT EXISTS ix_conversation_last_updated '
+                                         'ON conversation (last_updated)')
+                await connection.commit()
+                self.connection = connection
+        return self.connection
+
+    async def put(self, conversations: dict):
+        """
+        Writes conversations to the file, replacing the ones of the same chats.
+        :param conversations: chat id -> conversation
+        """
+        rows = [(chat_id, dumps(conversation.history), int(conversation.vision),
+                 conversation.last_updated.timestamp()) for chat_id, conversation in conversations.items()]
+        connection = await self.connect()
+        await connection.executemany('INSERT OR REPLACE INTO conversation VALUES (?, ?, ?, ?)', rows)
+        await connection.commit()
+
+    async def pop(self, chat_id) -> Conversation | None:
+        """
+        Removes the conversation of a chat from the file and returns it, or None if there is none.
+        """
+        connection = await self.connect()
+        async with connection.execute('SELECT history, vision, last_updated FROM conversation WHERE chat_id = ?',
+                                      (chat_id,)) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        await connection.execute('DELETE FROM conversation WHERE chat_id = ?', (chat_id,))
+        await connection.commit()
+        history, vision, last_updated = row
+        return Conversation(json.loads(history), vision=bool(vision),
+                            last_updated=datetime.datetime.fromtimestamp(last_updated))
+
+    async def delete_older_than(self, last_updated: datetime.datetime) -> int:
+        """
+        :return: number of conversations deleted
+        """
+        connection = await self.connect()
+        cursor = await connection.execute('DELETE FROM conversation WHERE last_updated < ?',
+                                          (last_updated.timestamp(),))
+        await connection.commit()
+        return cursor.rowcount
+
+    async def count(self) -> int:
+        connection = await self.connect()
+        async with connection.execute('SELECT COUNT(*) FROM conversation') as cursor:
+            (count,) = await cursor.fetchone()
+        return count
+
+    async def close(self):
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+
+
+class MemoryConversationStore(ConversationStore):
+    """
+    Conversations of the running bot, kept in memory in a bounded LRU.
+    Least recently used conversations are dropped once there are more than max_chats of them,
+    or once their histories take more than max_bytes once serialized.
+
+    With a spill file, sweep() moves conversations idle for spill_after_minutes out of memory
+    into the file, and so does the LRU instead of dropping them. get() moves them back.
+    Either way, sweep() drops the conversations older than max_age_minutes.
+    """
+
+    def __init__(self, max_chats=10000, max_bytes=256 * 1024 * 1024, max_age_minutes=180,
+                 spill_path: str | None = None, spill_after_minutes=30):
+        """
+        :param max_chats: maximum number of conversations in memory, defaults to 10000
+        :param max_bytes: maximum serialized size of all histories in memory, defaults to 256 MB
+        :param max_age_minutes: minutes after which an idle conversation is dropped, defaults to 180
+        :param spill_path: path to the SQLite file of spilled conversations, None to drop them instead
+        :param spill_after_minutes: minutes after which an idle conversation is spilled, defaults to 30
+        """
+        self.max_chats = max_chats
+        self.max_bytes = max_bytes
+        self.max_age = datetime.timedelta(minutes=max_age_minutes)
+        self.spill = SpillFile(spill_path) if spill_path else None
+        self.spill_after = datetime.timedelta(minutes=spill_after_minutes)
+        # chat id -> (conversation, serialized size of its history), least recently used first
+        self.conversations = OrderedDict()
+        self.size = 0
+        self.expired = 0
+        self.spilled = 0
+        self.reloaded = 0
+
+    async def get(self, chat_id) -> Conversation | None:
+        if chat_id in self.conversations:
+            self.conversations.move_to_end(chat_id)
+            return self.conversations[chat_id][0]
+        if self.spill is None:
+            return None
+        conversation = await self.spill.pop(chat_id)
+        if conversation is None:
+            # another request of the chat may have reloaded it meanwhile
+            return self.conversations.get(chat_id, (None, None))[0]
+        self.reloaded += 1
+        await self.save(chat_id, conversation)
+        return conversation
+
+    async def save(self, chat_id, conversation: Conversation):
+        await self.store(chat_id, conversation, len(dumps(conversation.history)))
+
+    async def append(self, chat_id, conversation: Conversation, *messages: dict):
+        conversation.history.extend(messages)
+        _, size = self.conversations.get(chat_id, (None, None))
+        if size is None:
+            size = len(dumps(conversation.history))
+        else:
+            size += sum(len(dumps(message)) + 1 for message in messages)
+        await self.store(chat_id, conversation, size)
+
+    async def store(self, chat_id, conversation: Conversation, size: int):
+        if chat_id in self.conversations:
+            self.size -= self.conversations[chat_id][1]
+        self.conversations[chat_id] = (conversation, size)
+        self.conversations.move_to_end(chat_id)
+        self.size += size
+        evicted = {}
+        # the conversation stored last is kept, even if it alone exceeds max_bytes
+        while len(self.conversations) > 1 and \
+                (len(self.conversations) > self.max_chats or self.size > self.max_bytes):
+            evicted_chat_id, (evicted_conversation, evicted_size) = self.conversations.popitem(last=False)
+            self.size -= evicted_size
+            evicted[evicted_chat_id] = evicted_conversation
+        if evicted and self.spill is not None:
+            self.spilled += len(evicted)
+            await self.spill.put(evicted)
+
+    def remove(self, chat_id) -> Conversation:
+        conversation, size = self.conversations.pop(chat_id)
+        self.size -= size
+        return conversation
+
+    async def sweep(self, now: datetime.datetime | None = None) -> int:
+        """
+        Drops the conversations older than the maximum conversation age, in memory and in the spill file,
+        and spills the conversations idle for longer than spill_after_minutes.
+        :param now: current time, defaults to now
+        :return: number of conversations dropped
+        """
+        now = now or datetime.datetime.now()
+        expired, idle = [], []
+        for chat_id, (conversation, _) in self.conversations.items():
+            if conversation.last_updated < now - self.max_age:
+                expired.append(chat_id)
+            elif conversation.last_updated < now - self.spill_after:
+                idle.append(chat_id)
+        for chat_id in expired:
+            self.remove(chat_id)
+        dropped = len(expired)
+        if self.spill is not None:
+            # removed from memory before the first await, so that a request of the chat reloads it from the file
+            spilled = {chat_id: self.remove(chat_id) for chat_id in idle}
+            if spilled:
+                self.spilled += len(spilled)
+                await self.spill.put(spilled)
+            dropped += await self.spill.delete_older_than(now - self.max_age)
+        self.expired += dropped
+        return dropped
+
+    async def stats(self) -> dict:
+        """
+        :return: number and size of the conversations in memory, number of spilled conversations
+                 and the expired, spilled and reloaded counters
+        """
+        return {
+            'resident': len(self.conversations),
+            'max_chats': self.max_chats,
+            'resident_bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'spilled': await self.spill.count() if self.spill is not None else 0,
+            'expired_total': self.expired,
+            'spilled_total': self.spilled,
+            'reloaded_total': self.reloaded,
+        }
+
+    async def close(self):
+        if self.spill is not None:
+            await self.spill.close()
+
+
+class RedisConversationStore(ConversationStore):
+    """
+    Conversations stored in Redis, so that several instances of the bot can share them.
+    The history of a chat is a list of compact JSON messages, so appending a message is one RPUSH,
+    and the vision flag and last update time are a hash next to it. Both expire once the conversation
+    is older than the maximum conversation age.
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', max_age_minutes=180, key_prefix='conversation:',
+                 client: redis.Redis | None = None):
+        """
+        :param url: Redis connection URL, defaults to "redis://localhost:6379/0"
+        :param max_age_minutes: minutes after which an idle conversation expires, defaults to 180
+        :param key_prefix: prefix of the Redis keys, defaults to "conversation:"
+        :param client: Redis client to use instead of connecting to url
+        """
+        self.client = client or redis.from_url(url)
+        self.ttl = datetime.timedelta(minutes=max_age_minutes)
+        self.key_prefix = key_prefix
+
+    def keys(self, chat_id) -> tuple[str, str]:
+        return f'{self.key_prefix}{chat_id}', f'{self.key_prefix}{chat_id}:meta'
+
+    async def get(self, chat_id) -> Conversation | None:
+        history_key, meta_key = self.keys(chat_id)
+        async with self.client.pipeline(transaction=False) as pipeline:
+            history, meta = await pipeline.lrange(history_key, 0, -1).hgetall(meta_key).execute()
+        if not meta:
+            return None
+        return Conversation([json.loads(message) for message in history], vision=meta[b'vision'] == b'1',
+                            last_updated=datetime.datetime.fromtimestamp(float(meta[b'last_updated'])))
+
+    async def save(self, chat_id, conversation: Conversation):
+        history_key, meta_key = self.keys(chat_id)
+        async with self.client.pipeline(transaction=True) as pipeline:
+            pipeline.delete(history_key)
+            if conversation.history:
+                pipeline.rpush(history_key, *[dumps(message) for message in conversation.history])
+            self.save_meta(pipeline, meta_key, conversation)
+            pipeline.expire(history_key, self.ttl)
+            await pipeline.execute()
+
+    async def append(self, chat_id, conversation: Conversation, *messages: dict):
+        conversation.history.extend(messages)
+        history_key, meta_key = self.keys(chat_id)
+        async with self.client.pipeline(transaction=True) as pipeline:
+            pipeline.rpush(history_key, *[dumps(message) for message in messages])
+            self.save_meta(pipeline, meta_key, conversation)
+            pipeline.expire(history_key, self.ttl)
+            await pipeline.execute()
+
+    async def replace_prefix(self, chat_id, prefix: list[dict], replacement: list[dict]) -> bool:
+        history_key, meta_key = self.keys(chat_id)
+
+        async def replace(pipeline) -> bool:
+            # watched, so the transaction is retried if another instance changes the history meanwhile
+            stored = await pipeline.lrange(history_key, 0, len(prefix) - 1)
+            if not await pipeline.exists(meta_key) or [json.loads(message) for message in stored] != prefix:
+                return False
+            pipeline.multi()
+            pipeline.ltrim(history_key, len(prefix), -1)
+            pipeline.lpush(history_key, *[dumps(message) for message in reversed(replacement)])
+            pipeline.expire(history_key, self.ttl)
+            pipeline.expire(meta_key, self.ttl)
+            return True
+
+        return await self.client.transaction(replace, history_key, meta_key, value_from_callable=True)
+
+    def save_meta(self, pipeline, meta_key, conversation: Conversation):
+        pipeline.hset(meta_key, mapping={'vision': int(conversation.vision),
+                                         'last_updated': conversation.last_updated.timestamp()})
+        pipeline.expire(meta_key, self.ttl)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_conversation_store(config) -> ConversationStore:
+    """
+    Creates the conversation store configured with CONVERSATION_STORE.
+    :param config: The OpenAI configuration object
+    """
+    if config['conversation_store'] == 'redis':
+        return RedisConversationStore(config['redis_url'], max_age_minutes=config['max_conversation_age_minutes'])
+    return MemoryConversationStore(max_chats=config['conversation_max_chats'],
+                                   max_bytes=config['conversation_max_bytes'],
+                                   max_age_minutes=config['max_conversation_age_minutes'],
+                                   spill_path=config['conversation_spill_path'] or None,
+                                   spill_after_minutes=config['conversation_spill_after_minutes'])
@@ -0,0 +1,289 @@
+"""
+Benchmark for the database layer in entities.py.
+
+Seeds a temporary SQLite database and runs one of the scenarios:
+- messages: replays the per-message database work of the bot (load the user context,
+  then increment the daily stats) from concurrent asyncio tasks
+- rollup: seeds --days of daily stats history per user, then reports the size of the
+  daily_stats table and the user context query latency before and after rollup_daily_stats
+- users: seeds transactions and subscriptions as well, then drives create_chat_user_or_get and
+  the QuotaEngine check and consume of every message from --tasks asyncio tasks in each of
+  --threads threads, and reports the latency of every step
+
+Run from the repository root, e.g.:
+
+    python bot/db_benchmark.py --profile default
+    python bot/db_benchmark.py --profile tuned
+    python bot/db_benchmark.py --scenario rollup --days 365
+    python bot/db_benchmark.py --scenario users --threads 4 --tasks 20
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import OperationalError
+
+import entities
+from entities import Base, ChatUser, DailyStats, Transaction, Subscription, init_database, dispose_database, \
+    load_user_context, update_stats, rollup_daily_stats, create_chat_user_or_get, start_write_behind
+from quota_engine import QuotaEngine, MESSAGES
+
+# SQLite storage profiles, see apply_sqlite_pragmas in entities.py
+PROFILES = {
+    'default': {
+        'sqlite_journal_mode': None,
+        'sqlite_synchronous': None,
+        'sqlite_mmap_size': None,
+        'sqlite_cache_size': None,
+        'sqlite_busy_timeout_ms': None,
+    },
+    'tuned': {},
+}
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def seed(users: int):
+    async with entities.engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    async with entities.session_scope() as session:
+        session.add_all([ChatUser(chat_id=chat_id, username=f'@user{chat_id}') for chat_id in range(1, users + 1)])
+
+
+async def seed_payments(args):
+    """
+    Gives --premium-users users an active subscription and spreads --transactions
+    older, expired subscriptions over all users.
+    """
+    now = datetime.datetime.now()
+    transactions, subscriptions = [], []
+    for transaction_id in range(1, args.transactions + 1):
+        premium = transaction_id <= args.premium_users
+        chat_id = transaction_id if premium else random.randint(1, args.users)
+        start_date = now - datetime.timedelta(days=1 if premium else random.randint(31, 365))
+        transactions.append({'id': transaction_id, 'user_id': chat_id, 'amount': 100, 'currency': 'XTR',
+                             'status': 'successful', 'ref_id': f'benchmark-{transaction_id}'})
+        subscriptions.append({'plan_name': 'Premium', 'transaction_id': transaction_id,
+                              'start_date': start_date, 'end_date': start_date + datetime.timedelta(days=30)})
+    async with entities.session_scope() as session:
+        await session.execute(insert(Transaction), transactions)
+        await session.execute(insert(Subscription), subscriptions)
+        await session.execute(ChatUser.__table__.update()
+                              .where(ChatUser.chat_id <= args.premium_users)
+                              .values(premium_until=now + datetime.timedelta(days=29)))
+
+
+class UsersScenario:
+    """
+    Latencies and errors of the users scenario, shared by the worker threads.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        # "sql" usage trackers keep nothing in memory or on disk, the budgets are not enforced
+        self.config = {'admin_user_ids': '-', 'max_free_messages_daily': 100, 'max_free_images_daily': 10,
+                       'enforce_budgets': False, 'usage_storage': 'sql', 'usage_snapshot_interval': 100,
+                       'usage_write_debounce_ms': 1000, 'usage_store_days': 90}
+        self.latencies = {name: [] for name in ('create_chat_user_or_get', 'quota_check', 'quota_consume',
+                                                'message')}
+        self.errors = {}
+        self.lock = threading.Lock()
+        self.next_new_user = args.users
+
+    def pick_chat_id(self):
+        with self.lock:
+            if random.random() < self.args.new_users:
+                self.next_new_user += 1
+                return self.next_new_user
+        return random.randint(1, self.args.users)
+
+    def record(self, timings: dict):
+        with self.lock:
+            for name, elapsed in timings.items():
+                self.latencies[name].append(elapsed)
+
+    def record_error(self, error: Exception):
+        message = str(error.orig) if isinstance(error, OperationalError) else f'{type(error).__name__}: {error}'
+        with self.lock:
+            self.errors[message] = self.errors.get(message, 0) + 1
+
+    async def handle_message(self, quota: QuotaEngine, chat_id):
+        update = SimpleNamespace(message=SimpleNamespace(
+            chat_id=chat_id, from_user=SimpleNamespace(username=f'user{chat_id}', first_name='', last_name='')))
+        timings = {}
+        start = time.perf_counter()
+        await create_chat_user_or_get(update)
+        timings['create_chat_user_or_get'], step = time.perf_counter() - start, time.perf_counter()
+        reason = await quota.check(chat_id, MESSAGES, f'@user{chat_id}')
+        timings['quota_check'], step = time.perf_counter() - step, time.perf_counter()
+        if reason is None:
+            await quota.consume(chat_id, MESSAGES)
+            timings['quota_consume'] = time.perf_counter() - step
+        timings['message'] = time.perf_counter() - start
+        self.record(timings)
+
+    async def worker(self, quota: QuotaEngine):
+        for _ in range(self.args.messages // (self.args.tasks * self.args.threads)):
+            try:
+                await self.handle_message(quota, self.pick_chat_id())
+            except Exception as e:
+                self.record_error(e)
+
+    async def run_thread(self):
+        # one quota engine per event loop, like one bot instance per process
+        quota = QuotaEngine(self.config, {}, max_size=self.args.users)
+        await asyncio.gather(*[self.worker(quota) for _ in range(self.args.tasks)])
+
+    async def run(self):
+        if self.args.write_behind:
+            await start_write_behind()
+        start = time.perf_counter()
+        if self.args.threads == 1:
+            await self.run_thread()
+        else:
+            # every thread runs its own event loop against the shared engine
+            threads = [threading.Thread(target=asyncio.run, args=(self.run_thread(),))
+                       for _ in range(self.args.threads)]
+            for thread in threads:
+                thread.start()
+            await asyncio.to_thread(lambda: [thread.join() for thread in threads])
+        elapsed = time.perf_counter() - start
+
+        messages = self.latencies['message']
+        print(f'profile={self.args.profile} users={self.args.users} threads={self.args.threads} '
+              f'tasks={self.args.tasks} messages={len(messages)}')
+        print(f'throughput: {len(messages) / elapsed:.0f} messages/s')
+        for name, latencies in self.latencies.items():
+            print(f'{name:<30} p50={percentile(latencies, 0.5) * 1000:.2f}ms '
+                  f'p99={percentile(latencies, 0.99) * 1000:.2f}ms')
+        locks = sum(count for message, count in self.errors.items() if 'locked' in message)
+        print(f'lock contention errors: {locks}')
+        print(f'errors: {sum(self.errors.values())} {self.errors if self.errors else ""}')
+
+
+async def handle_message(chat_id, latencies: list[float], errors: dict):
+    start = time.perf_counter()
+    try:
+        await load_user_context(chat_id)
+        await update_stats(chat_id=chat_id, messages=1)
+    except OperationalError as e:
+        errors[str(e.orig)] = errors.get(str(e.orig), 0) + 1
+        return
+    latencies.append(time.perf_counter() - start)
+
+
+async def seed_history(users: int, days: int):
+    today = entities.utc_today()
+    async with entities.session_scope() as session:
+        for day in range(1, days + 1):
+            for_day = today - datetime.timedelta(days=day)
+            await session.execute(insert(DailyStats), [
+                {'user_id': chat_id, 'for_day': for_day, 'messages': random.randint(1, 10), 'images': random.randint(0, 2)}
+                for chat_id in range(1, users + 1)
+            ])
+
+
+async def measure_queries(args) -> tuple[int, float, float, float]:
+    async with entities.session_scope() as session:
+        rows = await session.scalar(select(func.count()).select_from(DailyStats))
+    latencies = []
+    for _ in range(args.queries):
+        start = time.perf_counter()
+        await load_user_context(random.randint(1, args.users))
+        latencies.append(time.perf_counter() - start)
+    return rows, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000, percentile(latencies, 0.99) * 1000
+
+
+async def run_rollup(args):
+    await seed_history(args.users, args.days)
+    rows, p50, p95, p99 = await measure_queries(args)
+    print(f'before rollup: daily_stats rows={rows} user context p50={p50:.2f}ms p95={p95:.2f}ms p99={p99:.2f}ms')
+
+    start = time.perf_counter()
+    rolled_up = await rollup_daily_stats(retention_days=args.retention_days, chunk_size=args.chunk_size)
+    print(f'rolled up {rolled_up} rows in {time.perf_counter() - start:.2f}s')
+
+    rows, p50, p95, p99 = await measure_queries(args)
+    print(f'after rollup: daily_stats rows={rows} user context p50={p50:.2f}ms p95={p95:.2f}ms p99={p99:.2f}ms')
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        config = {'database_url': f'sqlite:///{os.path.join(directory, "benchmark.db")}'}
+        if args.threads == 1:
+            # pooled aiosqlite connections belong to the event loop that opened them,
+            # so with several threads every session opens its own connection instead
+            config.update({'pool_size': args.pool_size, 'max_overflow': args.max_overflow})
+        config.update(PROFILES[args.profile])
+        init_database(config=config)
+        await seed(args.users)
+
+        if args.scenario == 'rollup':
+            await run_rollup(args)
+            await dispose_database()
+            return
+        if args.scenario == 'users':
+            await seed_payments(args)
+            await UsersScenario(args).run()
+            await dispose_database()
+            return
+
+        latencies, errors = [], {}
+
+        async def worker():
+            for _ in range(args.messages // args.tasks):
+                await handle_message(random.randint(1, args.users), latencies, errors)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(args.tasks)])
+        elapsed = time.perf_counter() - start
+        await dispose_database()
+
+    print(f'profile={args.profile} users={args.users} tasks={args.tasks} messages={len(latencies)}')
+    print(f'throughput: {len(latencies) / elapsed:.0f} messages/s')
+    print(f'latency: p50={percentile(latencies, 0.5) * 1000:.2f}ms p99={percentile(latencies, 0.99) * 1000:.2f}ms')
+    print(f'errors: {sum(errors.values())} {errors if errors else ""}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the entities.py database layer')
+    parser.add_argument('--scenario', choices=['messages', 'rollup', 'users'], default='messages')
+    parser.add_argument('--profile', choices=PROFILES.keys(), default='tuned')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--tasks', type=int, default=50, help='concurrent asyncio tasks (per thread)')
+    parser.add_argument('--threads', type=int, default=1, help='threads of the users scenario, each with its own event loop')
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--pool-size', type=int, default=5)
+    parser.add_argument('--max-overflow', type=int, default=10)
+    parser.add_argument('--days', type=int, default=365, help='days of history seeded by the rollup scenario')
+    parser.add_argument('--retention-days', type=int, default=90)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--queries', type=int, default=2000, help='user context queries timed by the rollup scenario')
+    parser.add_argument('--transactions', type=int, default=2000, help='transactions seeded by the users scenario')
+    parser.add_argument('--premium-users', type=int, default=100, help='users with an active subscription')
+    parser.add_argument('--new-users', type=float, default=0.05, help='share of messages sent by users not seeded yet')
+    parser.add_argument('--write-behind', action='store_true', help='buffer stats and last_active writes like the bot')
+    args = parser.parse_args()
+    if args.write_behind and args.threads > 1:
+        parser.error('--write-behind needs a single event loop, use it with --threads 1')
+    if args.premium_users > args.transactions:
+        parser.error('--premium-users cannot exceed --transactions')
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
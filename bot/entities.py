@@ -1,25 +1,55 @@
+from __future__ import annotations
+
+import asyncio
 import datetime
 import logging
-from contextlib import contextmanager
-
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, func, Date
+from abc import abstractmethod, ABC
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, func, Date, select, and_, update, Index, event, \
+    tuple_, Float, case, BigInteger
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from telegram import Update
 
-from utils import is_admin
+# Async drivers used for each of the supported database URL schemes
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+}
 
-engine = create_engine('sqlite:///data.db', echo=False)
+# Maximum number of users whose premium status is kept in memory
+ENTITLEMENT_CACHE_SIZE = 10000
+# Maximum number of users remembered as existing by create_chat_user_or_get
+KNOWN_USERS_CACHE_SIZE = 10000
+
+engine = None
+Session = None
+stats_buffer = None
+activity_tracker = None
 
 Base = declarative_base()
 
+def utc_today() -> datetime.date:
+    """
+    Returns the current UTC date, the day all DailyStats rows and daily quotas are counted for.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
 class ChatUser(Base):
     __tablename__ = 'user'
 
-    chat_id = Column(Integer, primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     username = Column(String())
     created_at = Column(DateTime(), nullable=False, default=func.now())
     last_active = Column(DateTime(), nullable=False, default=func.now())
+    premium_until = Column(DateTime())
 
     transactions = relationship('Transaction', back_populates='user')
     daily_stats = relationship('DailyStats', back_populates='user')
@@ -28,16 +58,26 @@ class ChatUser(Base):
 class DailyStats(Base):
     __tablename__ = 'daily_stats'
 
-    user_id = Column(Integer, ForeignKey('user.chat_id'), primary_key=True)
+    user_id = Column(BigInteger, ForeignKey('user.chat_id'), primary_key=True)
     messages = Column(Integer, nullable=False, default=0)
     images = Column(Integer, nullable=False, default=0)
-    for_day = Column(Date(), nullable=False, default=func.current_date(), primary_key=True)
+    for_day = Column(Date(), nullable=False, default=utc_today, primary_key=True)
 
     user = relationship('ChatUser', back_populates='daily_stats')
 
 
+class MonthlyStats(Base):
+    __tablename__ = 'monthly_stats'
+
+    user_id = Column(BigInteger, ForeignKey('user.chat_id'), primary_key=True)
+    messages = Column(Integer, nullable=False, default=0)
+    images = Column(Integer, nullable=False, default=0)
+    for_month = Column(Date(), nullable=False, primary_key=True)
+
+
 class Subscription(Base):
     __tablename__ = 'subscription'
+    __table_args__ = (Index('ix_subscription_transaction_id_end_date', 'transaction_id', 'end_date'),)
 
     id = Column(Integer, primary_key=True)
     plan_name = Column(String)
@@ -50,9 +90,10 @@ class Subscription(Base):
 
 class Transaction(Base):
     __tablename__ = 'transaction'
+    __table_args__ = (Index('ix_transaction_user_id_status', 'user_id', 'status'),)
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('user.chat_id'), nullable=False)
+    user_id = Column(BigInteger, ForeignKey('user.chat_id'), nullable=False)
     amount = Column(Integer, nullable=False)
     currency = Column(String, nullable=False)
     status = Column(String, nullable=False)
@@ -62,94 +103,484 @@ class Transaction(Base):
     user = relationship('ChatUser', back_populates='transactions')
     subscription = relationship('Subscription', back_populates='transaction')
 
-Session = sessionmaker(bind=engine, expire_on_commit=False)
+class UsageEvent(Base):
+    """
+    One request tracked by a UsageTracker with the "sql" storage.
+    user_id is the Telegram ID of the user as a string, or "guests".
+    """
+    __tablename__ = 'usage_event'
+    __table_args__ = (Index('ix_usage_event_user_id_kind_day', 'user_id', 'kind', 'day'),
+                      Index('ix_usage_event_user_id_day', 'user_id', 'day'))
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(String, nullable=False)
+    kind = Column(String, nullable=False)
+    day = Column(Date(), nullable=False)
+    amount = Column(Float, nullable=False)
+    detail = Column(String)
+    cost = Column(Float, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=func.now())
+
+class UserContext:
+    """
+    Snapshot of everything the handlers need to know about a user for a single update:
+    the ChatUser row, today's DailyStats and the end date of the active subscription.
+    """
+
+    def __init__(self, chat_id, chat_user: ChatUser | None, daily_stats: DailyStats | None, premium_until,
+                 day: datetime.date | None = None):
+        self.chat_id = chat_id
+        self.day = day or utc_today()
+        self.chat_user = chat_user
+        self.daily_stats = daily_stats
+        self.premium_until = premium_until
+
+    @property
+    def is_premium(self) -> bool:
+        return self.premium_until is not None and self.premium_until >= datetime.datetime.today()
+
+    @property
+    def messages_today(self) -> int:
+        messages = self.daily_stats.messages if self.daily_stats is not None else 0
+        return messages + stats_buffer.get_pending(self.chat_id, self.day)[0]
+
+    @property
+    def images_today(self) -> int:
+        images = self.daily_stats.images if self.daily_stats is not None else 0
+        return images + stats_buffer.get_pending(self.chat_id, self.day)[1]
+
+
+class EntitlementCache:
+    """
+    Bounded LRU cache of chat_id -> premium_until.
+    Users without an active subscription are cached with None until they are invalidated,
+    users with a subscription are cached until the subscription end date.
+    """
+
+    MISSING = object()
+
+    def __init__(self, max_size=ENTITLEMENT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()
+
+    def get(self, chat_id):
+        """
+        Returns the cached premium_until of a user (None if not premium), or MISSING on a cache miss.
+        """
+        premium_until = self.entries.get(chat_id, self.MISSING)
+        if premium_until is self.MISSING:
+            return self.MISSING
+        if premium_until is not None and premium_until < datetime.datetime.today():
+            # the subscription ended, reload to catch a renewal made elsewhere
+            del self.entries[chat_id]
+            return self.MISSING
+        self.entries.move_to_end(chat_id)
+        return premium_until
+
+    def put(self, chat_id, premium_until):
+        if premium_until is not None and premium_until < datetime.datetime.today():
+            premium_until = None
+        self.entries[chat_id] = premium_until
+        self.entries.move_to_end(chat_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, chat_id):
+        self.entries.pop(chat_id, None)
+
+
+entitlements = EntitlementCache()
+
+
+class PeriodicFlush(ABC):
+    """
+    Base class for write-behind buffers. Once start() is called, flush() runs every
+    flush_interval_ms milliseconds, and a last time when stop() is called.
+    """
+
+    def __init__(self, flush_interval_ms=1000):
+        self.flush_interval_ms = flush_interval_ms
+        self.task = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None
+
+    @abstractmethod
+    async def flush(self):
+        """
+        Writes the buffered updates to the database.
+        """
+        pass
+
+    async def start(self):
+        self.task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        """
+        Stops the periodic flush and writes everything still pending.
+        """
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        await self.flush()
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval_ms / 1000)
+            await self.flush()
+
+
+class StatsBuffer(PeriodicFlush):
+    """
+    Write-behind buffer for DailyStats increments.
+    Deltas are summed per user and day in memory and written with one batched UPSERT every
+    flush_interval_ms milliseconds, or as soon as max_entries users have pending deltas.
+    Until start() is called, increments are written through immediately.
+    """
+
+    def __init__(self, flush_interval_ms=1000, max_entries=100):
+        super().__init__(flush_interval_ms)
+        self.max_entries = max_entries
+        self.pending: dict[tuple, list[int]] = {}  # {(chat_id, for_day): [messages, images]}
+        self.flushing: dict[tuple, list[int]] = {}
+        self.lock = None
+        self.flush_task = None
+
+    def add(self, chat_id, messages=0, images=0):
+        # the day is taken now, so increments flushed after midnight still count for the day they happened
+        deltas = self.pending.setdefault((chat_id, utc_today()), [0, 0])
+        deltas[0] += messages
+        deltas[1] += images
+        if len(self.pending) >= self.max_entries and (self.flush_task is None or self.flush_task.done()):
+            self.flush_task = asyncio.create_task(self.flush())
+
+    def get_pending(self, chat_id, for_day: datetime.date | None = None) -> tuple[int, int]:
+        """
+        Returns the messages and images of a user that are not yet written to the database.
+        :param chat_id: The user id
+        :param for_day: The day to count, today (UTC) by default
+        """
+        key = (chat_id, for_day or utc_today())
+        messages, images = 0, 0
+        for buffer in (self.pending, self.flushing):
+            if key in buffer:
+                messages += buffer[key][0]
+                images += buffer[key][1]
+        return messages, images
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending:
+                return
+            self.flushing, self.pending = self.pending, {}
+            try:
+                async with session_scope() as session:
+                    await session.execute(upsert_daily_stats(), [
+                        {'user_id': chat_id, 'for_day': for_day, 'messages': messages, 'images': images}
+                        for (chat_id, for_day), (messages, images) in self.flushing.items()
+                    ])
+            except Exception as e:
+                logging.warning(f'Failed to flush daily stats, retrying with the next flush: {e}')
+                for key, (messages, images) in self.flushing.items():
+                    deltas = self.pending.setdefault(key, [0, 0])
+                    deltas[0] += messages
+                    deltas[1] += images
+            finally:
+                self.flushing = {}
+
+    async def start(self):
+        self.lock = asyncio.Lock()
+        await super().start()
+
+
+class ActivityTracker(PeriodicFlush):
+    """
+    Coalesces ChatUser.last_active updates.
+    Users that exist in the database are remembered in a bounded LRU together with the last_active
+    value written for them. A new value is only queued once that one is older than interval_s seconds,
+    and queued values are written in one batch by the periodic flush.
+    """
+
+    def __init__(self, interval_s=300, flush_interval_ms=1000, max_users=KNOWN_USERS_CACHE_SIZE):
+        super().__init__(flush_interval_ms)
+        self.interval = datetime.timedelta(seconds=interval_s)
+        self.max_users = max_users
+        self.known_users: OrderedDict = OrderedDict()  # {chat_id: last written last_active}
+        self.pending: dict[int, datetime.datetime] = {}  # {chat_id: last_active}
+
+    def remember(self, chat_id, last_active):
+        self.known_users[chat_id] = last_active
+        self.known_users.move_to_end(chat_id)
+        while len(self.known_users) > self.max_users:
+            self.known_users.popitem(last=False)
+
+    def touch(self, chat_id) -> bool:
+        """
+        Records activity of a known user without touching the database.
+        :return: False if the user is not known yet and has to be loaded
+        """
+        if chat_id not in self.known_users:
+            return False
+        now = datetime.datetime.now()
+        if now - self.known_users[chat_id] >= self.interval:
+            self.pending[chat_id] = now
+            self.remember(chat_id, now)
+        else:
+            self.known_users.move_to_end(chat_id)
+        return True
 
-@contextmanager
-def session_scope():
-    session = Session()
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            async with session_scope() as session:
+                await session.execute(update(ChatUser), [
+                    {'chat_id': chat_id, 'last_active': last_active} for chat_id, last_active in pending.items()
+                ])
+        except Exception as e:
+            logging.warning(f'Failed to flush last_active updates, retrying with the next flush: {e}')
+            for chat_id, last_active in pending.items():
+                self.pending.setdefault(chat_id, last_active)
+
+
+def to_async_url(database_url: str) -> str:
+    """
+    Rewrites a database URL to use the asyncio driver of its dialect,
+    e.g. sqlite:///data.db -> sqlite+aiosqlite:///data.db
+    """
+    scheme, separator, rest = database_url.partition('://')
+    if '+' in scheme:
+        return database_url
+    return f'{ASYNC_DRIVERS.get(scheme, scheme)}{separator}{rest}'
+
+
+def apply_sqlite_pragmas(config: dict):
+    """
+    Returns a connect listener that applies the SQLite storage profile from the configuration
+    (journal mode, synchronous, mmap size, cache size and busy timeout) to every new connection.
+    Settings that are None keep the SQLite defaults.
+    """
+    pragmas = {
+        'journal_mode': config.get('sqlite_journal_mode', 'wal'),
+        'synchronous': config.get('sqlite_synchronous', 'normal'),
+        'mmap_size': config.get('sqlite_mmap_size', 268435456),
+        'cache_size': config.get('sqlite_cache_size', -16000),
+        'busy_timeout': config.get('sqlite_busy_timeout_ms', 5000),
+    }
+
+    def on_connect(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            if value is not None:
+                cursor.execute(f'PRAGMA {pragma}={value}')
+        cursor.close()
+
+    return on_connect
+
+
+def init_database(config: dict):
+    """
+    Creates the async engine and session factory used by all database helpers.
+    :param config: A dictionary containing the database configuration
+    """
+    global engine, Session, stats_buffer, activity_tracker
+    database_url = to_async_url(config.get('database_url', 'sqlite:///data.db'))
+    engine_args = {}
+    if 'pool_size' in config and ':memory:' not in database_url:
+        # aiosqlite defaults to NullPool, which opens a new connection (and reapplies the pragmas) per session
+        engine_args['poolclass'] = AsyncAdaptedQueuePool
+        engine_args['pool_size'] = config['pool_size']
+        engine_args['max_overflow'] = config.get('max_overflow', 10)
+    engine = create_async_engine(database_url, echo=False, **engine_args)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine.sync_engine, 'connect', apply_sqlite_pragmas(config))
+    Session = async_sessionmaker(bind=engine, expire_on_commit=False)
+    stats_buffer = StatsBuffer(config.get('stats_flush_interval_ms', 1000), config.get('stats_flush_max_entries', 100))
+    activity_tracker = ActivityTracker(config.get('last_active_interval_s', 300), config.get('stats_flush_interval_ms', 1000))
+
+
+async def start_write_behind():
+    """
+    Switches DailyStats increments and last_active updates to their write-behind buffers.
+    """
+    await stats_buffer.start()
+    await activity_tracker.start()
+
+
+async def dispose_database():
+    """
+    Writes all buffered updates and closes all pooled connections of the async engine.
+    """
+    for buffer in (stats_buffer, activity_tracker):
+        if buffer is not None:
+            await buffer.stop()
+    if engine is not None:
+        await engine.dispose()
+
+
+@asynccontextmanager
+async def session_scope():
+    session: AsyncSession = Session()
     try:
         yield session
-        session.commit()
+        await session.commit()
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         logging.error(f'Error occurred: {e}')
         raise
     finally:
-        session.close()
+        await session.close()
 
 
-def create_chat_user_or_get(update: Update):
+async def create_chat_user_or_get(update: Update):
+    """
+    Creates the ChatUser of the chat if needed and records its activity.
+    Users already known to the running bot are handled in memory and return None.
+    """
     chat_id = update.message.chat_id
-    with Session() as session:
-        chat_user = session.query(ChatUser).get(chat_id)
+    if activity_tracker.running and activity_tracker.touch(chat_id):
+        return None
+    async with Session() as session:
+        chat_user = await session.get(ChatUser, chat_id)
         if chat_user is not None:
             chat_user.last_active = datetime.datetime.now()
-            session.commit()
+            await session.commit()
+            activity_tracker.remember(chat_id, chat_user.last_active)
             return chat_user
         try:
-            chat_user = ChatUser()
-            chat_user.chat_id = chat_id
-            chat_user.username = f"@{update.message.from_user.username}" if update.message.from_user.username else f"{update.message.from_user.first_name} {update.message.from_user.last_name}"
-
-            daily_stats = session.query(DailyStats).filter(DailyStats.user_id.is_(chat_id), DailyStats.for_day.is_(func.current_date())).first()
-            if daily_stats is None:
-                daily_stats = DailyStats(user_id=chat_id)
-            daily_stats.for_day = func.current_date()
-            session.add(chat_user)
-            session.add(daily_stats)
-            session.commit()
+            username = f"@{update.message.from_user.username}" if update.message.from_user.username else f"{update.message.from_user.first_name} {update.message.from_user.last_name}"
+
+            # concurrent first messages of a new chat all get here, so the rows are inserted
+            # unless another call inserted them meanwhile, then the winning row is read back
+            await session.execute(dialect_insert(ChatUser.__table__)
+                                  .values(chat_id=chat_id, username=username)
+                                  .on_conflict_do_nothing(index_elements=[ChatUser.__table__.c.chat_id]))
+            daily_stats = DailyStats.__table__
+            await session.execute(dialect_insert(daily_stats)
+                                  .values(user_id=chat_id, for_day=utc_today())
+                                  .on_conflict_do_nothing(index_elements=[daily_stats.c.user_id,
+                                                                          daily_stats.c.for_day]))
+            await session.commit()
+            chat_user = await session.get(ChatUser, chat_id, populate_existing=True)
+            activity_tracker.remember(chat_id, datetime.datetime.now())
             return chat_user
         except SQLAlchemyError as e:
-            session.rollback()
-            logging.error(e)
-            raise
-
-def update_stats(chat_id, messages=0, images=0):
-    with Session() as session:
-        daily_stats = get_stats_internal(session, chat_id)
-        try:
-            daily_stats.messages += messages
-            daily_stats.images += images
-            session.commit()
-        except SQLAlchemyError as e:
-            session.rollback()
+            await session.rollback()
             logging.error(e)
             raise
 
-def get_stats_internal(session, chat_id):
-    daily_stats = session.query(DailyStats).filter(DailyStats.user_id.is_(chat_id), DailyStats.for_day.is_(func.current_date())).first()
-    if daily_stats is None:
-        daily_stats = DailyStats(user_id=chat_id)
-        session.add(daily_stats)
-        session.commit()
-    return daily_stats
-
-def get_stats(chat_id) -> DailyStats:
-    with session_scope() as session:
-        return get_stats_internal(session, chat_id)
-
-def is_user_within_messages_limit(chat_id, config):
-    if is_admin(config, chat_id) or is_premium(chat_id):
-        return True
-    max_free_messages_daily = int(config['max_free_messages_daily'])
-    with session_scope() as session:
-        messages_today = get_stats_internal(session, chat_id).messages
-    if messages_today >= max_free_messages_daily:
-        return False
-    return True
-
-def is_user_within_images_limit(chat_id, config):
-    if is_admin(config, chat_id) or is_premium(chat_id):
-        return True
-    max_free_images_daily = int(config['max_free_images_daily'])
-    with session_scope() as session:
-        images_today = get_stats_internal(session, chat_id).images
-    if images_today >= max_free_images_daily:
-        return False
-    return True
-
-def create_transaction(session: Session, chat_id, amount, ref_id, status) -> Transaction:
-    user = session.query(ChatUser).get(chat_id)
+def dialect_insert(table):
+    """
+    Returns an INSERT for the dialect of the engine, which supports on_conflict_do_update.
+    """
+    insert = postgresql_insert if engine.dialect.name == 'postgresql' else sqlite_insert
+    return insert(table)
+
+def upsert_daily_stats():
+    """
+    Builds an INSERT ... ON CONFLICT (user_id, for_day) DO UPDATE statement that adds
+    the messages and images parameters to the DailyStats row of the user_id and for_day
+    parameters, creating it if needed. Executing it with a list of parameters batches several users.
+    """
+    table = DailyStats.__table__
+    statement = dialect_insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.for_day],
+        set_={'messages': table.c.messages + statement.excluded.messages,
+              'images': table.c.images + statement.excluded.images}
+    )
+
+async def update_stats(chat_id, messages=0, images=0):
+    if stats_buffer.running:
+        stats_buffer.add(chat_id, messages, images)
+        return
+    async with session_scope() as session:
+        await session.execute(upsert_daily_stats(), {'user_id': chat_id, 'for_day': utc_today(),
+                                                      'messages': messages, 'images': images})
+
+def upsert_monthly_stats():
+    """
+    Builds an INSERT ... ON CONFLICT (user_id, for_month) DO UPDATE statement that adds
+    the messages and images parameters to a MonthlyStats row.
+    """
+    table = MonthlyStats.__table__
+    statement = dialect_insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.for_month],
+        set_={'messages': table.c.messages + statement.excluded.messages,
+              'images': table.c.images + statement.excluded.images}
+    )
+
+async def rollup_daily_stats(retention_days=90, chunk_size=500) -> int:
+    """
+    Moves DailyStats rows older than retention_days into MonthlyStats.
+    Every chunk of rows is rolled up in its own short transaction,
+    so the SQLite write lock is never held for long.
+    :return: The number of DailyStats rows rolled up
+    """
+    cutoff = utc_today() - datetime.timedelta(days=retention_days)
+    rolled_up = 0
+    last_key = None
+    while True:
+        async with session_scope() as session:
+            # walk the (user_id, for_day) primary key instead of scanning for old days on every chunk
+            query = select(DailyStats.user_id, DailyStats.for_day, DailyStats.messages, DailyStats.images) \
+                .filter(DailyStats.for_day < cutoff) \
+                .order_by(DailyStats.user_id, DailyStats.for_day) \
+                .limit(chunk_size)
+            if last_key is not None:
+                query = query.filter(tuple_(DailyStats.user_id, DailyStats.for_day) > last_key)
+            rows = (await session.execute(query)).all()
+            if not rows:
+                return rolled_up
+            months = {}
+            for user_id, for_day, messages, images in rows:
+                totals = months.setdefault((user_id, for_day.replace(day=1)), [0, 0])
+                totals[0] += messages
+                totals[1] += images
+            await session.execute(upsert_monthly_stats(), [
+                {'user_id': user_id, 'for_month': for_month, 'messages': messages, 'images': images}
+                for (user_id, for_month), (messages, images) in months.items()
+            ])
+            # the chunk is exactly the old rows between the previous and the last primary key read
+            chunk_key = tuple_(DailyStats.user_id, DailyStats.for_day)
+            chunk = DailyStats.__table__.delete() \
+                .where(DailyStats.for_day < cutoff, chunk_key <= (rows[-1][0], rows[-1][1]))
+            if last_key is not None:
+                chunk = chunk.where(chunk_key > last_key)
+            await session.execute(chunk)
+            last_key = (rows[-1][0], rows[-1][1])
+        rolled_up += len(rows)
+        # let the handlers use the database between two chunks
+        await asyncio.sleep(0)
+
+async def load_user_context(chat_id) -> UserContext:
+    """
+    Loads the ChatUser row, with its premium_until, and today's DailyStats of a user in one query.
+    """
+    today = utc_today()
+    query = select(ChatUser, DailyStats) \
+        .select_from(ChatUser) \
+        .outerjoin(DailyStats, and_(DailyStats.user_id == ChatUser.chat_id,
+                                    DailyStats.for_day == today)) \
+        .filter(ChatUser.chat_id == chat_id)
+    async with Session() as session:
+        row = (await session.execute(query)).first()
+    if row is None:
+        return UserContext(chat_id, None, None, None, today)
+    chat_user, daily_stats = row
+    entitlements.put(chat_id, chat_user.premium_until)
+    return UserContext(chat_id, chat_user, daily_stats, chat_user.premium_until, today)
+
+async def create_transaction(session: AsyncSession, chat_id, amount, ref_id, status) -> Transaction:
+    user = await session.get(ChatUser, chat_id)
     transaction = Transaction()
     transaction.user_id = user.chat_id
     transaction.currency = 'XTR'
@@ -157,7 +588,7 @@ def create_transaction(session: Session, chat_id, amount, ref_id, status) -> Tra
     transaction.status = status
     transaction.ref_id = ref_id
     session.add(transaction)
-    session.flush()
+    await session.flush()
     return transaction
 
 # def update_transaction(session: Session, transaction_id: int, status: str):
@@ -168,9 +599,9 @@ def create_transaction(session: Session, chat_id, amount, ref_id, status) -> Tra
 #     with session_scope() as session:
 #         update_transaction(session, transaction_id, 'canceled')
 
-def create_subscription(chat_id, amount, ref_id) -> Subscription:
-    with session_scope() as session:
-        transaction = create_transaction(session, chat_id, amount, ref_id, 'successful')
+async def create_subscription(chat_id, amount, ref_id) -> Subscription:
+    async with session_scope() as session:
+        transaction = await create_transaction(session, chat_id, amount, ref_id, 'successful')
         start_date = datetime.datetime.today()
         end_date = datetime.datetime.today() + datetime.timedelta(days=30)
         subscription = Subscription(plan_name='Premium',
@@ -178,12 +609,91 @@ def create_subscription(chat_id, amount, ref_id) -> Subscription:
                                     start_date=start_date,
                                     end_date=end_date)
         session.add(subscription)
-        return subscription
-
-def is_premium(chat_id):
-    with session_scope() as session:
-        transaction = session.query(Transaction).filter(Transaction.user_id.is_(chat_id), Transaction.status.is_('successful')).first()
-        if transaction is None:
-            return False
-        subscription = session.query(Subscription).filter(Subscription.transaction_id.is_(transaction.id), Subscription.end_date >= datetime.datetime.today()).first()
-        return subscription is not None
+        user = await session.get(ChatUser, chat_id)
+        if user.premium_until is None or user.premium_until < end_date:
+            user.premium_until = end_date
+    entitlements.invalidate(chat_id)
+    return subscription
+
+async def refund_transaction(chat_id, ref_id):
+    """
+    Marks the transaction with the given telegram payment charge id as refunded,
+    which ends the subscription bought with it.
+    """
+    async with session_scope() as session:
+        await session.execute(update(Transaction)
+                              .filter(Transaction.user_id == chat_id, Transaction.ref_id == ref_id)
+                              .values(status='refunded'))
+        latest_end_date = select(func.max(Subscription.end_date)) \
+            .join(Transaction, Subscription.transaction_id == Transaction.id) \
+            .filter(Transaction.user_id == chat_id, Transaction.status == 'successful') \
+            .scalar_subquery()
+        await session.execute(update(ChatUser)
+                              .filter(ChatUser.chat_id == chat_id)
+                              .values(premium_until=latest_end_date))
+    entitlements.invalidate(chat_id)
+
+async def get_premium_until(chat_id):
+    """
+    Returns the end date of the latest successful subscription of a user, or None if there is none.
+    """
+    async with session_scope() as session:
+        return await session.scalar(select(ChatUser.premium_until).filter(ChatUser.chat_id == chat_id))
+
+async def is_premium(chat_id):
+    premium_until = entitlements.get(chat_id)
+    if premium_until is EntitlementCache.MISSING:
+        premium_until = await get_premium_until(chat_id)
+        entitlements.put(chat_id, premium_until)
+    return premium_until is not None and premium_until >= datetime.datetime.today()
+
+async def get_premium_user_ids() -> set[int]:
+    """
+    Returns the chat ids of all users with an active subscription.
+    """
+    async with session_scope() as session:
+        return set(await session.scalars(
+            select(ChatUser.chat_id).filter(ChatUser.premium_until >= datetime.datetime.today())))
+
+async def add_usage_event(user_id, kind, day, amount, cost, detail=None):
+    async with session_scope() as session:
+        await session.execute(UsageEvent.__table__.insert().values(
+            user_id=str(user_id), kind=kind, day=day, amount=amount, cost=cost,
+            detail=str(detail) if detail is not None else None))
+
+async def get_usage_amounts(user_id, kind, day) -> tuple[float, float]:
+    """
+    Sums the amounts of one kind of usage_event of a user for the given day and its month.
+    """
+    first_of_month = day.replace(day=1)
+    async with session_scope() as session:
+        row = (await session.execute(
+            select(func.coalesce(func.sum(case((UsageEvent.day == day, UsageEvent.amount), else_=0)), 0),
+                   func.coalesce(func.sum(UsageEvent.amount), 0))
+            .filter(UsageEvent.user_id == str(user_id), UsageEvent.kind == kind,
+                    UsageEvent.day >= first_of_month, UsageEvent.day <= day)
+        )).one()
+    return row[0], row[1]
+
+async def get_usage_costs(user_id, day) -> tuple[float, float, float]:
+    """
+    Sums the usage_event costs of a user for the given day, its month and all time.
+    """
+    async with session_scope() as session:
+        row = (await session.execute(
+            select(func.coalesce(func.sum(case((UsageEvent.day == day, UsageEvent.cost), else_=0)), 0),
+                   func.coalesce(func.sum(case((UsageEvent.day >= day.replace(day=1), UsageEvent.cost), else_=0)), 0),
+                   func.coalesce(func.sum(UsageEvent.cost), 0))
+            .filter(UsageEvent.user_id == str(user_id))
+        )).one()
+    return row[0], row[1], row[2]
+
+async def get_usage_days(user_id) -> tuple[datetime.date | None, datetime.date | None]:
+    """
+    Returns the first and the last day with a usage_event of a user, or None if there is none.
+    """
+    async with session_scope() as session:
+        row = (await session.execute(
+            select(func.min(UsageEvent.day), func.max(UsageEvent.day)).filter(UsageEvent.user_id == str(user_id))
+        )).one()
+    return row[0], row[1]
@@ -0,0 +1,114 @@
+"""
+One-shot import of the usage_logs/*.json files of UsageTracker into the usage_event table,
+for switching an existing bot to USAGE_STORAGE=sql.
+
+Every day of the usage history, including journal records not snapshotted yet, becomes
+one usage_event row per kind (and per image size or TTS model). Costs are recomputed from
+the prices configured in .env, the same way UsageTracker.initialize_all_time_cost does. Monthly
+totals of compacted usage histories are imported as rows of the first day of their month. Files are parsed in parallel worker processes,
+and users that already have usage_event rows are skipped, so the import can be resumed.
+
+Run from the repository root after `alembic upgrade head`, e.g.:
+
+    python bot/import_usage_logs.py --logs-dir usage_logs --workers 4
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+from sqlalchemy import select
+
+import entities
+from entities import UsageEvent, init_database, dispose_database
+from usage_tracker import UsageTracker, USAGE_LOGS_DIR
+
+
+def load_prices() -> dict:
+    return {
+        'token_price': float(os.environ.get('TOKEN_PRICE', 0.002)),
+        'image_prices': [float(i) for i in os.environ.get('IMAGE_PRICES', "0.016,0.018,0.02").split(",")],
+        'vision_token_price': float(os.environ.get('VISION_TOKEN_PRICE', '0.01')),
+        'tts_prices': [float(i) for i in os.environ.get('TTS_PRICES', "0.015,0.030").split(",")],
+        'transcription_price': float(os.environ.get('TRANSCRIPTION_PRICE', 0.006)),
+    }
+
+
+def usage_events(path: str, prices: dict) -> tuple[str, list[dict]]:
+    """
+    Converts the usage history of one usage log file into usage_event rows.
+    """
+    user_id = os.path.basename(path)[:-len('.json')]
+    # loading through UsageTracker replays the journal of USAGE_STORAGE=journal as well
+    history = UsageTracker(user_id, None, logs_dir=os.path.dirname(path)).usage['usage_history']
+    rows = []
+
+    def add(kind, day, amount, cost, detail=None):
+        if len(day) == len('2023-03'):
+            # monthly total of a compacted usage history
+            day = f'{day}-01'
+        rows.append({'user_id': user_id, 'kind': kind, 'day': datetime.date.fromisoformat(day), 'amount': amount,
+                     'cost': round(cost, 6), 'detail': detail, 'created_at': datetime.datetime.now()})
+
+    for day, tokens in history.get('chat_tokens', {}).items():
+        add('chat_tokens', day, tokens, tokens * prices['token_price'] / 1000)
+    for day, images in history.get('number_images', {}).items():
+        for size, count in enumerate(images):
+            if count:
+                add('number_images', day, count, count * prices['image_prices'][size], str(size))
+    for day, tokens in history.get('vision_tokens', {}).items():
+        add('vision_tokens', day, tokens, tokens * prices['vision_token_price'] / 1000)
+    for day, seconds in history.get('transcription_seconds', {}).items():
+        add('transcription_seconds', day, seconds, seconds * prices['transcription_price'] / 60)
+    for model_index, tts_model in enumerate(['tts-1', 'tts-1-hd']):
+        for day, characters in history.get('tts_characters', {}).get(tts_model, {}).items():
+            add('tts_characters', day, characters, characters * prices['tts_prices'][model_index] / 1000, tts_model)
+    return user_id, rows
+
+
+async def run(args):
+    init_database(config={'database_url': os.environ.get('DATABASE_URL', 'sqlite:///data.db')})
+    async with entities.session_scope() as session:
+        imported_users = set(await session.scalars(select(UsageEvent.user_id).distinct()))
+
+    paths = [path for path in glob.glob(os.path.join(args.logs_dir, '*.json'))
+             if os.path.basename(path)[:-len('.json')] not in imported_users]
+    print(f'importing {len(paths)} usage logs, skipping {len(imported_users)} users already imported')
+
+    loop = asyncio.get_running_loop()
+    prices = load_prices()
+    users, events = 0, 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        parsed = [loop.run_in_executor(executor, usage_events, path, prices) for path in paths]
+        for next_parsed in asyncio.as_completed(parsed):
+            try:
+                user_id, rows = await next_parsed
+            except (OSError, ValueError, KeyError) as e:
+                print(f'skipping unreadable usage log: {e}')
+                continue
+            # one transaction per user, so an interrupted import never leaves a user half imported
+            async with entities.session_scope() as session:
+                for start in range(0, len(rows), args.batch_size):
+                    await session.execute(UsageEvent.__table__.insert(), rows[start:start + args.batch_size])
+            users += 1
+            events += len(rows)
+    await dispose_database()
+    print(f'imported {events} usage events of {users} users')
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Import usage_logs/*.json into the usage_event table')
+    parser.add_argument('--logs-dir', default=USAGE_LOGS_DIR)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes parsing the usage logs')
+    parser.add_argument('--batch-size', type=int, default=1000, help='rows per INSERT statement')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
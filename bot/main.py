@@ -3,6 +3,8 @@ import os
 
 from dotenv import load_dotenv
 
+from access_policy import AccessPolicy
+from entities import init_database
 from plugin_manager import PluginManager
 from openai_helper import OpenAIHelper, default_max_tokens, are_functions_available
 from telegram_bot import ChatGPTTelegramBot
@@ -12,6 +14,9 @@ def main():
     # Read .env file
     load_dotenv()
 
+    # tiktoken reads its cache directory from the environment, set it once before any encoding is loaded
+    os.environ.setdefault('TIKTOKEN_CACHE_DIR', 'tiktoken_cache')
+
     # Setup logging
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -37,6 +42,16 @@ def main():
         'proxy': os.environ.get('PROXY', None) or os.environ.get('OPENAI_PROXY', None),
         'max_history_size': int(os.environ.get('MAX_HISTORY_SIZE', 15)),
         'max_conversation_age_minutes': int(os.environ.get('MAX_CONVERSATION_AGE_MINUTES', 180)),
+        'conversation_store': os.environ.get('CONVERSATION_STORE', 'memory').lower(),
+        'conversation_max_chats': int(os.environ.get('CONVERSATION_MAX_CHATS', 10000)),
+        'conversation_max_bytes': int(os.environ.get('CONVERSATION_MAX_BYTES', 256 * 1024 * 1024)),
+        'redis_url': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+        'conversation_spill_path': os.environ.get('CONVERSATION_SPILL_PATH', ''),
+        'conversation_spill_after_minutes': int(os.environ.get('CONVERSATION_SPILL_AFTER_MINUTES', 30)),
+        'max_history_tokens': int(os.environ.get('MAX_HISTORY_TOKENS', 0)),
+        'background_summaries': os.environ.get('BACKGROUND_SUMMARIES', 'false').lower() == 'true',
+        'summary_lead_messages': int(os.environ.get('SUMMARY_LEAD_MESSAGES', 2)),
+        'summary_lead_ratio': float(os.environ.get('SUMMARY_LEAD_RATIO', 0.8)),
         'assistant_prompt': os.environ.get('ASSISTANT_PROMPT', 'You are a helpful assistant.'),
         'max_tokens': int(os.environ.get('MAX_TOKENS', max_tokens_default)),
         'n_choices': int(os.environ.get('N_CHOICES', 1)),
@@ -89,6 +104,7 @@ def main():
         'budget_period': os.environ.get('BUDGET_PERIOD', 'monthly').lower(),
         'user_budgets': os.environ.get('USER_BUDGETS', os.environ.get('MONTHLY_USER_BUDGETS', '*')),
         'guest_budget': float(os.environ.get('GUEST_BUDGET', os.environ.get('MONTHLY_GUEST_BUDGET', '100.0'))),
+        'enforce_budgets': os.environ.get('ENFORCE_BUDGETS', 'false').lower() == 'true',
         'stream': os.environ.get('STREAM', 'true').lower() == 'true',
         'proxy': os.environ.get('PROXY', None) or os.environ.get('TELEGRAM_PROXY', None),
         'voice_reply_transcript': os.environ.get('VOICE_REPLY_WITH_TRANSCRIPT_ONLY', 'false').lower() == 'true',
@@ -107,14 +123,42 @@ def main():
         'max_free_messages_daily': os.environ.get('MAX_FREE_MESSAGES_DAILY', 10),
         'max_free_images_daily': os.environ.get('MAX_FREE_IMAGES_DAILY', 2),
         'free_model': os.environ.get('FREE_MODEL', 'gpt-4o-mini'),
-        'premium_model': os.environ.get('PREMIUM_MODEL', 'gpt-o1-mini')
+        'premium_model': os.environ.get('PREMIUM_MODEL', 'gpt-o1-mini'),
+        'stats_retention_days': int(os.environ.get('STATS_RETENTION_DAYS', 90)),
+        'stats_rollup_chunk_size': int(os.environ.get('STATS_ROLLUP_CHUNK_SIZE', 500)),
+        'usage_storage': os.environ.get('USAGE_STORAGE', 'json').lower(),
+        'usage_snapshot_interval': int(os.environ.get('USAGE_SNAPSHOT_INTERVAL', 500)),
+        'usage_cache_size': int(os.environ.get('USAGE_CACHE_SIZE', 10000)),
+        'usage_cache_ttl': int(os.environ.get('USAGE_CACHE_TTL', 3600)),
+        'usage_write_debounce_ms': int(os.environ.get('USAGE_WRITE_DEBOUNCE_MS', 1000)),
+        'guest_usage_shards': max(1, int(os.environ.get('GUEST_USAGE_SHARDS', 8))),
+        'usage_store_dir': os.environ.get('USAGE_STORE_DIR', 'usage_store'),
+        'usage_store_days': int(os.environ.get('USAGE_STORE_DAYS', 90)),
+        'conversation_sweep_interval_minutes': int(os.environ.get('CONVERSATION_SWEEP_INTERVAL_MINUTES', 5))
     }
+    # parse the user id and budget lists once instead of on every update
+    telegram_config['access_policy'] = AccessPolicy.from_config(telegram_config)
 
     plugin_config = {
         'plugins': os.environ.get('PLUGINS', '').split(',')
     }
 
+    database_config = {
+        'database_url': os.environ.get('DATABASE_URL', 'sqlite:///data.db'),
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'sqlite_journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'wal'),
+        'sqlite_synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'normal'),
+        'sqlite_mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 268435456)),
+        'sqlite_cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -16000)),
+        'sqlite_busy_timeout_ms': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        'stats_flush_interval_ms': int(os.environ.get('STATS_FLUSH_INTERVAL_MS', 1000)),
+        'stats_flush_max_entries': int(os.environ.get('STATS_FLUSH_MAX_ENTRIES', 100)),
+        'last_active_interval_s': int(os.environ.get('LAST_ACTIVE_UPDATE_INTERVAL', 300))
+    }
+
     # Setup and run ChatGPT and Telegram bot
+    init_database(config=database_config)
     plugin_manager = PluginManager(config=plugin_config)
     openai_helper = OpenAIHelper(config=openai_config, plugin_manager=plugin_manager)
     telegram_bot = ChatGPTTelegramBot(config=telegram_config, openai=openai_helper)
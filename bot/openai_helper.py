@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 import datetime
 import io
 import json
@@ -10,8 +11,11 @@ import httpx
 import openai
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 
+from conversation_store import Conversation, create_conversation_store
 from entities import is_premium
 from plugin_manager import PluginManager
+from stream_events import Delta, DirectResult, Done, Usage
+from token_counter import TokenCounter, history_token_budget
 from utils import is_direct_result, encode_image
 
 
@@ -62,9 +66,9 @@ class OpenAIHelper:
         self.client = openai.AsyncOpenAI(api_key=config['api_key'], http_client=http_client)
         self.config = config
         self.plugin_manager = plugin_manager
-        self.conversations: dict[int: list] = {}  # {chat_id: history}
-        self.conversations_vision: dict[int: bool] = {}  # {chat_id: is_vision}
-        self.last_updated: dict[int: datetime] = {}  # {chat_id: last_update_timestamp}
+        self.conversations = create_conversation_store(config)
+        self.token_counter = TokenCounter()
+        self.summaries: dict[int: asyncio.Task] = {}  # {chat_id: background summary task}
 
     async def get_chat_response(self, chat_id: int, query: str) -> tuple[str, str]:
         """
@@ -74,9 +78,9 @@ class OpenAIHelper:
         :return: The answer from the model and the number of tokens used
         """
         plugins_used = ()
-        response = await self.__common_get_chat_response(chat_id, query)
-        if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-            response, plugins_used = await self.__handle_function_call(chat_id, response)
+        response, conversation = await self.__common_get_chat_response(chat_id, query)
+        if self.config['enable_functions'] and not conversation.vision:
+            response, plugins_used = await self.__handle_function_call(chat_id, conversation, response)
             if is_direct_result(response):
                 return response, '0'
 
@@ -86,13 +90,13 @@ class OpenAIHelper:
             for index, choice in enumerate(response.choices):
                 content = choice.message.content.strip()
                 if index == 0:
-                    self.__add_to_history(chat_id, role="assistant", content=content)
+                    await self.__add_to_history(chat_id, conversation, role="assistant", content=content)
                 answer += f'{index + 1}\u20e3\n'
                 answer += content
                 answer += '\n\n'
         else:
             answer = response.choices[0].message.content.strip()
-            self.__add_to_history(chat_id, role="assistant", content=answer)
+            await self.__add_to_history(chat_id, conversation, role="assistant", content=answer)
 
         bot_language = self.config['bot_language']
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
@@ -109,43 +113,58 @@ class OpenAIHelper:
 
         return answer, response.usage.total_tokens
 
-    async def get_chat_response_stream(self, chat_id: int, query: str):
+    async def get_chat_response_events(self, chat_id: int, query: str):
         """
         Stream response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
-        :return: The answer from the model and the number of tokens used, or 'not_finished'
+        :return: Delta events with the text of the answer, then a Usage and a Done event,
+                 or a single DirectResult event if a plugin answered directly
         """
         plugins_used = ()
-        response = await self.__common_get_chat_response(chat_id, query, stream=True)
-        if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-            response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
+        response, conversation = await self.__common_get_chat_response(chat_id, query, stream=True)
+        if self.config['enable_functions'] and not conversation.vision:
+            response, plugins_used = await self.__handle_function_call(chat_id, conversation, response, stream=True)
             if is_direct_result(response):
-                yield response, '0'
+                yield DirectResult(response)
                 return
 
-        answer = ''
-        async for chunk in response:
-            if len(chunk.choices) == 0:
-                continue
-            delta = chunk.choices[0].delta
-            if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
-        answer = answer.strip()
-        self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        parts = []
+        async for event in self.__stream_deltas(response, parts):
+            yield event
+        answer = ''.join(parts).strip()
+        await self.__add_to_history(chat_id, conversation, role="assistant", content=answer)
+        tokens_used = self.token_counter.count_messages(conversation.history, await self.get_model(chat_id))
 
+        footer = ''
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
         if self.config['show_usage']:
-            answer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
+            footer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
             if show_plugins_used:
-                answer += f"\n🔌 {', '.join(plugin_names)}"
+                footer += f"\n🔌 {', '.join(plugin_names)}"
         elif show_plugins_used:
-            answer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
+            footer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
 
-        yield answer, tokens_used
+        if footer:
+            yield Delta(footer)
+        yield Usage(tokens_used)
+        yield Done()
+
+    async def __stream_deltas(self, response, parts: list[str]):
+        """
+        Yields a Delta event for every chunk of text of a streamed completion and collects the text in parts.
+        Whitespace at the start of the answer is skipped.
+        """
+        async for chunk in response:
+            if len(chunk.choices) == 0:
+                continue
+            text = chunk.choices[0].delta.content
+            if text and not parts:
+                text = text.lstrip()
+            if text:
+                parts.append(text)
+                yield Delta(text)
 
     @retry(
         reraise=True,
@@ -158,35 +177,39 @@ class OpenAIHelper:
         Request a response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
-        :return: The answer from the model and the number of tokens used
+        :return: The response of the model and the conversation of the chat
         """
         bot_language = self.config['bot_language']
         try:
-            if chat_id not in self.conversations or self.__max_age_reached(chat_id):
-                self.reset_chat_history(chat_id)
-
-            self.last_updated[chat_id] = datetime.datetime.now()
+            conversation = await self.__get_conversation(chat_id)
+            model = await self.get_model(chat_id)
+            token_budget = self.__history_token_budget(model, self.config['max_tokens'])
 
-            self.__add_to_history(chat_id, role="user", content=query)
+            await self.__add_to_history(chat_id, conversation, role="user", content=query)
 
             # Summarize the chat history if it's too long to avoid excessive token usage
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
+            exceeded_max_history_size = len(conversation.history) > self.config['max_history_size'] or \
+                self.token_counter.count_messages(conversation.history, model) > token_budget
 
-            if exceeded_max_history_size:
+            if self.config['background_summaries']:
+                self.__summarise_in_background(chat_id, conversation, model, token_budget)
+            elif exceeded_max_history_size:
                 logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
                 try:
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
+                    summary = await self.__summarise(conversation.history[:-1])
                     logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.__add_to_history(chat_id, role="user", content=query)
+                    conversation = await self.reset_chat_history(chat_id, conversation.history[0]['content'])
+                    await self.__add_to_history(chat_id, conversation, role="assistant", content=summary)
+                    await self.__add_to_history(chat_id, conversation, role="user", content=query)
                 except Exception as e:
                     logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+                    conversation.history = conversation.history[-self.config['max_history_size']:]
+                    await self.conversations.save(chat_id, conversation)
+            await self.__truncate_to_budget(chat_id, conversation, model, token_budget)
 
             common_args = {
-                'model': self.get_model(chat_id),
-                'messages': self.conversations[chat_id],
+                'model': model,
+                'messages': conversation.history,
                 'temperature': self.config['temperature'],
                 'n': self.config['n_choices'],
                 'max_tokens': self.config['max_tokens'],
@@ -195,12 +218,12 @@ class OpenAIHelper:
                 'stream': stream
             }
 
-            if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
+            if self.config['enable_functions'] and not conversation.vision:
                 functions = self.plugin_manager.get_functions_specs()
                 if len(functions) > 0:
                     common_args['functions'] = self.plugin_manager.get_functions_specs()
                     common_args['function_call'] = 'auto'
-            return await self.client.chat.completions.create(**common_args)
+            return await self.client.chat.completions.create(**common_args), conversation
 
         except openai.RateLimitError as e:
             raise e
@@ -211,10 +234,10 @@ class OpenAIHelper:
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
-    def get_model(self, chat_id):
-        return self.config['premium_model'] if is_premium(chat_id) else self.config['free_model']
+    async def get_model(self, chat_id):
+        return self.config['premium_model'] if await is_premium(chat_id) else self.config['free_model']
 
-    async def __handle_function_call(self, chat_id, response, stream=False, times=0, plugins_used=()):
+    async def __handle_function_call(self, chat_id, conversation, response, stream=False, times=0, plugins_used=()):
         function_name = ''
         arguments = ''
         if stream:
@@ -252,20 +275,21 @@ class OpenAIHelper:
             plugins_used += (function_name,)
 
         if is_direct_result(function_response):
-            self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name,
-                                                content=json.dumps({'result': 'Done, the content has been sent'
-                                                                              'to the user.'}))
+            await self.__add_function_call_to_history(chat_id, conversation, function_name=function_name,
+                                                      content=json.dumps({'result': 'Done, the content has been sent'
+                                                                                    'to the user.'}))
             return function_response, plugins_used
 
-        self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name, content=function_response)
+        await self.__add_function_call_to_history(chat_id, conversation, function_name=function_name,
+                                                  content=function_response)
         response = await self.client.chat.completions.create(
             model=self.config['model'],
-            messages=self.conversations[chat_id],
+            messages=conversation.history,
             functions=self.plugin_manager.get_functions_specs(),
             function_call='auto' if times < self.config['functions_max_consecutive_calls'] else 'none',
             stream=stream
         )
-        return await self.__handle_function_call(chat_id, response, stream, times + 1, plugins_used)
+        return await self.__handle_function_call(chat_id, conversation, response, stream, times + 1, plugins_used)
 
     async def generate_image(self, prompt: str) -> tuple[str, str]:
         """
@@ -342,47 +366,57 @@ class OpenAIHelper:
         Request a response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
-        :return: The answer from the model and the number of tokens used
+        :return: The response of the model and the conversation of the chat
         """
         bot_language = self.config['bot_language']
         try:
-            if chat_id not in self.conversations or self.__max_age_reached(chat_id):
-                self.reset_chat_history(chat_id)
-
-            self.last_updated[chat_id] = datetime.datetime.now()
+            conversation = await self.__get_conversation(chat_id)
 
             if self.config['enable_vision_follow_up_questions']:
-                self.conversations_vision[chat_id] = True
-                self.__add_to_history(chat_id, role="user", content=content)
+                conversation.vision = True
+                await self.__add_to_history(chat_id, conversation, role="user", content=content)
             else:
                 for message in content:
                     if message['type'] == 'text':
                         query = message['text']
                         break
-                self.__add_to_history(chat_id, role="user", content=query)
+                await self.__add_to_history(chat_id, conversation, role="user", content=query)
+
+            model = self.config['vision_model']
+            token_budget = self.__history_token_budget(model, self.config['vision_max_tokens'])
+            # the image is sent with the last message even if only its prompt is kept in the history
+            token_budget -= self.token_counter.count_message({'role': 'user', 'content': content}, model) - \
+                self.token_counter.count_message(conversation.history[-1], model)
 
             # Summarize the chat history if it's too long to avoid excessive token usage
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
+            exceeded_max_history_size = len(conversation.history) > self.config['max_history_size'] or \
+                self.token_counter.count_messages(conversation.history, model) > token_budget
 
-            if exceeded_max_history_size:
+            if self.config['background_summaries']:
+                self.__summarise_in_background(chat_id, conversation, model, token_budget)
+            elif exceeded_max_history_size:
                 logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
                 try:
 
-                    last = self.conversations[chat_id][-1]
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
+                    last = conversation.history[-1]
+                    summary = await self.__summarise(conversation.history[:-1])
                     logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.conversations[chat_id] += [last]
+                    vision = conversation.vision
+                    conversation = await self.reset_chat_history(chat_id, conversation.history[0]['content'])
+                    conversation.vision = vision
+                    await self.__add_to_history(chat_id, conversation, role="assistant", content=summary)
+                    await self.conversations.append(chat_id, conversation, last)
                 except Exception as e:
                     logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+                    conversation.history = conversation.history[-self.config['max_history_size']:]
+                    await self.conversations.save(chat_id, conversation)
+            await self.__truncate_to_budget(chat_id, conversation, model, token_budget)
 
             message = {'role': 'user', 'content': content}
 
             common_args = {
-                'model': self.config['vision_model'],
-                'messages': self.conversations[chat_id][:-1] + [message],
+                'model': model,
+                'messages': conversation.history[:-1] + [message],
                 'temperature': self.config['temperature'],
                 'n': 1,  # several choices is not implemented yet
                 'max_tokens': self.config['vision_max_tokens'],
@@ -399,7 +433,7 @@ class OpenAIHelper:
             #         common_args['functions'] = self.plugin_manager.get_functions_specs()
             #         common_args['function_call'] = 'auto'
 
-            return await self.client.chat.completions.create(**common_args)
+            return await self.client.chat.completions.create(**common_args), conversation
 
         except openai.RateLimitError as e:
             raise e
@@ -421,7 +455,7 @@ class OpenAIHelper:
                                                       'image_url': {'url': image,
                                                                     'detail': self.config['vision_detail']}}]
 
-        response = await self.__common_get_chat_response_vision(chat_id, content)
+        response, conversation = await self.__common_get_chat_response_vision(chat_id, content)
 
         # functions are not available for this model
 
@@ -436,13 +470,13 @@ class OpenAIHelper:
             for index, choice in enumerate(response.choices):
                 content = choice.message.content.strip()
                 if index == 0:
-                    self.__add_to_history(chat_id, role="assistant", content=content)
+                    await self.__add_to_history(chat_id, conversation, role="assistant", content=content)
                 answer += f'{index + 1}\u20e3\n'
                 answer += content
                 answer += '\n\n'
         else:
             answer = response.choices[0].message.content.strip()
-            self.__add_to_history(chat_id, role="assistant", content=answer)
+            await self.__add_to_history(chat_id, conversation, role="assistant", content=answer)
 
         bot_language = self.config['bot_language']
         # Plugins are not enabled either
@@ -460,9 +494,10 @@ class OpenAIHelper:
 
         return answer, response.usage.total_tokens
 
-    async def interpret_image_stream(self, chat_id, fileobj, prompt=None):
+    async def interpret_image_events(self, chat_id, fileobj, prompt=None):
         """
-        Interprets a given PNG image file using the Vision model.
+        Interprets a given PNG image file using the Vision model, streaming the interpretation.
+        :return: Delta events with the text of the answer, then a Usage and a Done event
         """
         image = encode_image(fileobj)
         prompt = self.config['vision_prompt'] if prompt is None else prompt
@@ -471,73 +506,134 @@ class OpenAIHelper:
                                                       'image_url': {'url': image,
                                                                     'detail': self.config['vision_detail']}}]
 
-        response = await self.__common_get_chat_response_vision(chat_id, content, stream=True)
+        response, conversation = await self.__common_get_chat_response_vision(chat_id, content, stream=True)
 
         # if self.config['enable_functions']:
         #     response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
         #     if is_direct_result(response):
-        #         yield response, '0'
+        #         yield DirectResult(response)
         #         return
 
-        answer = ''
-        async for chunk in response:
-            if len(chunk.choices) == 0:
-                continue
-            delta = chunk.choices[0].delta
-            if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
-        answer = answer.strip()
-        self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        parts = []
+        async for event in self.__stream_deltas(response, parts):
+            yield event
+        answer = ''.join(parts).strip()
+        await self.__add_to_history(chat_id, conversation, role="assistant", content=answer)
+        tokens_used = self.token_counter.count_messages(conversation.history, self.config['vision_model'])
 
         # show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         # plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
         if self.config['show_usage']:
-            answer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
+            yield Delta(f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}")
         #     if show_plugins_used:
-        #         answer += f"\n🔌 {', '.join(plugin_names)}"
+        #         yield Delta(f"\n🔌 {', '.join(plugin_names)}")
         # elif show_plugins_used:
-        #     answer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
+        #     yield Delta(f"\n\n---\n🔌 {', '.join(plugin_names)}")
 
-        yield answer, tokens_used
+        yield Usage(tokens_used)
+        yield Done()
 
-    def reset_chat_history(self, chat_id, content=''):
+    async def reset_chat_history(self, chat_id, content='') -> Conversation:
         """
         Resets the conversation history.
+        :return: The new conversation of the chat
         """
         if content == '':
             content = self.config['assistant_prompt']
-        self.conversations[chat_id] = [{"role": "system", "content": content}]
-        self.conversations_vision[chat_id] = False
+        conversation = Conversation([{"role": "system", "content": content}])
+        await self.conversations.save(chat_id, conversation)
+        return conversation
 
-    def __max_age_reached(self, chat_id) -> bool:
+    async def __get_conversation(self, chat_id) -> Conversation:
         """
-        Checks if the maximum conversation age has been reached.
+        Returns the conversation of a chat for a new request, starting a new one if there is none
+        or the maximum conversation age has been reached.
         :param chat_id: The chat ID
+        """
+        conversation = await self.conversations.get(chat_id)
+        if conversation is None or self.__max_age_reached(conversation):
+            return await self.reset_chat_history(chat_id)
+        conversation.last_updated = datetime.datetime.now()
+        return conversation
+
+    def __history_token_budget(self, model: str, max_tokens: int) -> int:
+        return history_token_budget(model, max_tokens, self.config['max_history_tokens'])
+
+    async def __truncate_to_budget(self, chat_id, conversation: Conversation, model: str, token_budget: int):
+        """
+        Drops the oldest messages of a conversation that does not fit in the token budget, even once summarised.
+        """
+        if self.token_counter.count_messages(conversation.history, model) <= token_budget:
+            return
+        logging.info(f'Chat history for chat ID {chat_id} exceeds {token_budget} tokens. Dropping oldest messages...')
+        conversation.history = self.token_counter.truncate(conversation.history, model, token_budget)
+        await self.conversations.save(chat_id, conversation)
+
+    def __summarise_in_background(self, chat_id, conversation: Conversation, model: str, token_budget: int):
+        """
+        Starts summarising the history of a conversation before the last message once the history is
+        within SUMMARY_LEAD_MESSAGES messages or SUMMARY_LEAD_RATIO of the token budget of its limits.
+        At most one summary per chat runs at a time, and the request never waits for it.
+        """
+        if chat_id in self.summaries or len(conversation.history) < 3:
+            return
+        near_max_history_size = \
+            len(conversation.history) > self.config['max_history_size'] - self.config['summary_lead_messages']
+        near_token_budget = self.token_counter.count_messages(conversation.history, model) > \
+            token_budget * self.config['summary_lead_ratio']
+        if not near_max_history_size and not near_token_budget:
+            return
+        logging.info(f'Chat history for chat ID {chat_id} is getting long. Summarising in the background...')
+        history = list(conversation.history[:-1])
+        self.summaries[chat_id] = asyncio.create_task(self.__swap_in_summary(chat_id, history))
+
+    async def __swap_in_summary(self, chat_id, history: list[dict]):
+        """
+        Summarises a history and replaces it by the summary in the conversation of the chat,
+        keeping the messages added since. The summary is dropped if the conversation was reset
+        or truncated meanwhile.
+        :param chat_id: The chat ID
+        :param history: The history to summarise, the system prompt first
+        """
+        try:
+            summary = await self.__summarise(history)
+            logging.debug(f'Summary: {summary}')
+            replaced = await self.conversations.replace_prefix(
+                chat_id, history, [{"role": "system", "content": history[0]['content']},
+                                   {"role": "assistant", "content": summary}])
+            if not replaced:
+                logging.info(f'Chat history for chat ID {chat_id} changed while summarising. Dropping the summary...')
+        except Exception as e:
+            logging.warning(f'Error while summarising chat history in the background: {str(e)}')
+        finally:
+            self.summaries.pop(chat_id, None)
+
+    def __max_age_reached(self, conversation: Conversation) -> bool:
+        """
+        Checks if the maximum conversation age has been reached.
+        :param conversation: The conversation of the chat
         :return: A boolean indicating whether the maximum conversation age has been reached
         """
-        if chat_id not in self.last_updated:
-            return False
-        last_updated = self.last_updated[chat_id]
         now = datetime.datetime.now()
         max_age_minutes = self.config['max_conversation_age_minutes']
-        return last_updated < now - datetime.timedelta(minutes=max_age_minutes)
+        return conversation.last_updated < now - datetime.timedelta(minutes=max_age_minutes)
 
-    def __add_function_call_to_history(self, chat_id, function_name, content):
+    async def __add_function_call_to_history(self, chat_id, conversation, function_name, content):
         """
         Adds a function call to the conversation history
         """
-        self.conversations[chat_id].append({"role": "function", "name": function_name, "content": content})
+        await self.conversations.append(chat_id, conversation,
+                                        {"role": "function", "name": function_name, "content": content})
 
-    def __add_to_history(self, chat_id, role, content):
+    async def __add_to_history(self, chat_id, conversation, role, content):
         """
         Adds a message to the conversation history.
         :param chat_id: The chat ID
+        :param conversation: The conversation of the chat
         :param role: The role of the message sender
         :param content: The message content
         """
-        self.conversations[chat_id].append({"role": role, "content": content})
+        await self.conversations.append(chat_id, conversation, {"role": role, "content": content})
 
     async def __summarise(self, conversation) -> str:
         """
@@ -555,12 +651,3 @@ class OpenAIHelper:
             temperature=0.4
         )
         return response.choices[0].message.content
-
-    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def __count_tokens(self, messages) -> int:
-        return 0
-
-    # no longer needed
-
-    def __count_tokens_vision(self, image_bytes: bytes) -> int:
-        return 0
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from datetime import date
+
+import utils
+from entities import load_user_context, is_premium, update_stats, utc_today
+
+# kinds of requests, named after their DailyStats counters
+MESSAGES = 'messages'
+IMAGES = 'images'
+
+# reasons for refusing a request
+LIMIT = 'limit'
+BUDGET = 'budget'
+
+
+class UserQuota:
+    """
+    Messages and images a user requested today, counted in memory.
+    """
+
+    def __init__(self, day: date, messages: int, images: int):
+        self.day = day
+        self.used = {MESSAGES: messages, IMAGES: images}
+
+
+class QuotaEngine:
+    """
+    Decides whether a user may make a request now, for every kind of request.
+
+    The daily free message and image counters of a user are loaded from DailyStats once a day
+    and kept in a bounded LRU. consume() updates them in memory and hands the increment over to
+    the write-behind buffer of DailyStats. Premium status comes from the entitlement cache and
+    budgets from the running cost counters of the usage trackers, so once a user is cached a check
+    does not touch the database.
+    """
+
+    def __init__(self, config, usage, max_size=10000):
+        """
+        :param config: The bot configuration object
+        :param usage: The usage trackers of the bot, a UsageCache or a dict
+        :param max_size: maximum number of users whose counters are kept in memory, defaults to 10000
+        """
+        self.config = config
+        self.usage = usage
+        self.max_size = max_size
+        self.limits = {MESSAGES: int(config['max_free_messages_daily']),
+                       IMAGES: int(config['max_free_images_daily'])}
+        # user id -> UserQuota, least recently used first
+        self.quotas = OrderedDict()
+
+    async def get_user_quota(self, user_id) -> UserQuota:
+        """
+        Returns the counters of a user for today, loading them from DailyStats on a cache miss.
+        """
+        today = utc_today()
+        quota = self.quotas.get(user_id)
+        if quota is None:
+            user_context = await load_user_context(user_id)
+            today = user_context.day
+            # another request of the user may have loaded the counters meanwhile
+            quota = self.quotas.setdefault(user_id, UserQuota(today, user_context.messages_today,
+                                                              user_context.images_today))
+        elif quota.day != today:
+            quota = self.quotas[user_id] = UserQuota(today, 0, 0)
+        self.quotas.move_to_end(user_id)
+        while len(self.quotas) > self.max_size:
+            self.quotas.popitem(last=False)
+        return quota
+
+    async def check(self, user_id, kind, name=None) -> str | None:
+        """
+        Checks if a user may make a request of the given kind now.
+        :param user_id: The user id
+        :param kind: MESSAGES or IMAGES
+        :param name: The user name, stored with a new usage tracker
+        :return: None if the request is allowed, LIMIT if the daily free requests of the kind are used up,
+                 BUDGET if the user or guest budget is used up and ENFORCE_BUDGETS is set
+        """
+        if user_id not in self.usage:
+            self.usage[user_id] = utils.create_usage_tracker(self.config, user_id, name)
+        if utils.is_admin(self.config, user_id):
+            return None
+        if not await is_premium(user_id):
+            quota = await self.get_user_quota(user_id)
+            if quota.used[kind] >= self.limits[kind]:
+                return LIMIT
+        if self.config['enforce_budgets'] and \
+                await utils.get_user_remaining_budget(self.config, self.usage, user_id, name) <= 0:
+            return BUDGET
+        return None
+
+    async def consume(self, user_id, kind, amount=1):
+        """
+        Counts a request of the given kind that was answered.
+        """
+        quota = await self.get_user_quota(user_id)
+        quota.used[kind] += amount
+        await update_stats(chat_id=user_id, **{kind: amount})
@@ -0,0 +1,91 @@
+"""
+Events of the answers OpenAIHelper streams to the Telegram handlers.
+
+A streamed answer is a sequence of Delta events followed by a Usage and a Done event,
+or a single DirectResult event if a plugin answered directly. Handlers collect the deltas
+in a MessageBuffer, so handling one delta does not depend on the length of the answer so far.
+"""
+from __future__ import annotations
+
+from typing import Union
+
+
+class Delta:
+    """
+    Text appended to the answer.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class DirectResult:
+    """
+    Result of a plugin, to be sent to the user as is instead of an answer.
+    """
+
+    def __init__(self, result: dict | str):
+        """
+        :param result: The plugin response, see utils.handle_direct_result
+        """
+        self.result = result
+
+
+class Usage:
+    """
+    Tokens used by the request, sent once the answer is complete.
+    """
+
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+
+
+class Done:
+    """
+    End of the answer.
+    """
+
+
+StreamEvent = Union[Delta, DirectResult, Usage, Done]
+
+
+class MessageBuffer:
+    """
+    Streamed answer split into messages of at most chunk_size characters (Telegram's message limit).
+    The text of the message being written is kept as a list of parts and only joined when it is sent.
+    """
+
+    def __init__(self, chunk_size=4096):
+        self.chunk_size = chunk_size
+        self.messages: list[str] = []  # complete messages
+        self.parts: list[str] = []  # parts of the message being written
+        self.length = 0
+
+    def append(self, text: str) -> list[str]:
+        """
+        Appends text to the answer.
+        :return: The messages completed by the text, usually none
+        """
+        completed = []
+        while self.length + len(text) > self.chunk_size:
+            split = self.chunk_size - self.length
+            self.parts.append(text[:split])
+            completed.append(''.join(self.parts))
+            self.parts, self.length = [], 0
+            text = text[split:]
+        if text:
+            self.parts.append(text)
+            self.length += len(text)
+        self.messages += completed
+        return completed
+
+    def text(self) -> str:
+        """
+        :return: The text of the message being written
+        """
+        if len(self.parts) > 1:
+            self.parts = [''.join(self.parts)]
+        return self.parts[0] if self.parts else ''
+
+    def __len__(self) -> int:
+        return self.length
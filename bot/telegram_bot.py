@@ -1,10 +1,13 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import io
 import logging
+import multiprocessing
 import os
-from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
 from uuid import uuid4
 
 from PIL import Image
@@ -18,15 +21,18 @@ from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, \
     filters, InlineQueryHandler, CallbackQueryHandler, Application, ContextTypes, CallbackContext, \
     PreCheckoutQueryHandler
 
-from entities import create_chat_user_or_get, update_stats, is_user_within_messages_limit, \
-    is_user_within_images_limit, create_subscription, is_premium, get_stats_internal, get_stats
+from entities import create_chat_user_or_get, create_subscription, refund_transaction, is_premium, \
+    dispose_database, start_write_behind, rollup_daily_stats, get_premium_user_ids
 from utils import is_admin
 from openai_helper import OpenAIHelper, localized_text
-from usage_tracker import UsageTracker
+from usage_tracker import UsageTracker, UsageCache, USAGE_LOGS_DIR
+from usage_store import UsageStore, build_usage_store
+from quota_engine import QuotaEngine, MESSAGES, IMAGES, LIMIT, BUDGET
+from stream_events import Delta, DirectResult, Done, Usage, MessageBuffer
 from utils import is_group_chat, get_thread_id, message_text, wrap_with_indicator, split_into_chunks, \
-    edit_message_with_retry, get_stream_cutoff_values, is_allowed, get_remaining_budget, is_within_budget, \
+    edit_message_with_retry, get_stream_cutoff_values, is_allowed, \
     get_reply_to_message_id, add_chat_request_to_usage_tracker, error_handler, is_direct_result, handle_direct_result, \
-    cleanup_intermediate_files, get_admins
+    cleanup_intermediate_files, get_admins, create_usage_tracker, is_guest, get_guest_usage_tracker
 
 
 class ChatGPTTelegramBot:
@@ -63,7 +69,10 @@ class ChatGPTTelegramBot:
         )] + self.commands
         self.disallowed_message = localized_text('disallowed', bot_language)
         self.budget_limit_message = localized_text('budget_limit', bot_language)
-        self.usage = {}
+        self.usage = UsageCache(loader=self.load_usage_tracker, max_size=config['usage_cache_size'],
+                                ttl=config['usage_cache_ttl'])
+        self.usage_store = UsageStore(config['usage_store_dir'])
+        self.quota = QuotaEngine(config, self.usage, max_size=config['usage_cache_size'])
         self.last_message = {}
         self.inline_queries_cache = {}
 
@@ -86,14 +95,14 @@ class ChatGPTTelegramBot:
 
     async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.message.chat_id
-        is_paid = is_premium(chat_id)
-        daily_stats = get_stats(update.message.from_user.id)
+        quota = await self.quota.get_user_quota(update.message.from_user.id)
+        is_paid = await is_premium(update.message.from_user.id)
         max_msg = self.config['max_free_messages_daily'] if not is_paid else 'Unlimited'
         max_img = self.config['max_free_images_daily'] if not is_paid else 'Unlimited'
         text = f"""
 *Daily stats:*
-- Messages left: {daily_stats.messages}/{max_msg}
-- Images left: {daily_stats.images}/{max_img}
+- Messages left: {quota.used[MESSAGES]}/{max_msg}
+- Images left: {quota.used[IMAGES]}/{max_img}
 """
         await context.bot.send_message(chat_id, text, parse_mode=constants.ParseMode.MARKDOWN)
 
@@ -109,7 +118,7 @@ class ChatGPTTelegramBot:
 
         if not await self.check_channel_subscription(update, context):
             return
-        if not await self.check_messages_limits(update, context):
+        if not await self.check_quota(update, context, MESSAGES):
             return
 
         chat_id = update.effective_chat.id
@@ -145,7 +154,7 @@ class ChatGPTTelegramBot:
 
         chat_id = update.effective_chat.id
         reset_content = message_text(update.message)
-        self.openai.reset_chat_history(chat_id=chat_id, content=reset_content)
+        await self.openai.reset_chat_history(chat_id=chat_id, content=reset_content)
         await update.effective_message.reply_text(
             message_thread_id=get_thread_id(update),
             text=localized_text('reset_done', self.config['bot_language'])
@@ -153,7 +162,7 @@ class ChatGPTTelegramBot:
 
     async def invoice(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.message.chat_id
-        if is_premium(chat_id):
+        if await is_premium(update.message.from_user.id):
             await context.bot.send_message(chat_id=chat_id,
                                            text="You are already a premium user 🥰",
                                            parse_mode=constants.ParseMode.MARKDOWN)
@@ -175,14 +184,14 @@ class ChatGPTTelegramBot:
         else:
             await pre_checkout_query.answer(ok=False, error_message="Something went wrong 😟 Please contact me: @PatchMapping")
 
-        if is_premium(pre_checkout_query.from_user.id):
+        if await is_premium(pre_checkout_query.from_user.id):
             await pre_checkout_query.answer(ok=False, error_message="You are already a premium user 🥰")
 
 
     async def successful_payment_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         payment = update.message.successful_payment
         chat_id = update.message.chat_id
-        subscription = create_subscription(chat_id, payment.total_amount, payment.telegram_payment_charge_id)
+        subscription = await create_subscription(chat_id, payment.total_amount, payment.telegram_payment_charge_id)
         text = f"""
 Thank you! ❤️
 
@@ -203,11 +212,88 @@ After the end date, you will be asked to renew the subscription.
             telegram_payment_charge_id=telegram_charge_id
         )
         if status:
+            await refund_transaction(int(context.args[0]), telegram_charge_id)
             await context.bot.send_message(
                 chat_id=update.message.chat.id,
                 text=f'Payment {telegram_charge_id} has been refunded successfully.'
             )
 
+    def load_usage_tracker(self, user_id) -> UsageTracker:
+        """
+        Loads the usage tracker of a user evicted from the usage cache.
+        """
+        return create_usage_tracker(self.config, user_id, None)
+
+    async def usage_cache_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Sends the hit, miss and eviction counters of the usage tracker cache to an admin.
+        """
+        if not is_admin(self.config, update.message.chat_id):
+            return
+        stats = self.usage.stats()
+        await update.effective_message.reply_text(
+            message_thread_id=get_thread_id(update),
+            text=f'Usage trackers cached: {stats["size"]}/{stats["max_size"]}\n'
+                 f'Hits: {stats["hits"]}, misses: {stats["misses"]}, evictions: {stats["evictions"]}'
+        )
+
+    async def conversation_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Sends the number of conversations in memory and spilled to disk to an admin.
+        """
+        if not is_admin(self.config, update.message.chat_id):
+            return
+        stats = await self.openai.conversations.stats()
+        if stats is None:
+            text = 'The conversation store keeps no counters.'
+        else:
+            text = f'Conversations in memory: {stats["resident"]}/{stats["max_chats"]}, ' \
+                   f'{stats["resident_bytes"]}/{stats["max_bytes"]} bytes\n' \
+                   f'Spilled to disk: {stats["spilled"]}\n' \
+                   f'Expired: {stats["expired_total"]}, spilled: {stats["spilled_total"]}, ' \
+                   f'reloaded: {stats["reloaded_total"]}'
+        await update.effective_message.reply_text(message_thread_id=get_thread_id(update), text=text)
+
+    async def usage_report(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Sends totals, top spenders, the daily cost curve and the free vs premium split of all users to an admin.
+        `/usage_report rebuild` rebuilds the usage store first, `/usage_report 20` lists 20 top spenders.
+        """
+        if not is_admin(self.config, update.message.chat_id):
+            return
+        if self.config['usage_storage'] == 'sql':
+            await update.effective_message.reply_text(
+                message_thread_id=get_thread_id(update),
+                text='The usage report is built from the usage logs, which are not written with USAGE_STORAGE=sql')
+            return
+        if 'rebuild' in context.args:
+            await self.rebuild_usage_store(context)
+        top = next((int(arg) for arg in context.args if arg.isdigit()), 10)
+        if self.usage_store.load():
+            text = self.usage_store.report(top=top)
+        else:
+            text = 'The usage store has not been built yet, try /usage_report rebuild'
+        for chunk in split_into_chunks(text):
+            await update.effective_message.reply_text(message_thread_id=get_thread_id(update), text=chunk)
+
+    async def rebuild_usage_store(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Maintenance job that rebuilds the columnar usage store from the usage logs.
+        """
+        if self.config['usage_storage'] == 'sql':
+            return
+        try:
+            premium_user_ids = await get_premium_user_ids()
+            # parsing all usage logs is CPU bound, a separate process keeps it from holding up the event loop.
+            # The process is spawned, a fork of the running bot would copy its event loop, threads and locks
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                users = await asyncio.get_running_loop().run_in_executor(
+                    executor, functools.partial(build_usage_store, USAGE_LOGS_DIR, self.config['usage_store_dir'],
+                                                self.config, premium_user_ids, days=self.config['usage_store_days']))
+            logging.info(f'Built the usage store of {users} users')
+        except Exception as e:
+            logging.exception(e)
+
     async def broadcast_to_admins(self, context: ContextTypes.DEFAULT_TYPE, text):
         for admin_id in get_admins(self.config):
             try:
@@ -217,9 +303,11 @@ After the end date, you will be asked to renew the subscription.
 
     async def is_user_subscribed(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.message.from_user.id
+        if user_id not in self.usage:
+            # first tracker access of a request, a tracker loaded by the usage cache has no user name
+            self.usage[user_id] = create_usage_tracker(self.config, user_id, update.message.from_user.name)
         today = date.today()
-        last_update = date.fromisoformat(self.usage[user_id].usage['current_cost']['last_update'])
-        created = date.fromisoformat(self.usage[user_id].usage['current_cost']['created'])
+        created, last_update = await self.usage[user_id].get_first_and_last_day()
         if created == today or last_update != today:
             try:
                 member = await context.bot.get_chat_member(chat_id=-1002407348424, user_id=user_id)
@@ -233,7 +321,7 @@ After the end date, you will be asked to renew the subscription.
 
     async def check_channel_subscription(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         is_sub = await self.is_user_subscribed(update, context)
-        if is_premium(update.message.from_user.id):
+        if await is_premium(update.message.from_user.id):
             return True
         if not is_sub:
             logging.info('User tried to chat without subscription')
@@ -261,38 +349,37 @@ It will reset tomorrow!
 📅 No need to cancel subscription. Pay manually once a month!
 """
 
-    async def check_messages_limits(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-
-        is_within_limit = is_user_within_messages_limit(update.message.from_user.id, self.config)
-        if not is_within_limit:
+    async def check_quota(self, update: Update, context: ContextTypes.DEFAULT_TYPE, kind) -> bool:
+        """
+        Checks the daily free limit and the budget of the message sender for a request of the given kind,
+        and tells them when it is used up.
+        :param kind: MESSAGES or IMAGES
+        :return: Boolean indicating if the request may be made
+        """
+        user = update.message.from_user
+        reason = await self.quota.check(user.id, kind, user.name)
+        if reason == LIMIT:
             await context.bot.send_message(chat_id=update.message.chat_id,
                                            text=self.text_limit)
             await self.invoice(update, context)
-        return is_within_limit
-
-    async def check_images_limits(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        is_within_limit = is_user_within_images_limit(update.message.from_user.id, self.config)
-        if not is_within_limit:
-            await context.bot.send_message(chat_id=update.message.chat_id,
-                                           text=self.text_limit,
-                                           parse_mode=constants.ParseMode.MARKDOWN)
-            await self.invoice(update, context)
-        return is_within_limit
-
+        elif reason == BUDGET:
+            logging.warning(f'User {user.name} (id: {user.id}) reached their usage limit')
+            await self.send_budget_reached_message(update, context)
+        return reason is None
 
     async def image(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Generates an image for the given prompt using DALL·E APIs
         """
         if not self.config['enable_image_generation'] \
-                or not await self.check_allowed_and_within_budget(update, context):
+                or not await self.check_allowed(update, context):
             pass
 
-        create_chat_user_or_get(update)
+        await create_chat_user_or_get(update)
 
         if not await self.check_channel_subscription(update, context):
             return
-        if not await self.check_images_limits(update, context):
+        if not await self.check_quota(update, context, IMAGES):
             return
 
         image_query = message_text(update.message)
@@ -323,11 +410,11 @@ It will reset tomorrow!
                     raise Exception(f"env variable IMAGE_RECEIVE_MODE has invalid value {self.config['image_receive_mode']}")
                 # add image request to users usage tracker
                 user_id = update.message.from_user.id
-                self.usage[user_id].add_image_request(image_size, self.config['image_prices'])
-                update_stats(chat_id=user_id, images=1)
+                await self.usage[user_id].add_image_request(image_size, self.config['image_prices'])
+                await self.quota.consume(user_id, IMAGES)
                 # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
-                    self.usage["guests"].add_image_request(image_size, self.config['image_prices'])
+                if is_guest(self.config, user_id):
+                    await get_guest_usage_tracker(self.config, self.usage, user_id).add_image_request(image_size, self.config['image_prices'])
 
             except Exception as e:
                 logging.exception(e)
@@ -345,15 +432,15 @@ It will reset tomorrow!
         Generates an speech for the given input using TTS APIs
         """
         if not self.config['enable_tts_generation'] \
-                or not await self.check_allowed_and_within_budget(update, context):
+                or not await self.check_allowed(update, context):
             pass
 
-        create_chat_user_or_get(update)
+        await create_chat_user_or_get(update)
 
         if not await self.check_channel_subscription(update, context):
             return
 
-        if not await self.check_messages_limits(update, context):
+        if not await self.check_quota(update, context, MESSAGES):
             return
 
         tts_query = message_text(update.message)
@@ -378,11 +465,11 @@ It will reset tomorrow!
                 speech_file.close()
                 # add image request to users usage tracker
                 user_id = update.message.from_user.id
-                self.usage[user_id].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
-                update_stats(chat_id=user_id, messages=1)
+                await self.usage[user_id].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
+                await self.quota.consume(user_id, MESSAGES)
                 # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
-                    self.usage["guests"].add_tts_request(text_length, self.config['tts_model'],
+                if is_guest(self.config, user_id):
+                    await get_guest_usage_tracker(self.config, self.usage, user_id).add_tts_request(text_length, self.config['tts_model'],
                                                          self.config['tts_prices'])
 
             except Exception as e:
@@ -400,10 +487,10 @@ It will reset tomorrow!
         """
         Transcribe audio messages.
         """
-        if not self.config['enable_transcription'] or not await self.check_allowed_and_within_budget(update, context):
+        if not self.config['enable_transcription'] or not await self.check_allowed(update, context):
             pass
 
-        create_chat_user_or_get(update)
+        await create_chat_user_or_get(update)
 
         if is_group_chat(update) and self.config['ignore_group_transcriptions']:
             logging.info('Transcription coming from group chat, ignoring...')
@@ -412,7 +499,7 @@ It will reset tomorrow!
         if not await self.check_channel_subscription(update, context):
             return
 
-        if not await self.check_messages_limits(update, context):
+        if not await self.check_quota(update, context, MESSAGES):
             return
 
         chat_id = update.effective_chat.id
@@ -456,23 +543,22 @@ It will reset tomorrow!
 
             user_id = update.message.from_user.id
             if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+                self.usage[user_id] = create_usage_tracker(self.config, user_id, update.message.from_user.name)
 
             try:
                 transcript = await self.openai.transcribe(filename_mp3)
 
                 transcription_price = self.config['transcription_price']
-                self.usage[user_id].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
+                await self.usage[user_id].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
 
-                allowed_user_ids = self.config['allowed_user_ids'].split(',')
-                if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
-                    self.usage["guests"].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
+                if is_guest(self.config, user_id):
+                    await get_guest_usage_tracker(self.config, self.usage, user_id).add_transcription_seconds(audio_track.duration_seconds, transcription_price)
 
                 # check if transcript starts with any of the prefixes
                 response_to_transcription = any(transcript.lower().startswith(prefix.lower()) if prefix else False
                                                 for prefix in self.config['voice_reply_prompts'])
 
-                update_stats(chat_id=user_id, messages=1)
+                await self.quota.consume(user_id, MESSAGES)
 
                 if self.config['voice_reply_transcript'] and not response_to_transcription:
 
@@ -491,9 +577,9 @@ It will reset tomorrow!
                     # Get the response of the transcript
                     response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=transcript)
 
-                    self.usage[user_id].add_chat_tokens(total_tokens, self.config['token_price'])
-                    if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
-                        self.usage["guests"].add_chat_tokens(total_tokens, self.config['token_price'])
+                    await self.usage[user_id].add_chat_tokens(total_tokens, self.config['token_price'])
+                    if is_guest(self.config, user_id):
+                        await get_guest_usage_tracker(self.config, self.usage, user_id).add_chat_tokens(total_tokens, self.config['token_price'])
 
                     # Split into chunks of 4096 characters (Telegram's message limit)
                     transcript_output = (
@@ -530,15 +616,15 @@ It will reset tomorrow!
         """
         Interpret image using vision model.
         """
-        if not self.config['enable_vision'] or not await self.check_allowed_and_within_budget(update, context):
+        if not self.config['enable_vision'] or not await self.check_allowed(update, context):
             pass
 
-        create_chat_user_or_get(update)
+        await create_chat_user_or_get(update)
 
         if not await self.check_channel_subscription(update, context):
             return
 
-        if not await self.check_images_limits(update, context):
+        if not await self.check_quota(update, context, IMAGES):
             return
 
         chat_id = update.effective_chat.id
@@ -596,88 +682,14 @@ It will reset tomorrow!
 
             user_id = update.message.from_user.id
             if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+                self.usage[user_id] = create_usage_tracker(self.config, user_id, update.message.from_user.name)
 
             if self.config['stream']:
 
-                stream_response = self.openai.interpret_image_stream(chat_id=chat_id, fileobj=temp_file_png,
-                                                                     prompt=prompt)
-                i = 0
-                prev = ''
-                sent_message = None
-                backoff = 0
-                stream_chunk = 0
-
-                async for content, tokens in stream_response:
-                    if is_direct_result(content):
-                        return await handle_direct_result(self.config, update, content)
-
-                    if len(content.strip()) == 0:
-                        continue
-
-                    stream_chunks = split_into_chunks(content)
-                    if len(stream_chunks) > 1:
-                        content = stream_chunks[-1]
-                        if stream_chunk != len(stream_chunks) - 1:
-                            stream_chunk += 1
-                            try:
-                                await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                              stream_chunks[-2])
-                            except:
-                                pass
-                            try:
-                                sent_message = await update.effective_message.reply_text(
-                                    message_thread_id=get_thread_id(update),
-                                    text=content if len(content) > 0 else "..."
-                                )
-                            except:
-                                pass
-                            continue
-
-                    cutoff = get_stream_cutoff_values(update, content)
-                    cutoff += backoff
-
-                    if i == 0:
-                        try:
-                            if sent_message is not None:
-                                await context.bot.delete_message(chat_id=sent_message.chat_id,
-                                                                 message_id=sent_message.message_id)
-                            sent_message = await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config, update),
-                                text=content,
-                            )
-                        except:
-                            continue
-
-                    elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                        prev = content
-
-                        try:
-                            use_markdown = tokens != 'not_finished'
-                            await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                          text=content, markdown=use_markdown)
-
-                        except RetryAfter as e:
-                            backoff += 5
-                            await asyncio.sleep(e.retry_after)
-                            continue
-
-                        except TimedOut:
-                            backoff += 5
-                            await asyncio.sleep(0.5)
-                            continue
-
-                        except Exception:
-                            backoff += 5
-                            continue
-
-                        await asyncio.sleep(0.01)
-
-                    i += 1
-                    if tokens != 'not_finished':
-                        total_tokens = int(tokens)
-
+                events = self.openai.interpret_image_events(chat_id=chat_id, fileobj=temp_file_png, prompt=prompt)
+                total_tokens = await self.reply_with_stream(update, context, chat_id, events)
+                if total_tokens is None:
+                    return
 
             else:
 
@@ -716,12 +728,11 @@ It will reset tomorrow!
                         parse_mode=constants.ParseMode.MARKDOWN
                     )
             vision_token_price = self.config['vision_token_price']
-            self.usage[user_id].add_vision_tokens(total_tokens, vision_token_price)
-            update_stats(chat_id=user_id, images=1)
+            await self.usage[user_id].add_vision_tokens(total_tokens, vision_token_price)
+            await self.quota.consume(user_id, IMAGES)
 
-            allowed_user_ids = self.config['allowed_user_ids'].split(',')
-            if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
-                self.usage["guests"].add_vision_tokens(total_tokens, vision_token_price)
+            if is_guest(self.config, user_id):
+                await get_guest_usage_tracker(self.config, self.usage, user_id).add_vision_tokens(total_tokens, vision_token_price)
 
         await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
 
@@ -732,14 +743,14 @@ It will reset tomorrow!
         if update.edited_message or not update.message or update.message.via_bot:
             return
 
-        create_chat_user_or_get(update)
+        await create_chat_user_or_get(update)
 
-        if not await self.check_allowed_and_within_budget(update, context):
+        if not await self.check_allowed(update, context):
             pass
 
         if not await self.check_channel_subscription(update, context):
             return
-        if not await self.check_messages_limits(update, context):
+        if not await self.check_quota(update, context, MESSAGES):
             return
 
 
@@ -777,82 +788,10 @@ It will reset tomorrow!
                     message_thread_id=get_thread_id(update)
                 )
 
-                stream_response = self.openai.get_chat_response_stream(chat_id=chat_id, query=prompt)
-                i = 0
-                prev = ''
-                sent_message = None
-                backoff = 0
-                stream_chunk = 0
-
-                async for content, tokens in stream_response:
-                    if is_direct_result(content):
-                        return await handle_direct_result(self.config, update, content)
-
-                    if len(content.strip()) == 0:
-                        continue
-
-                    stream_chunks = split_into_chunks(content)
-                    if len(stream_chunks) > 1:
-                        content = stream_chunks[-1]
-                        if stream_chunk != len(stream_chunks) - 1:
-                            stream_chunk += 1
-                            try:
-                                await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                              stream_chunks[-2])
-                            except:
-                                pass
-                            try:
-                                sent_message = await update.effective_message.reply_text(
-                                    message_thread_id=get_thread_id(update),
-                                    text=content if len(content) > 0 else "..."
-                                )
-                            except:
-                                pass
-                            continue
-
-                    cutoff = get_stream_cutoff_values(update, content)
-                    cutoff += backoff
-
-                    if i == 0:
-                        try:
-                            if sent_message is not None:
-                                await context.bot.delete_message(chat_id=sent_message.chat_id,
-                                                                 message_id=sent_message.message_id)
-                            sent_message = await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config, update),
-                                text=content,
-                            )
-                        except:
-                            continue
-
-                    elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                        prev = content
-
-                        try:
-                            use_markdown = tokens != 'not_finished'
-                            await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                          text=content, markdown=use_markdown)
-
-                        except RetryAfter as e:
-                            backoff += 5
-                            await asyncio.sleep(e.retry_after)
-                            continue
-
-                        except TimedOut:
-                            backoff += 5
-                            await asyncio.sleep(0.5)
-                            continue
-
-                        except Exception:
-                            backoff += 5
-                            continue
-
-                        await asyncio.sleep(0.01)
-
-                    i += 1
-                    if tokens != 'not_finished':
-                        total_tokens = int(tokens)
+                events = self.openai.get_chat_response_events(chat_id=chat_id, query=prompt)
+                total_tokens = await self.reply_with_stream(update, context, chat_id, events)
+                if total_tokens is None:
+                    return
 
             else:
                 async def _reply():
@@ -887,8 +826,8 @@ It will reset tomorrow!
 
                 await wrap_with_indicator(update, context, _reply, constants.ChatAction.TYPING)
 
-            update_stats(chat_id=chat_id, messages=1)
-            add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
+            await self.quota.consume(user_id, MESSAGES)
+            await add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
 
         except Exception as e:
             logging.exception(e)
@@ -899,6 +838,88 @@ It will reset tomorrow!
                 parse_mode=constants.ParseMode.MARKDOWN
             )
 
+    async def reply_with_stream(self, update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id,
+                                events) -> int | None:
+        """
+        Sends an answer while OpenAIHelper streams it, editing the message as the answer grows
+        and going on in a new message every 4096 characters (Telegram's message limit).
+        :param update: Telegram update object
+        :param context: Telegram context object
+        :param chat_id: The chat ID
+        :param events: The stream events of the answer
+        :return: The number of tokens used, or None if a plugin result was sent instead of an answer
+        """
+        buffer = MessageBuffer()
+        sent_message = None
+        sent_length = 0
+        messages_sent = 0
+        backoff = 0
+        total_tokens = 0
+
+        async def send(text, markdown=False):
+            nonlocal sent_message, sent_length, messages_sent
+            if sent_message is None:
+                sent_message = await update.effective_message.reply_text(
+                    message_thread_id=get_thread_id(update),
+                    reply_to_message_id=get_reply_to_message_id(self.config, update) if messages_sent == 0 else None,
+                    text=text
+                )
+                messages_sent += 1
+            else:
+                await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
+                                              text=text, markdown=markdown)
+            sent_length = len(text)
+
+        async for event in events:
+            if isinstance(event, DirectResult):
+                await handle_direct_result(self.config, update, event.result)
+                return None
+
+            if isinstance(event, Usage):
+                total_tokens = event.tokens
+                continue
+
+            if isinstance(event, Delta):
+                for message in buffer.append(event.text):
+                    # the message is full, send it as it is and go on in a new one
+                    try:
+                        await send(message, markdown=True)
+                    except Exception:
+                        pass
+                    sent_message = None
+                cutoff = get_stream_cutoff_values(update, len(buffer)) + backoff
+                if len(buffer) == 0 or (sent_message is not None and len(buffer) - sent_length <= cutoff):
+                    continue
+
+            if isinstance(event, Done) and len(buffer) == 0:
+                continue
+
+            try:
+                await send(buffer.text(), markdown=isinstance(event, Done))
+
+            except RetryAfter as e:
+                backoff += 5
+                await asyncio.sleep(e.retry_after)
+                if isinstance(event, Done):
+                    try:
+                        await send(buffer.text(), markdown=True)
+                    except Exception:
+                        pass
+                continue
+
+            except TimedOut:
+                backoff += 5
+                await asyncio.sleep(0.5)
+                continue
+
+            except Exception:
+                backoff += 5
+                continue
+
+            await asyncio.sleep(0.01)
+
+        return total_tokens
+
     async def inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Handle the inline query. This is run when you type: @botusername <query>
@@ -906,7 +927,7 @@ It will reset tomorrow!
         query = update.inline_query.query
         if len(query) < 3:
             return
-        if not await self.check_allowed_and_within_budget(update, context, is_inline=True):
+        if not await self.check_allowed(update, context, is_inline=True):
             pass
 
         callback_data_suffix = "gpt:"
@@ -978,64 +999,58 @@ It will reset tomorrow!
 
                 unavailable_message = localized_text("function_unavailable_in_inline_mode", bot_language)
                 if self.config['stream']:
-                    stream_response = self.openai.get_chat_response_stream(chat_id=user_id, query=query)
-                    i = 0
-                    prev = ''
+                    buffer = MessageBuffer()
+                    sent_length = None
                     backoff = 0
-                    async for content, tokens in stream_response:
-                        if is_direct_result(content):
-                            cleanup_intermediate_files(content)
+                    async for event in self.openai.get_chat_response_events(chat_id=user_id, query=query):
+                        if isinstance(event, DirectResult):
+                            cleanup_intermediate_files(event.result)
                             await edit_message_with_retry(context, chat_id=None,
                                                           message_id=inline_message_id,
                                                           text=f'{query}\n\n_{answer_tr}:_\n{unavailable_message}',
                                                           is_inline=True)
                             return
 
-                        if len(content.strip()) == 0:
+                        if isinstance(event, Usage):
+                            total_tokens = event.tokens
                             continue
 
-                        cutoff = get_stream_cutoff_values(update, content)
-                        cutoff += backoff
-
-                        if i == 0:
-                            try:
-                                await edit_message_with_retry(context, chat_id=None,
-                                                              message_id=inline_message_id,
-                                                              text=f'{query}\n\n{answer_tr}:\n{content}',
-                                                              is_inline=True)
-                            except:
+                        if isinstance(event, Delta):
+                            # We only want to send the first 4096 characters. No chunking allowed in inline mode.
+                            if buffer.messages:
+                                continue
+                            buffer.append(event.text)
+                            length = buffer.chunk_size if buffer.messages else len(buffer)
+                            cutoff = get_stream_cutoff_values(update, length) + backoff
+                            if sent_length is not None and length - sent_length <= cutoff:
                                 continue
 
-                        elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                            prev = content
-                            try:
-                                use_markdown = tokens != 'not_finished'
-                                divider = '_' if use_markdown else ''
-                                text = f'{query}\n\n{divider}{answer_tr}:{divider}\n{content}'
-
-                                # We only want to send the first 4096 characters. No chunking allowed in inline mode.
-                                text = text[:4096]
-
-                                await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
-                                                              text=text, markdown=use_markdown, is_inline=True)
+                        if isinstance(event, Done) and len(buffer) == 0 and not buffer.messages:
+                            continue
+                        answer = buffer.messages[0] if buffer.messages else buffer.text()
+                        try:
+                            use_markdown = isinstance(event, Done)
+                            divider = '_' if use_markdown else ''
+                            text = f'{query}\n\n{divider}{answer_tr}:{divider}\n{answer}'
+                            text = text[:4096]
 
-                            except RetryAfter as e:
-                                backoff += 5
-                                await asyncio.sleep(e.retry_after)
-                                continue
-                            except TimedOut:
-                                backoff += 5
-                                await asyncio.sleep(0.5)
-                                continue
-                            except Exception:
-                                backoff += 5
-                                continue
+                            await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
+                                                          text=text, markdown=use_markdown, is_inline=True)
 
-                            await asyncio.sleep(0.01)
+                        except RetryAfter as e:
+                            backoff += 5
+                            await asyncio.sleep(e.retry_after)
+                            continue
+                        except TimedOut:
+                            backoff += 5
+                            await asyncio.sleep(0.5)
+                            continue
+                        except Exception:
+                            backoff += 5
+                            continue
 
-                        i += 1
-                        if tokens != 'not_finished':
-                            total_tokens = int(tokens)
+                        sent_length = len(answer)
+                        await asyncio.sleep(0.01)
 
                 else:
                     async def _send_inline_query_response():
@@ -1068,7 +1083,7 @@ It will reset tomorrow!
                     await wrap_with_indicator(update, context, _send_inline_query_response,
                                               constants.ChatAction.TYPING, is_inline=True)
 
-                add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
+                await add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
 
         except Exception as e:
             logging.error(f'Failed to respond to an inline query via button callback: {e}')
@@ -1078,26 +1093,20 @@ It will reset tomorrow!
                                           text=f"{query}\n\n_{answer_tr}:_\n{localized_answer} {str(e)}",
                                           is_inline=True)
 
-    async def check_allowed_and_within_budget(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
-                                              is_inline=False) -> bool:
+    async def check_allowed(self, update: Update, context: ContextTypes.DEFAULT_TYPE, is_inline=False) -> bool:
         """
-        Checks if the user is allowed to use the bot and if they are within their budget
+        Checks if the user is allowed to use the bot, budgets are checked by the quota engine
         :param update: Telegram update object
         :param context: Telegram context object
         :param is_inline: Boolean flag for inline queries
         :return: Boolean indicating if the user is allowed to use the bot
         """
-        name = update.message.from_user.name
-        user_id = update.message.from_user.id
+        user = update.inline_query.from_user if is_inline else update.message.from_user
 
         if not await is_allowed(self.config, update, context, is_inline=is_inline):
-            logging.warning(f'User {name} (id: {user_id}) is not allowed to use the bot')
+            logging.warning(f'User {user.name} (id: {user.id}) is not allowed to use the bot')
             # await self.send_disallowed_message(update, context, is_inline)
             return False
-        if not is_within_budget(self.config, self.usage, update, is_inline=is_inline):
-            logging.warning(f'User {name} (id: {user_id}) reached their usage limit')
-            # await self.send_budget_reached_message(update, context, is_inline)
-            return False
 
         return True
 
@@ -1128,12 +1137,55 @@ It will reset tomorrow!
             result_id = str(uuid4())
             await self.send_inline_query_result(update, result_id, message_content=self.budget_limit_message)
 
+    async def rollup_stats(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Maintenance job that rolls daily stats older than the retention period into monthly stats.
+        """
+        try:
+            rolled_up = await rollup_daily_stats(retention_days=self.config['stats_retention_days'],
+                                                 chunk_size=self.config['stats_rollup_chunk_size'])
+            logging.info(f'Rolled up {rolled_up} daily stats rows into monthly stats')
+        except Exception as e:
+            logging.exception(e)
+
+    async def compact_usage_logs(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Maintenance job that folds usage history days of past months into monthly totals.
+        """
+        if self.config['usage_storage'] == 'sql':
+            return
+        try:
+            compacted = await self.usage.compact_usage_logs()
+            logging.info(f'Compacted the usage history of {compacted} usage logs')
+        except Exception as e:
+            logging.exception(e)
+
+    async def sweep_conversations(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Maintenance job that drops expired conversations and spills idle ones to disk.
+        """
+        try:
+            expired = await self.openai.conversations.sweep()
+            if expired:
+                logging.info(f'Dropped {expired} expired conversations')
+        except Exception as e:
+            logging.exception(e)
+
     async def post_init(self, application: Application) -> None:
         """
         Post initialization hook for the bot.
         """
         await application.bot.set_my_commands(self.group_commands, scope=BotCommandScopeAllGroupChats())
         await application.bot.set_my_commands(self.commands)
+        await start_write_behind()
+
+    async def post_shutdown(self, application: Application) -> None:
+        """
+        Post shutdown hook for the bot, flushes usage trackers and buffered stats before the database is closed.
+        """
+        self.usage.flush_all()
+        await self.openai.conversations.close()
+        await dispose_database()
 
     def run(self):
         """
@@ -1144,6 +1196,7 @@ It will reset tomorrow!
             .proxy_url(self.config['proxy']) \
             .get_updates_proxy_url(self.config['proxy']) \
             .post_init(self.post_init) \
+            .post_shutdown(self.post_shutdown) \
             .concurrent_updates(True) \
             .build()
 
@@ -1173,7 +1226,28 @@ It will reset tomorrow!
         application.add_handler(PreCheckoutQueryHandler(self.pre_chekout_callback))
         application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, self.successful_payment_callback))
         application.add_handler(CommandHandler('refund', self.refund_payment))
+        application.add_handler(CommandHandler('usage_cache', self.usage_cache_stats))
+        application.add_handler(CommandHandler('usage_report', self.usage_report))
+        application.add_handler(CommandHandler('conversation_stats', self.conversation_stats))
 
         application.add_error_handler(error_handler)
 
+        if application.job_queue is not None:
+            application.job_queue.run_repeating(self.rollup_stats, interval=timedelta(days=1),
+                                                first=timedelta(minutes=5))
+            if self.config['usage_storage'] != 'sql':
+                application.job_queue.run_repeating(self.compact_usage_logs, interval=timedelta(days=1),
+                                                    first=timedelta(minutes=10))
+                application.job_queue.run_repeating(self.rebuild_usage_store, interval=timedelta(days=1),
+                                                    first=timedelta(minutes=15))
+            sweep_interval = timedelta(minutes=self.config['conversation_sweep_interval_minutes'])
+            application.job_queue.run_repeating(self.sweep_conversations, interval=sweep_interval,
+                                                first=sweep_interval)
+        else:
+            logging.warning('JobQueue is not available, daily stats will not be rolled up, usage logs '
+                            'will only be compacted when they are loaded, the usage store will only be '
+                            'built with /usage_report rebuild and expired conversations will only be '
+                            'reset when their chat writes again. '
+                            'Install python-telegram-bot[job-queue] to enable it.')
+
         application.run_polling()
@@ -0,0 +1,190 @@
+"""
+Token accounting of chat histories with tiktoken.
+
+Encodings are loaded once per encoding and token counts are cached per message text, so counting
+a history again after a message was appended only encodes the new message. tiktoken downloads its
+encoding files on first use and keeps them in TIKTOKEN_CACHE_DIR. Run this module once while online
+to fill the cache, so the bot starts and counts tokens offline:
+
+    python bot/token_counter.py
+
+If an encoding can be neither downloaded nor read from the cache, tokens are estimated
+from the length of the text instead.
+"""
+from __future__ import annotations
+
+import base64
+import io
+import logging
+import math
+import os
+from collections import OrderedDict
+
+import tiktoken
+from dotenv import load_dotenv
+from PIL import Image
+
+ENCODINGS = ['cl100k_base', 'o200k_base']
+
+# context window of the models by model name prefix, the longest matching prefix wins
+CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-4-turbo': 128000,
+    'gpt-4-1106': 128000,
+    'gpt-4-0125': 128000,
+    'gpt-4-vision': 128000,
+    'gpt-4o': 128000,
+    'o1': 200000,
+    'o1-mini': 128000,
+    'o1-preview': 128000,
+    'gpt-o1': 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+
+def context_window(model: str) -> int:
+    prefixes = [prefix for prefix in CONTEXT_WINDOWS if model.startswith(prefix)]
+    return CONTEXT_WINDOWS[max(prefixes, key=len)] if prefixes else DEFAULT_CONTEXT_WINDOW
+
+
+def history_token_budget(model: str, max_tokens: int, max_history_tokens=0) -> int:
+    """
+    Returns the number of tokens the history sent to a model may take.
+    :param model: The model the history is sent to
+    :param max_tokens: Tokens reserved for the answer of the model
+    :param max_history_tokens: Configured upper limit, 0 for none
+    """
+    window = context_window(model)
+    # a max_tokens close to the context window would leave no room for the history at all
+    budget = max(window - max_tokens, window // 4)
+    return min(budget, max_history_tokens) if max_history_tokens else budget
+
+
+def encoding_name(model: str) -> str:
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        return 'o200k_base' if model.startswith(('o1', 'gpt-o1', 'gpt-4o')) else 'cl100k_base'
+
+
+def image_tokens(image_url: dict) -> int:
+    """
+    Returns the tokens of an image sent to a vision model, from its detail level and size.
+    https://platform.openai.com/docs/guides/vision/calculating-costs
+    """
+    if image_url.get('detail') == 'low':
+        return 85
+    url = image_url['url']
+    if not url.startswith('data:'):
+        # size unknown without downloading the image, count it as 1024x1024
+        return 85 + 170 * 4
+    width, height = Image.open(io.BytesIO(base64.b64decode(url.split(',', 1)[1]))).size
+    # scaled to fit in 2048x2048, then its shortest side to 768
+    scale = min(1.0, 2048 / max(width, height))
+    scale *= min(1.0, 768 / (min(width, height) * scale))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return 85 + 170 * tiles
+
+
+class TokenCounter:
+    """
+    Counts the tokens of chat messages, with one encoder per encoding and an LRU of token counts
+    per text and per image.
+    """
+
+    def __init__(self, max_size=100000):
+        """
+        Encodings are loaded from the TIKTOKEN_CACHE_DIR set at startup, see main.py.
+        :param max_size: maximum number of cached token counts, defaults to 100000
+        """
+        self.max_size = max_size
+        # encoding name -> tiktoken encoding, or None if it could not be loaded
+        self.encodings = {}
+        # (encoding name, text) -> tokens, least recently used first
+        self.counts = OrderedDict()
+
+    def get_encoding(self, name: str) -> tiktoken.Encoding | None:
+        if name not in self.encodings:
+            try:
+                self.encodings[name] = tiktoken.get_encoding(name)
+            except Exception as e:
+                logging.warning(f'Could not load the {name} encoding, estimating tokens from text length instead: '
+                                f'{str(e)}')
+                self.encodings[name] = None
+        return self.encodings[name]
+
+    def cached(self, key: tuple, count) -> int:
+        tokens = self.counts.get(key)
+        if tokens is not None:
+            self.counts.move_to_end(key)
+            return tokens
+        tokens = self.counts[key] = count()
+        if len(self.counts) > self.max_size:
+            self.counts.popitem(last=False)
+        return tokens
+
+    def count_text(self, text: str, encoding: str) -> int:
+        def count():
+            encoder = self.get_encoding(encoding)
+            if encoder is None:
+                return math.ceil(len(text) / 4)
+            return len(encoder.encode(text, disallowed_special=()))
+
+        return self.cached((encoding, text), count)
+
+    def count_image(self, image_url: dict) -> int:
+        # keyed by the hash of the url, so that the cache does not keep whole images alive
+        return self.cached(('image', image_url.get('detail'), hash(image_url['url'])),
+                           lambda: image_tokens(image_url))
+
+    def count_message(self, message: dict, model: str) -> int:
+        encoding = encoding_name(model)
+        # every message is wrapped in <|start|>{role/name}\n{content}<|end|>\n
+        tokens = 3
+        for key, value in message.items():
+            if isinstance(value, list):
+                for part in value:
+                    if part['type'] == 'image_url':
+                        tokens += self.count_image(part['image_url'])
+                    else:
+                        tokens += self.count_text(part['text'], encoding)
+            else:
+                tokens += self.count_text(str(value), encoding)
+            if key == 'name':
+                tokens += 1
+        return tokens
+
+    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    def count_messages(self, messages: list[dict], model: str) -> int:
+        """
+        Counts the tokens of the messages sent to a model, including the priming of its reply.
+        """
+        return sum(self.count_message(message, model) for message in messages) + 3
+
+    def truncate(self, messages: list[dict], model: str, budget: int) -> list[dict]:
+        """
+        Drops the oldest messages after the system prompt until the messages fit in the token budget.
+        The system prompt and the last message are always kept.
+        """
+        counts = [self.count_message(message, model) for message in messages]
+        total = sum(counts) + 3
+        first = 1 if messages and messages[0]['role'] == 'system' else 0
+        drop = first
+        while total > budget and drop < len(messages) - 1:
+            total -= counts[drop]
+            drop += 1
+        return messages[:first] + messages[drop:]
+
+
+def main():
+    load_dotenv()
+    os.environ.setdefault('TIKTOKEN_CACHE_DIR', 'tiktoken_cache')
+    for name in ENCODINGS:
+        tiktoken.get_encoding(name)
+    print(f'cached the {", ".join(ENCODINGS)} encodings in {os.environ.get("TIKTOKEN_CACHE_DIR")}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Regression benchmark for the budget checks of UsageTracker.
+
+Writes a usage log with --years of synthetic daily history (chat tokens, images, vision
+tokens, TTS characters and transcription seconds) to a temporary directory, then times
+is_within_budget, get_remaining_budget and the get_current_* functions against it.
+Their latency should not grow with the length of the history.
+
+The cache scenario gives --users users --years of history each, sends one request per user
+through a UsageCache of --cache-size trackers, and reports the memory held by the trackers.
+
+Run from the repository root, e.g.:
+
+    python bot/usage_benchmark.py --years 1
+    python bot/usage_benchmark.py --years 5
+    python bot/usage_benchmark.py --scenario cache --users 5000 --cache-size 500
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from usage_tracker import UsageTracker, UsageCache
+from utils import is_within_budget, get_remaining_budget
+
+USER_ID = 1
+
+
+def synthetic_usage(years: int) -> dict:
+    today = datetime.date.today()
+    history = {'chat_tokens': {}, 'transcription_seconds': {}, 'number_images': {}, 'vision_tokens': {},
+               'tts_characters': {'tts-1': {}, 'tts-1-hd': {}}}
+    for days_ago in range(years * 365):
+        day = str(today - datetime.timedelta(days=days_ago))
+        history['chat_tokens'][day] = random.randint(100, 50000)
+        history['transcription_seconds'][day] = random.randint(0, 600)
+        history['number_images'][day] = [random.randint(0, 3) for _ in range(3)]
+        history['vision_tokens'][day] = random.randint(0, 5000)
+        history['tts_characters']['tts-1'][day] = random.randint(0, 2000)
+        history['tts_characters']['tts-1-hd'][day] = random.randint(0, 2000)
+    return {
+        'user_name': '@benchmark',
+        'current_cost': {'day': 0.0, 'month': 0.0, 'all_time': 0.0, 'last_update': str(today), 'created': str(today)},
+        'usage_history': history,
+    }
+
+
+def timed(calls: int, function) -> float:
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - start) / calls * 1000000
+
+
+async def timed_async(calls: int, function) -> float:
+    # the first call initializes the running counters of usage files written without them
+    await function()
+    start = time.perf_counter()
+    for _ in range(calls):
+        await function()
+    return (time.perf_counter() - start) / calls * 1000000
+
+
+async def run_cache(args):
+    with tempfile.TemporaryDirectory() as logs_dir:
+        usage_log = json.dumps(synthetic_usage(args.years))
+        for user_id in range(args.users):
+            with open(os.path.join(logs_dir, f'{user_id}.json'), 'w') as file:
+                file.write(usage_log)
+
+        def loader(user_id):
+            return UsageTracker(user_id, None, logs_dir=logs_dir, storage='journal')
+
+        for name, usage in (('dict', {}), ('cache', UsageCache(loader, max_size=args.cache_size))):
+            tracemalloc.start()
+            start = time.perf_counter()
+            for user_id in range(args.users):
+                if user_id not in usage:
+                    usage[user_id] = loader(user_id)
+                await usage[user_id].add_chat_tokens(100)
+            elapsed = time.perf_counter() - start
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            stats = f' {usage.stats()}' if isinstance(usage, UsageCache) else ''
+            print(f'{name:<6} users={args.users} memory={memory / 1024 / 1024:.1f}MB '
+                  f'elapsed={elapsed:.2f}s{stats}')
+            del usage
+
+
+async def run(args):
+    if args.scenario == 'cache':
+        await run_cache(args)
+        return
+    config = {'allowed_user_ids': str(USER_ID), 'admin_user_ids': '-', 'user_budgets': '10.0',
+              'budget_period': 'monthly', 'guest_budget': 100.0, 'token_price': 0.002,
+              'usage_storage': 'journal', 'usage_snapshot_interval': 500}
+    update = SimpleNamespace(message=SimpleNamespace(from_user=SimpleNamespace(id=USER_ID, name='@benchmark')))
+
+    with tempfile.TemporaryDirectory() as logs_dir:
+        with open(os.path.join(logs_dir, f'{USER_ID}.json'), 'w') as file:
+            json.dump(synthetic_usage(args.years), file)
+        load_us = timed(1, lambda: UsageTracker(USER_ID, '@benchmark', logs_dir=logs_dir))
+        # journal storage without snapshots, so that add_chat_tokens does not time the rewrite of the whole file
+        usage = {USER_ID: UsageTracker(USER_ID, '@benchmark', logs_dir=logs_dir, storage='journal',
+                                       snapshot_interval=float('inf'))}
+
+        print(f'history: {args.years} years, {args.years * 365} days, load {load_us / 1000:.1f}ms')
+        results = {
+            'is_within_budget': await timed_async(args.calls, lambda: is_within_budget(config, usage, update)),
+            'get_remaining_budget': await timed_async(args.calls, lambda: get_remaining_budget(config, usage, update)),
+        }
+        tracker = usage[USER_ID]
+        for name in ('get_current_cost', 'get_current_token_usage', 'get_current_image_count',
+                     'get_current_vision_tokens', 'get_current_tts_usage', 'get_current_transcription_duration'):
+            results[name] = await timed_async(args.calls, getattr(tracker, name))
+        results['add_chat_tokens'] = await timed_async(
+            args.calls, lambda: tracker.add_chat_tokens(100, config['token_price']))
+        for name, microseconds in results.items():
+            print(f'{name:<36} {microseconds:10.1f}us')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the UsageTracker budget checks')
+    parser.add_argument('--scenario', choices=['budget', 'cache'], default='budget')
+    parser.add_argument('--years', type=int, default=3, help='years of synthetic daily history')
+    parser.add_argument('--users', type=int, default=2000, help='users of the cache scenario')
+    parser.add_argument('--cache-size', type=int, default=200, help='trackers kept by the cache scenario')
+    parser.add_argument('--calls', type=int, default=200, help='calls timed per function')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+Columnar store of the usage of all users, for reports across users without parsing every usage log.
+
+build_usage_store parses the usage_logs/*.json files once into <store_dir>/usage.npy, a float64 array
+of shape (users, days + 1, metrics). Column 0 of the day axis holds all usage older than the last
+`days` days, the other columns one day each, the last one being today. <store_dir>/users.json holds
+the user ids, names and premium flags of the rows. The guest usage shards have rows as well, flagged
+as guests: they count for the totals and the daily costs, but not as users. UsageStore memory-maps the array, so totals,
+top spenders, daily cost curves and the free vs premium split are vectorized sums over it.
+
+Costs are recalculated from the configured prices, the same way UsageTracker.initialize_all_time_cost
+does. Compacted usage histories keep the days of the store, their monthly totals count as older usage.
+
+Run from the repository root, e.g.:
+
+    python bot/usage_store.py build --days 90
+    python bot/usage_store.py report --top 10 --curve-days 14
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime
+import glob
+import json
+import logging
+import os
+import pathlib
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+from entities import init_database, dispose_database, get_premium_user_ids
+from import_usage_logs import load_prices
+from usage_tracker import UsageTracker, USAGE_LOGS_DIR
+from utils import is_guest_usage_shard
+
+METRICS = ['chat_tokens', 'images_256x256', 'images_512x512', 'images_1024x1024', 'vision_tokens',
+           'transcription_seconds', 'tts_characters_tts-1', 'tts_characters_tts-1-hd', 'cost']
+COST = METRICS.index('cost')
+
+
+def unit_prices(prices) -> np.ndarray:
+    """
+    Returns the price of one unit of every metric but cost, e.g. of one chat token.
+    :param prices: The bot configuration object, or any dict with its price settings
+    """
+    return np.array([prices['token_price'] / 1000, *prices['image_prices'][:3],
+                     prices['vision_token_price'] / 1000, prices['transcription_price'] / 60,
+                     *[price / 1000 for price in prices['tts_prices'][:2]]])
+
+
+def usage_rows(usage_history: dict, first_day: datetime.date, days: int) -> np.ndarray:
+    """
+    Converts the usage history of one user into its (days + 1, metrics - 1) block of the store.
+    """
+    rows = np.zeros((days + 1, COST))
+
+    def add(day, metric, amount):
+        if len(day) == len('2023-03'):
+            # monthly total of a compacted usage history, which kept its days within the store
+            rows[0, metric] += amount
+            return
+        column = (datetime.date.fromisoformat(day) - first_day).days + 1
+        rows[min(max(column, 0), days), metric] += amount
+
+    for day, tokens in usage_history.get('chat_tokens', {}).items():
+        add(day, 0, tokens)
+    for day, images in usage_history.get('number_images', {}).items():
+        for size, count in enumerate(images[:3]):
+            add(day, 1 + size, count)
+    for day, tokens in usage_history.get('vision_tokens', {}).items():
+        add(day, 4, tokens)
+    for day, seconds in usage_history.get('transcription_seconds', {}).items():
+        add(day, 5, seconds)
+    for model_index, tts_model in enumerate(['tts-1', 'tts-1-hd']):
+        for day, characters in usage_history.get('tts_characters', {}).get(tts_model, {}).items():
+            add(day, 6 + model_index, characters)
+    return rows
+
+
+def write_atomically(path: str, write):
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as file:
+        write(file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def build_usage_store(logs_dir: str, store_dir: str, prices, premium_user_ids: set[int], days=90,
+                      today: datetime.date | None = None) -> int:
+    """
+    Parses all usage logs into the columnar usage store, replacing the previous one.
+    :param logs_dir: path to directory of usage logs
+    :param store_dir: path to directory of the usage store
+    :param prices: The bot configuration object, or any dict with its price settings
+    :param premium_user_ids: chat ids of the users with an active subscription
+    :param days: days with a column of their own, older usage is summed up in the first column
+    :param today: last day of the store, defaults to today
+    :return: number of users in the store, not counting the guest usage shards
+    """
+    today = today or datetime.date.today()
+    first_day = today - datetime.timedelta(days=days - 1)
+    user_ids, user_names, blocks = [], [], []
+    for path in sorted(glob.glob(os.path.join(logs_dir, '*.json'))):
+        user_id = os.path.basename(path)[:-len('.json')]
+        try:
+            # loading through UsageTracker replays the journal of USAGE_STORAGE=journal as well
+            usage = UsageTracker(user_id, None, logs_dir=logs_dir, history_days=days).usage
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f'Skipping unreadable usage log {path}: {str(e)}')
+            continue
+        user_ids.append(user_id)
+        user_names.append(usage.get('user_name'))
+        blocks.append(usage_rows(usage['usage_history'], first_day, days))
+
+    data = np.zeros((len(blocks), days + 1, len(METRICS)))
+    if blocks:
+        data[:, :, :COST] = np.stack(blocks)
+    data[:, :, COST] = data[:, :, :COST] @ unit_prices(prices)
+
+    pathlib.Path(store_dir).mkdir(exist_ok=True)
+    # the array goes first, UsageStore.load refuses a users.json that does not match it
+    write_atomically(os.path.join(store_dir, 'usage.npy'), lambda file: np.save(file, data))
+    users = {
+        'built': datetime.datetime.now().isoformat(timespec='seconds'),
+        'first_day': str(first_day),
+        'days': days,
+        'metrics': METRICS,
+        'user_ids': user_ids,
+        'user_names': user_names,
+        'premium': [user_id.isdigit() and int(user_id) in premium_user_ids for user_id in user_ids],
+        'guest': [is_guest_usage_shard(user_id) for user_id in user_ids],
+    }
+    write_atomically(os.path.join(store_dir, 'users.json'), lambda file: file.write(json.dumps(users).encode()))
+    return users['guest'].count(False)
+
+
+class UsageStore:
+    """
+    Read-only view of the columnar usage store written by build_usage_store.
+    """
+
+    def __init__(self, store_dir='usage_store'):
+        """
+        :param store_dir: path to directory of the usage store, defaults to "usage_store"
+        """
+        self.store_dir = store_dir
+        self.data = None
+        self.users = None
+        self.premium = None
+        self.guest = None
+
+    def load(self) -> bool:
+        """
+        Memory-maps the latest usage store.
+        :return: False if the store has not been built yet or is being rebuilt
+        """
+        try:
+            with open(os.path.join(self.store_dir, 'users.json'), 'r') as file:
+                users = json.load(file)
+            data = np.load(os.path.join(self.store_dir, 'usage.npy'), mmap_mode='r')
+        except FileNotFoundError:
+            return False
+        if data.shape[0] != len(users['user_ids']) or data.shape[1] != users['days'] + 1:
+            return False
+        self.data, self.users = data, users
+        self.premium = np.array(users['premium'], dtype=bool)
+        # stores built before guest shards were flagged
+        self.guest = np.array(users.get('guest', [False] * len(users['user_ids'])), dtype=bool)
+        return True
+
+    def user_costs(self) -> np.ndarray:
+        return self.data[:, :, COST].sum(axis=1)
+
+    def totals(self) -> dict[str, float]:
+        """
+        :return: total of every metric over all users and days
+        """
+        return dict(zip(METRICS, self.data.sum(axis=(0, 1)).tolist()))
+
+    def top_spenders(self, n=10) -> list[tuple[str, str | None, float]]:
+        """
+        :return: user id, user name and cost of the n users with the highest cost
+        """
+        # guest shards never rank
+        costs = np.where(self.guest, -np.inf, self.user_costs())
+        n = min(n, int((~self.guest).sum()))
+        top = np.argpartition(costs, len(costs) - n)[len(costs) - n:] if n else []
+        top = sorted(top, key=lambda row: costs[row], reverse=True)
+        return [(self.users['user_ids'][row], self.users['user_names'][row], float(costs[row])) for row in top]
+
+    def daily_costs(self, days=30) -> list[tuple[datetime.date, float]]:
+        """
+        :return: day and total cost of all users for each of the last days of the store
+        """
+        days = min(days, self.users['days'])
+        last_day = datetime.date.fromisoformat(self.users['first_day']) + \
+            datetime.timedelta(days=self.users['days'] - 1)
+        costs = self.data[:, self.data.shape[1] - days:, COST].sum(axis=0)
+        return [(last_day - datetime.timedelta(days=days - 1 - index), float(cost)) for index, cost in enumerate(costs)]
+
+    def premium_split(self) -> dict[str, float]:
+        """
+        :return: number of users and their total cost, for free and premium users, and the cost of guests
+        """
+        costs = self.user_costs()
+        free = ~self.premium & ~self.guest
+        return {'free_users': int(free.sum()), 'free_cost': float(costs[free].sum()),
+                'premium_users': int(self.premium.sum()), 'premium_cost': float(costs[self.premium].sum()),
+                'guest_cost': float(costs[self.guest].sum())}
+
+    def report(self, top=10, curve_days=7) -> str:
+        """
+        Formats totals, top spenders, the daily cost curve and the free vs premium split as text.
+        """
+        totals = self.totals()
+        split = self.premium_split()
+        lines = [f'Usage of {int((~self.guest).sum())} users, built {self.users["built"]}',
+                 f'Total cost: ${totals["cost"]:.2f}']
+        lines += [f'{metric}: {int(amount)}' for metric, amount in totals.items() if metric != 'cost']
+        lines += ['', f'Top {top} spenders:']
+        lines += [f'{user_name or user_id} ({user_id}): ${cost:.2f}'
+                  for user_id, user_name, cost in self.top_spenders(top)]
+        lines += ['', f'Daily cost, last {curve_days} days:']
+        lines += [f'{day}: ${cost:.2f}' for day, cost in self.daily_costs(curve_days)]
+        lines += ['', f'Free: {split["free_users"]} users, ${split["free_cost"]:.2f}',
+                  f'Premium: {split["premium_users"]} users, ${split["premium_cost"]:.2f}',
+                  f'Guests: ${split["guest_cost"]:.2f}']
+        return '\n'.join(lines)
+
+
+async def build(args):
+    init_database(config={'database_url': os.environ.get('DATABASE_URL', 'sqlite:///data.db')})
+    premium_user_ids = await get_premium_user_ids()
+    await dispose_database()
+    start = time.perf_counter()
+    users = build_usage_store(args.logs_dir, args.store_dir, load_prices(), premium_user_ids, days=args.days)
+    print(f'built the usage store of {users} users in {time.perf_counter() - start:.2f}s')
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Build or report on the columnar usage store')
+    parser.add_argument('command', choices=['build', 'report'])
+    parser.add_argument('--logs-dir', default=USAGE_LOGS_DIR)
+    parser.add_argument('--store-dir', default=os.environ.get('USAGE_STORE_DIR', 'usage_store'))
+    parser.add_argument('--days', type=int, default=int(os.environ.get('USAGE_STORE_DAYS', 90)),
+                        help='days with a column of their own')
+    parser.add_argument('--top', type=int, default=10, help='top spenders reported')
+    parser.add_argument('--curve-days', type=int, default=7, help='days of the daily cost curve')
+    args = parser.parse_args()
+    if args.command == 'build':
+        asyncio.run(build(args))
+        return
+    store = UsageStore(args.store_dir)
+    if not store.load():
+        parser.error(f'no usage store in {args.store_dir}, run the build command first')
+    start = time.perf_counter()
+    report = store.report(top=args.top, curve_days=args.curve_days)
+    print(report)
+    print(f'\nreport computed in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
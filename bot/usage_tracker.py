@@ -1,7 +1,23 @@
+import asyncio
 import os.path
 import pathlib
 import json
-from datetime import date
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import date, timedelta
+
+import entities
+
+# writes usage files and snapshots, and removes compacted journals, off the request path
+write_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='usage-writer')
+
+# directory of the usage logs of the "json" and "journal" storages
+USAGE_LOGS_DIR = "usage_logs"
+
+# seconds between two scans of UsageCache for idle trackers and finished writes
+EXPIRY_CHECK_INTERVAL = 60
 
 
 def year_month(date_str):
@@ -22,6 +38,11 @@ class UsageTracker:
             "month": 3.23,
             "all_time": 3.23,
             "last_update": "2023-03-14"},
+        "current_usage": {
+            "chat_tokens": {"day": 1532, "month": 2052, "all_time": 2052, "last_update": "2023-03-14"},
+            "transcription_seconds": {"day": 64, "month": 189, "all_time": 189, "last_update": "2023-03-14"},
+            "number_images": {"day": 3, "month": 14, "all_time": 14, "last_update": "2023-03-14"}
+        },
         "usage_history": {
             "chat_tokens": {
                 "2023-03-13": 520,
@@ -36,22 +57,62 @@ class UsageTracker:
                 "2023-03-13": [1, 2, 3],
                 "2023-03-14": [0, 1, 2]
             }
-        }
+        },
+        "journal_seq": 1532
     }
+
+    With the "json" storage the usage file is rewritten, atomically and by a background thread,
+    at most once every write_debounce_ms per user.
+
+    current_cost and current_usage are running counters updated with every request,
+    so budget checks never have to go through usage_history.
+
+    With the "journal" storage, every request is appended as one line to /usage_logs/<user_id>.journal,
+    e.g. [1533,"chat_tokens","2023-03-14",250,null,0.0005] (sequence, kind, day, amount, detail, cost).
+    Every snapshot_interval requests the JSON file above is rewritten as a snapshot in the background
+    and the journal is started over. On load, journal lines newer than the snapshot's journal_seq are replayed.
+
+    Days of past months older than history_days are folded into one usage_history entry per month on load,
+    e.g. "2023-02": 48210, so the usage file does not grow with the age of the account (see compact_history).
+
+    With the "sql" storage, every request is inserted as a usage_event row (see entities.py)
+    and the get_current_* functions are aggregated by the database.
     """
 
-    def __init__(self, user_id, user_name, logs_dir="usage_logs"):
+    def __init__(self, user_id, user_name, logs_dir=USAGE_LOGS_DIR, storage="json", snapshot_interval=500,
+                 write_debounce_ms=1000, history_days=90):
         """
         Initializes UsageTracker for a user with current date.
         Loads usage data from usage log file.
         :param user_id: Telegram ID of the user
         :param user_name: Telegram user name
         :param logs_dir: path to directory of usage logs, defaults to "usage_logs"
+        :param storage: "json" to rewrite the usage file on every request,
+                        "journal" to append to the journal and snapshot periodically,
+                        "sql" to insert into the usage_event table, defaults to "json"
+        :param snapshot_interval: journal records between two snapshots, defaults to 500
+        :param write_debounce_ms: with the "json" storage, milliseconds during which the requests
+                                  of the user are coalesced into one write of the usage file, defaults to 1000
+        :param history_days: days of usage history that are never folded into monthly totals, defaults to 90
         """
         self.user_id = user_id
         self.logs_dir = logs_dir
+        self.storage = storage
+        self.snapshot_interval = snapshot_interval
+        self.write_debounce_ms = write_debounce_ms
+        self.history_days = history_days
         # path to usage file of given user
         self.user_file = f"{logs_dir}/{user_id}.json"
+        self.journal_file = f"{logs_dir}/{user_id}.journal"
+        # usage not written to the usage file yet, the timer of its write and the write in progress
+        self.dirty = False
+        self.scheduled_write = None
+        self.pending_write = None
+        # journals of an interrupted compaction, removed with the next snapshot
+        self.compacted_journals = []
+        if storage == "sql":
+            self.usage = None
+            return
 
         if os.path.isfile(self.user_file):
             with open(self.user_file, "r") as file:
@@ -71,50 +132,37 @@ class UsageTracker:
                 "current_cost": {"day": 0.0, "month": 0.0, "all_time": 0.0, "last_update": str(date.today()), "created": str(date.today())},
                 "usage_history": {"chat_tokens": {}, "transcription_seconds": {}, "number_images": {}, "tts_characters": {}, "vision_tokens":{}}
             }
+        self.journal_seq = self.usage.get('journal_seq', 0)
+        self.records_since_snapshot = 0
+        # a journal is replayed whatever the storage, so switching back to "json" loses nothing
+        self.replay_journal()
+        # the compacted history is written with the next write of the usage file
+        self.dirty = self.compact_history() > 0
 
     # token usage functions:
 
-    def add_chat_tokens(self, tokens, tokens_price=0.002):
+    async def add_chat_tokens(self, tokens, tokens_price=0.002):
         """Adds used tokens from a request to a users usage history and updates current cost
         :param tokens: total tokens used in last request
         :param tokens_price: price per 1000 tokens, defaults to 0.002
         """
-        today = date.today()
         token_cost = round(float(tokens) * tokens_price / 1000, 6)
-        self.add_current_costs(token_cost)
+        await self.record("chat_tokens", tokens, token_cost)
 
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["chat_tokens"]:
-            # add token usage to existing date
-            self.usage["usage_history"]["chat_tokens"][str(today)] += tokens
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["chat_tokens"][str(today)] = tokens
-
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
-
-    def get_current_token_usage(self):
+    async def get_current_token_usage(self):
         """Get token amounts used for today and this month
 
         :return: total number of tokens used per day and per month
         """
         today = date.today()
-        if str(today) in self.usage["usage_history"]["chat_tokens"]:
-            usage_day = self.usage["usage_history"]["chat_tokens"][str(today)]
-        else:
-            usage_day = 0
-        month = str(today)[:7]  # year-month as string
-        usage_month = 0
-        for today, tokens in self.usage["usage_history"]["chat_tokens"].items():
-            if today.startswith(month):
-                usage_month += tokens
-        return usage_day, usage_month
+        if self.storage == "sql":
+            usage_day, usage_month = await entities.get_usage_amounts(self.user_id, "chat_tokens", today)
+            return int(usage_day), int(usage_month)
+        return self.get_current_usage("chat_tokens", today)
 
     # image usage functions:
 
-    def add_image_request(self, image_size, image_prices="0.016,0.018,0.02"):
+    async def add_image_request(self, image_size, image_prices="0.016,0.018,0.02"):
         """Add image request to users usage history and update current costs.
 
         :param image_size: requested image size
@@ -124,216 +172,396 @@ class UsageTracker:
         sizes = ["256x256", "512x512", "1024x1024"]
         requested_size = sizes.index(image_size)
         image_cost = image_prices[requested_size]
-        today = date.today()
-        self.add_current_costs(image_cost)
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["number_images"]:
-            # add token usage to existing date
-            self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["number_images"][str(today)] = [0, 0, 0]
-            self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
+        await self.record("number_images", 1, image_cost, requested_size)
 
-        # write updated image number to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
-
-    def get_current_image_count(self):
+    async def get_current_image_count(self):
         """Get number of images requested for today and this month.
 
         :return: total number of images requested per day and per month
         """
         today = date.today()
-        if str(today) in self.usage["usage_history"]["number_images"]:
-            usage_day = sum(self.usage["usage_history"]["number_images"][str(today)])
-        else:
-            usage_day = 0
-        month = str(today)[:7]  # year-month as string
-        usage_month = 0
-        for today, images in self.usage["usage_history"]["number_images"].items():
-            if today.startswith(month):
-                usage_month += sum(images)
-        return usage_day, usage_month
+        if self.storage == "sql":
+            usage_day, usage_month = await entities.get_usage_amounts(self.user_id, "number_images", today)
+            return int(usage_day), int(usage_month)
+        return self.get_current_usage("number_images", today)
 
 
     # vision usage functions
-    def add_vision_tokens(self, tokens, vision_token_price=0.01):
+    async def add_vision_tokens(self, tokens, vision_token_price=0.01):
         """
          Adds requested vision tokens to a users usage history and updates current cost.
         :param tokens: total tokens used in last request
         :param vision_token_price: price per 1K tokens transcription, defaults to 0.01
         """
-        today = date.today()
         token_price = round(tokens * vision_token_price / 1000, 2)
-        self.add_current_costs(token_price)
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["vision_tokens"]:
-            # add requested seconds to existing date
-            self.usage["usage_history"]["vision_tokens"][str(today)] += tokens
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["vision_tokens"][str(today)] = tokens
+        await self.record("vision_tokens", tokens, token_price)
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
-
-    def get_current_vision_tokens(self):
+    async def get_current_vision_tokens(self):
         """Get vision tokens for today and this month.
 
         :return: total amount of vision tokens per day and per month
         """
         today = date.today()
-        if str(today) in self.usage["usage_history"]["vision_tokens"]:
-            tokens_day = self.usage["usage_history"]["vision_tokens"][str(today)]
-        else:
-            tokens_day = 0
-        month = str(today)[:7]  # year-month as string
-        tokens_month = 0
-        for today, tokens in self.usage["usage_history"]["vision_tokens"].items():
-            if today.startswith(month):
-                tokens_month += tokens
-        return tokens_day, tokens_month
+        if self.storage == "sql":
+            tokens_day, tokens_month = await entities.get_usage_amounts(self.user_id, "vision_tokens", today)
+            return int(tokens_day), int(tokens_month)
+        return self.get_current_usage("vision_tokens", today)
 
     # tts usage functions:
 
-    def add_tts_request(self, text_length, tts_model, tts_prices):
+    async def add_tts_request(self, text_length, tts_model, tts_prices):
         tts_models = ['tts-1', 'tts-1-hd']
         price = tts_prices[tts_models.index(tts_model)]
-        today = date.today()
         tts_price = round(text_length * price / 1000, 2)
-        self.add_current_costs(tts_price)
+        await self.record("tts_characters", text_length, tts_price, tts_model)
 
-        if 'tts_characters' not in self.usage['usage_history']:
-            self.usage['usage_history']['tts_characters'] = {}
-        
-        if tts_model not in self.usage['usage_history']['tts_characters']:
-            self.usage['usage_history']['tts_characters'][tts_model] = {}
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["tts_characters"][tts_model]:
-            # add requested text length to existing date
-            self.usage["usage_history"]["tts_characters"][tts_model][str(today)] += text_length
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["tts_characters"][tts_model][str(today)] = text_length
-
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
-
-    def get_current_tts_usage(self):
+    async def get_current_tts_usage(self):
         """Get length of speech generated for today and this month.
 
         :return: total amount of characters converted to speech per day and per month
         """
 
-        tts_models = ['tts-1', 'tts-1-hd']
         today = date.today()
-        characters_day = 0
-        for tts_model in tts_models:
-            if tts_model in self.usage["usage_history"]["tts_characters"] and \
-                str(today) in self.usage["usage_history"]["tts_characters"][tts_model]:
-                characters_day += self.usage["usage_history"]["tts_characters"][tts_model][str(today)]
-
-        month = str(today)[:7]  # year-month as string
-        characters_month = 0
-        for tts_model in tts_models:
-            if tts_model in self.usage["usage_history"]["tts_characters"]: 
-                for today, characters in self.usage["usage_history"]["tts_characters"][tts_model].items():
-                    if today.startswith(month):
-                        characters_month += characters
+        if self.storage == "sql":
+            characters_day, characters_month = await entities.get_usage_amounts(self.user_id, "tts_characters", today)
+        else:
+            characters_day, characters_month = self.get_current_usage("tts_characters", today)
         return int(characters_day), int(characters_month)
 
 
     # transcription usage functions:
 
-    def add_transcription_seconds(self, seconds, minute_price=0.006):
+    async def add_transcription_seconds(self, seconds, minute_price=0.006):
         """Adds requested transcription seconds to a users usage history and updates current cost.
         :param seconds: total seconds used in last request
         :param minute_price: price per minute transcription, defaults to 0.006
         """
-        today = date.today()
         transcription_price = round(seconds * minute_price / 60, 2)
-        self.add_current_costs(transcription_price)
+        await self.record("transcription_seconds", seconds, transcription_price)
+
+    # persistence functions:
+
+    async def record(self, kind, amount, cost, detail=None):
+        """
+        Applies a request to the usage of today and persists it with the configured storage.
+        :param kind: usage_history key, e.g. "chat_tokens"
+        :param amount: tokens, images, characters or seconds used by the request
+        :param cost: cost of the request
+        :param detail: image size index for "number_images", model for "tts_characters"
+        """
+        if self.storage == "sql":
+            await entities.add_usage_event(self.user_id, kind, date.today(), amount, cost, detail)
+            return
+        today = str(date.today())
+        self.apply(kind, today, amount, cost, detail)
+        self.journal_seq += 1
+        if self.storage == "journal":
+            self.append_to_journal([self.journal_seq, kind, today, amount, detail, cost])
+        else:
+            self.usage["journal_seq"] = self.journal_seq
+            self.mark_dirty()
 
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["transcription_seconds"]:
-            # add requested seconds to existing date
-            self.usage["usage_history"]["transcription_seconds"][str(today)] += seconds
+    def apply(self, kind, day, amount, cost, detail=None):
+        """
+        Adds a request of the given day to current costs and usage_history.
+        """
+        self.add_current_costs(cost, date.fromisoformat(day))
+        self.add_current_usage(kind, amount, date.fromisoformat(day))
+        history = self.usage["usage_history"].setdefault(kind, {})
+        if kind == "tts_characters":
+            history = history.setdefault(detail, {})
+        if kind == "number_images":
+            # one counter per image size
+            history.setdefault(day, [0, 0, 0])[detail] += amount
         else:
-            # create new entry for current date
-            self.usage["usage_history"]["transcription_seconds"][str(today)] = seconds
+            history[day] = history.get(day, 0) + amount
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+    def append_to_journal(self, entry):
+        """
+        Appends one compact record to the journal and takes a snapshot every snapshot_interval records.
+        """
+        with open(self.journal_file, "a") as journal:
+            journal.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self.records_since_snapshot += 1
+        if self.records_since_snapshot >= self.snapshot_interval:
+            self.snapshot()
 
-    def add_current_costs(self, request_cost):
+    def snapshot(self):
+        """
+        Serializes the usage and starts over with an empty journal. Writing the snapshot file
+        and removing the previous journal are left to the writer threads.
+        """
+        if self.pending_write is not None and not self.pending_write.done():
+            # the previous snapshot is still being written, the journal keeps growing until then
+            return
+        if os.path.isfile(self.journal_file):
+            self.compacted_journals.append(f"{self.journal_file}.{self.journal_seq}")
+            os.replace(self.journal_file, self.compacted_journals[-1])
+        self.usage["journal_seq"] = self.journal_seq
+        self.records_since_snapshot = 0
+        compacted_journals, self.compacted_journals = self.compacted_journals, []
+        self.pending_write = write_executor.submit(self.write_snapshot, json.dumps(self.usage), compacted_journals)
+
+    def mark_dirty(self):
+        """
+        Schedules a write of the usage file, coalescing the requests of the next write_debounce_ms.
+        """
+        self.dirty = True
+        if self.scheduled_write is None:
+            self.scheduled_write = asyncio.get_running_loop().call_later(self.write_debounce_ms / 1000,
+                                                                         self.write_dirty)
+
+    def write_dirty(self):
+        """
+        Serializes the usage and hands the write of the usage file over to the writer threads.
+        """
+        self.scheduled_write = None
+        if not self.dirty:
+            return
+        if self.pending_write is not None and not self.pending_write.done():
+            # a user's writes must not overtake each other, try again once the previous one is done
+            self.mark_dirty()
+            return
+        self.dirty = False
+        self.pending_write = write_executor.submit(self.write_snapshot, json.dumps(self.usage), [])
+
+    def write_snapshot(self, data, compacted_journals):
+        """
+        Atomically replaces the usage file with data, so a crash never leaves a half written file.
+        """
+        try:
+            snapshot_file = f"{self.user_file}.tmp"
+            with open(snapshot_file, "w") as outfile:
+                outfile.write(data)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(snapshot_file, self.user_file)
+            for compacted_journal in compacted_journals:
+                if os.path.isfile(compacted_journal):
+                    os.remove(compacted_journal)
+        except Exception as e:
+            # compacted journals are kept and replayed on the next load,
+            # the "json" storage writes the usage again with the next request or flush
+            self.dirty = self.storage == "json"
+            logging.warning(f'Failed to write usage snapshot of {self.user_id}: {str(e)}')
+
+    def flush(self, wait_for_write=True):
+        """
+        Makes sure everything recorded so far is written, e.g. before the tracker is dropped from memory.
+        :param wait_for_write: whether to wait until the usage is on disk, otherwise the write is left
+            to the writer threads, defaults to True
+        :return: the write in progress, if any
+        """
+        if self.scheduled_write is not None:
+            self.scheduled_write.cancel()
+            self.scheduled_write = None
+        if self.dirty:
+            self.dirty = False
+            # journal records applied so far are part of the written usage and must not be replayed again
+            self.usage["journal_seq"] = self.journal_seq
+            self.pending_write = write_executor.submit(self.write_after, self.pending_write, json.dumps(self.usage))
+        if wait_for_write and self.pending_write is not None:
+            # a reload must not read the old snapshot while the journal it replaces is being removed
+            self.pending_write.result()
+        return self.pending_write
+
+    def write_after(self, previous_write, data):
+        """
+        Writes the usage file once the previous write is done, so a user's writes never overtake each other.
+        """
+        if previous_write is not None:
+            wait([previous_write])
+        self.write_snapshot(data, [])
+
+    def replay_journal(self):
+        """
+        Applies the journal records that are newer than the snapshot, including journals
+        left behind by an interrupted compaction.
+        """
+        prefix = f"{self.user_id}.journal"
+        if not os.path.isdir(self.logs_dir):
+            return
+        journals = [name for name in os.listdir(self.logs_dir) if name.startswith(prefix)]
+        # compacted journals are named after the last record they hold, the live journal goes last
+        journals.sort(key=lambda name: int(name[len(prefix) + 1:] or 0) if name != prefix else float("inf"))
+        for name in journals:
+            if name != prefix:
+                self.compacted_journals.append(f"{self.logs_dir}/{name}")
+            with open(f"{self.logs_dir}/{name}", "r") as journal:
+                for line in journal:
+                    try:
+                        seq, kind, day, amount, detail, cost = json.loads(line)
+                    except ValueError:
+                        # torn last line of a crashed write
+                        continue
+                    if seq <= self.journal_seq:
+                        continue
+                    self.apply(kind, day, amount, cost, detail)
+                    self.journal_seq = seq
+                    self.records_since_snapshot += 1
+
+    def compact_history(self, today=None):
+        """
+        Folds the usage_history days of months before the current one into monthly totals.
+        Monthly entries are summed like days by initialize_all_time_cost and get_usage_counters,
+        and the days of the current month are kept, so costs and current usage are unchanged.
+        The last history_days days are kept as well, for the daily cost curve of the usage store.
+        :param today: day of the current month, defaults to today
+        :return: number of days folded
+        """
+        today = today or date.today()
+        current_month = year_month(today)
+        first_kept_day = str(today - timedelta(days=self.history_days - 1))
+        histories = []
+        for kind, history in self.usage["usage_history"].items():
+            # one history per model
+            histories.extend(history.values() if kind == "tts_characters" else [history])
+        folded = 0
+        for history in histories:
+            for day in [day for day in history
+                        if len(day) > 7 and year_month(day) < current_month and day < first_kept_day]:
+                amount = history.pop(day)
+                month = year_month(day)
+                if isinstance(amount, list):
+                    # one counter per image size
+                    month_amount = history.setdefault(month, [0] * len(amount))
+                    for size, count in enumerate(amount):
+                        month_amount[size] += count
+                else:
+                    history[month] = history.get(month, 0) + amount
+                folded += 1
+        return folded
+
+    def add_current_costs(self, request_cost, today=None):
         """
         Add current cost to all_time, day and month cost and update last_update date.
+        :param request_cost: cost of the request
+        :param today: day of the request, defaults to today
         """
-        today = date.today()
+        today = today or date.today()
         last_update = date.fromisoformat(self.usage["current_cost"]["last_update"])
 
-        # add to all_time cost, initialize with calculation of total_cost if key doesn't exist
-        self.usage["current_cost"]["all_time"] = \
-            self.usage["current_cost"].get("all_time", self.initialize_all_time_cost()) + request_cost
+        self.usage["current_cost"]["all_time"] = self.get_all_time_cost() + request_cost
         # add current cost, update new day
         if today == last_update:
             self.usage["current_cost"]["day"] += request_cost
             self.usage["current_cost"]["month"] += request_cost
         else:
-            if today.month == last_update.month:
+            if year_month(today) == year_month(last_update):
                 self.usage["current_cost"]["month"] += request_cost
             else:
                 self.usage["current_cost"]["month"] = request_cost
             self.usage["current_cost"]["day"] = request_cost
             self.usage["current_cost"]["last_update"] = str(today)
 
-    def get_current_transcription_duration(self):
+    def get_all_time_cost(self):
+        """
+        Returns the all_time cost, calculating it from usage_history only once for usage files without it.
+        """
+        if "all_time" not in self.usage["current_cost"]:
+            self.usage["current_cost"]["all_time"] = self.initialize_all_time_cost()
+        return self.usage["current_cost"]["all_time"]
+
+    def add_current_usage(self, kind, amount, today):
+        """
+        Add amount to the running day, month and all_time counters of a usage kind.
+        """
+        counters = self.get_usage_counters(kind, today)
+        last_update = date.fromisoformat(counters["last_update"])
+        counters["all_time"] += amount
+        if today == last_update:
+            counters["day"] += amount
+            counters["month"] += amount
+        else:
+            if year_month(today) == year_month(last_update):
+                counters["month"] += amount
+            else:
+                counters["month"] = amount
+            counters["day"] = amount
+            counters["last_update"] = str(today)
+
+    def get_current_usage(self, kind, today):
+        """Get the amount of a usage kind for today and this month from its running counters.
+
+        :return: usage per day and per month
+        """
+        counters = self.get_usage_counters(kind, today)
+        last_update = date.fromisoformat(counters["last_update"])
+        usage_day = counters["day"] if today == last_update else 0
+        usage_month = counters["month"] if year_month(today) == year_month(last_update) else 0
+        return usage_day, usage_month
+
+    def get_usage_counters(self, kind, today):
+        """
+        Returns the running counters of a usage kind, calculating them from usage_history
+        only once for usage files written before they existed.
+        """
+        current_usage = self.usage.setdefault("current_usage", {})
+        if kind not in current_usage:
+            history = self.usage["usage_history"].get(kind, {})
+            if kind == "tts_characters":
+                # one history per model
+                days = [item for model_history in history.values() for item in model_history.items()]
+            elif kind == "number_images":
+                days = [(day, sum(images)) for day, images in history.items()]
+            else:
+                days = list(history.items())
+            current_usage[kind] = {
+                "day": sum(amount for day, amount in days if day == str(today)),
+                "month": sum(amount for day, amount in days if day.startswith(year_month(today))),
+                "all_time": sum(amount for day, amount in days),
+                "last_update": str(today)
+            }
+        return current_usage[kind]
+
+    async def get_current_transcription_duration(self):
         """Get minutes and seconds of audio transcribed for today and this month.
 
         :return: total amount of time transcribed per day and per month (4 values)
         """
         today = date.today()
-        if str(today) in self.usage["usage_history"]["transcription_seconds"]:
-            seconds_day = self.usage["usage_history"]["transcription_seconds"][str(today)]
+        if self.storage == "sql":
+            seconds_day, seconds_month = await entities.get_usage_amounts(self.user_id, "transcription_seconds", today)
         else:
-            seconds_day = 0
-        month = str(today)[:7]  # year-month as string
-        seconds_month = 0
-        for today, seconds in self.usage["usage_history"]["transcription_seconds"].items():
-            if today.startswith(month):
-                seconds_month += seconds
+            seconds_day, seconds_month = self.get_current_usage("transcription_seconds", today)
         minutes_day, seconds_day = divmod(seconds_day, 60)
         minutes_month, seconds_month = divmod(seconds_month, 60)
         return int(minutes_day), round(seconds_day, 2), int(minutes_month), round(seconds_month, 2)
 
     # general functions
-    def get_current_cost(self):
+    async def get_current_cost(self):
         """Get total USD amount of all requests of the current day and month
 
         :return: cost of current day and month
         """
         today = date.today()
+        if self.storage == "sql":
+            cost_day, cost_month, cost_all_time = await entities.get_usage_costs(self.user_id, today)
+            return {"cost_today": cost_day, "cost_month": cost_month, "cost_all_time": cost_all_time}
         last_update = date.fromisoformat(self.usage["current_cost"]["last_update"])
         if today == last_update:
             cost_day = self.usage["current_cost"]["day"]
             cost_month = self.usage["current_cost"]["month"]
         else:
             cost_day = 0.0
-            if today.month == last_update.month:
+            if year_month(today) == year_month(last_update):
                 cost_month = self.usage["current_cost"]["month"]
             else:
                 cost_month = 0.0
-        # add to all_time cost, initialize with calculation of total_cost if key doesn't exist
-        cost_all_time = self.usage["current_cost"].get("all_time", self.initialize_all_time_cost())
+        cost_all_time = self.get_all_time_cost()
         return {"cost_today": cost_day, "cost_month": cost_month, "cost_all_time": cost_all_time}
 
+    async def get_first_and_last_day(self):
+        """Get the day this user was first tracked and the day of their last request.
+
+        :return: created and last_update dates
+        """
+        if self.storage == "sql":
+            created, last_update = await entities.get_usage_days(self.user_id)
+            return created or date.today(), last_update or date.today()
+        return date.fromisoformat(self.usage["current_cost"]["created"]), \
+            date.fromisoformat(self.usage["current_cost"]["last_update"])
+
     def initialize_all_time_cost(self, tokens_price=0.002, image_prices="0.016,0.018,0.02", minute_price=0.006, vision_token_price=0.01, tts_prices='0.015,0.030'):
         """Get total USD amount of all requests in history
         
@@ -364,3 +592,160 @@ class UsageTracker:
 
         all_time_cost = token_cost + transcription_cost + image_cost + vision_cost + tts_cost
         return all_time_cost
+
+
+class UsageCache:
+    """
+    Bounded LRU cache of the UsageTrackers of active users, used like a dict by ChatGPTTelegramBot.
+    Trackers idle for longer than ttl seconds, or least recently used once max_size is reached,
+    are flushed and dropped from memory. They are loaded again from their usage log when needed.
+    Evicted trackers are written by the writer threads, a tracker used again before its write is
+    done is taken back into the cache instead of being loaded from the outdated usage log.
+    """
+
+    def __init__(self, loader, max_size=10000, ttl=3600):
+        """
+        :param loader: function loading the UsageTracker of a user id that is not cached
+        :param max_size: maximum number of cached trackers, defaults to 10000
+        :param ttl: seconds after which an unused tracker is evicted, defaults to 3600
+        """
+        self.loader = loader
+        self.max_size = max_size
+        self.ttl = ttl
+        # user id -> (tracker, time of last access), least recently used first
+        self.trackers = OrderedDict()
+        # user id -> evicted tracker whose usage is still being written
+        self.flushing = {}
+        # user ids inserted by the caller after a miss and not read yet
+        self.inserted = set()
+        self.next_expiry_check = time.monotonic() + min(ttl, EXPIRY_CHECK_INTERVAL)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, user_id):
+        if time.monotonic() >= self.next_expiry_check:
+            self.evict_expired()
+        if user_id in self.trackers:
+            return True
+        if user_id in self.flushing:
+            self.cache(user_id, self.flushing.pop(user_id))
+            return True
+        return False
+
+    def __getitem__(self, user_id):
+        if user_id in self.inserted:
+            # loaded by the caller, the miss is counted by __setitem__
+            self.inserted.discard(user_id)
+        elif user_id in self.trackers:
+            self.hits += 1
+        elif user_id in self.flushing:
+            # evicted by another handler since the caller checked for it, but not written yet
+            self.hits += 1
+            self.cache(user_id, self.flushing.pop(user_id))
+        else:
+            self.misses += 1
+            self.cache(user_id, self.loader(user_id))
+        tracker, _ = self.trackers[user_id]
+        self.trackers[user_id] = (tracker, time.monotonic())
+        self.trackers.move_to_end(user_id)
+        return tracker
+
+    def __setitem__(self, user_id, tracker):
+        # the caller loaded the tracker of a user that is not cached
+        self.misses += 1
+        self.inserted.add(user_id)
+        self.cache(user_id, tracker)
+
+    def __len__(self):
+        return len(self.trackers)
+
+    def cache(self, user_id, tracker):
+        self.trackers[user_id] = (tracker, time.monotonic())
+        self.trackers.move_to_end(user_id)
+        while len(self.trackers) > self.max_size:
+            self.evict()
+
+    def evict(self):
+        user_id, (tracker, _) = self.trackers.popitem(last=False)
+        self.inserted.discard(user_id)
+        pending_write = tracker.flush(wait_for_write=False)
+        if pending_write is not None and not pending_write.done():
+            self.flushing[user_id] = tracker
+        self.evictions += 1
+
+    def evict_expired(self):
+        """
+        Evicts the trackers idle for longer than ttl seconds and forgets the evicted trackers that are
+        written. Membership tests call it at most every EXPIRY_CHECK_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        self.next_expiry_check = now + min(self.ttl, EXPIRY_CHECK_INTERVAL)
+        expired = now - self.ttl
+        while self.trackers and next(iter(self.trackers.values()))[1] < expired:
+            self.evict()
+        for user_id in [user_id for user_id, tracker in self.flushing.items() if tracker.pending_write.done()]:
+            del self.flushing[user_id]
+
+    def flush_all(self):
+        """
+        Flushes every cached tracker and waits for the writes of the evicted ones, e.g. on shutdown.
+        """
+        for tracker, _ in self.trackers.values():
+            tracker.flush()
+        for tracker in self.flushing.values():
+            tracker.flush()
+        self.flushing.clear()
+
+    async def compact_usage_logs(self, logs_dir=USAGE_LOGS_DIR):
+        """
+        Compacts the usage history of all usage files, see UsageTracker.compact_history.
+        Cached trackers are compacted in memory and written with their next write. The others are
+        loaded in a worker thread and written by the writer threads. Until that write is done they are
+        kept with the evicted trackers, so a request never loads a usage file while it is being rewritten.
+        :param logs_dir: path to directory of usage logs, defaults to "usage_logs"
+        :return: number of usage files compacted
+        """
+        if not os.path.isdir(logs_dir):
+            return 0
+        compacted = 0
+        for name in sorted(os.listdir(logs_dir)):
+            if not name.endswith(".json"):
+                continue
+            user_id = name[:-len(".json")]
+            # telegram user ids are cached as integers, guest usage shards by name
+            user_id = int(user_id) if user_id.isdigit() else user_id
+            if self.cached(user_id) is None:
+                # loading compacts the usage history, see UsageTracker.__init__
+                tracker = await asyncio.to_thread(self.loader, user_id)
+                if self.cached(user_id) is None:
+                    if tracker.dirty:
+                        tracker.flush(wait_for_write=False)
+                        self.flushing[user_id] = tracker
+                        compacted += 1
+                    continue
+                # a request loaded the usage file in the meantime, its tracker may have newer usage
+            tracker = self.cached(user_id)
+            if tracker.compact_history() > 0:
+                compacted += 1
+                if user_id in self.trackers:
+                    tracker.dirty = True
+                else:
+                    tracker.flush(wait_for_write=False)
+            await asyncio.sleep(0)
+        return compacted
+
+    def cached(self, user_id):
+        """
+        :return: the tracker of a user id held in memory, cached or evicted and still being written, if any
+        """
+        if user_id in self.trackers:
+            return self.trackers[user_id][0]
+        return self.flushing.get(user_id)
+
+    def stats(self):
+        """
+        :return: size, hit, miss and eviction counters of the cache
+        """
+        return {"size": len(self.trackers), "max_size": self.max_size, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
@@ -1,7 +1,6 @@
 from __future__ import annotations
 
 import asyncio
-import itertools
 import json
 import logging
 import os
@@ -12,7 +11,8 @@ import telegram
 from telegram import Message, MessageEntity, Update, ChatMember, constants
 from telegram.ext import CallbackContext, ContextTypes
 
-from usage_tracker import UsageTracker
+import usage_tracker
+from access_policy import AccessPolicy
 
 
 def message_text(message: Message) -> str:
@@ -55,16 +55,16 @@ def get_thread_id(update: Update) -> int | None:
     return None
 
 
-def get_stream_cutoff_values(update: Update, content: str) -> int:
+def get_stream_cutoff_values(update: Update, length: int) -> int:
     """
     Gets the stream cutoff values for the message length
     """
     if is_group_chat(update):
         # group chats have stricter flood limits
-        return 180 if len(content) > 1000 else 120 if len(content) > 200 \
-            else 90 if len(content) > 50 else 50
-    return 90 if len(content) > 1000 else 45 if len(content) > 200 \
-        else 25 if len(content) > 50 else 15
+        return 180 if length > 1000 else 120 if length > 200 \
+            else 90 if length > 50 else 50
+    return 90 if length > 1000 else 45 if length > 200 \
+        else 25 if length > 50 else 15
 
 
 def is_group_chat(update: Update) -> bool:
@@ -153,27 +153,28 @@ async def error_handler(_: object, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 
+def get_access_policy(config) -> AccessPolicy:
+    """
+    Returns the access policy of the bot configuration, built from its user id
+    and budget settings on first use if main.py did not build it.
+    """
+    if 'access_policy' not in config:
+        config['access_policy'] = AccessPolicy.from_config(config)
+    return config['access_policy']
+
+
 async def is_allowed(config, update: Update, context: CallbackContext, is_inline=False) -> bool:
     """
     Checks if the user is allowed to use the bot.
     """
-    if config['allowed_user_ids'] == '*':
-        return True
-
+    policy = get_access_policy(config)
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
-    if is_admin(config, user_id):
+    if policy.is_allowed(user_id):
         return True
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    allowed_user_ids = config['allowed_user_ids'].split(',')
-    # Check if user is allowed
-    if str(user_id) in allowed_user_ids:
-        return True
     # Check if it's a group a chat with at least one authorized member
     if not is_inline and is_group_chat(update):
-        admin_user_ids = config['admin_user_ids'].split(',')
-        for user in itertools.chain(allowed_user_ids, admin_user_ids):
-            if not user.strip():
-                continue
+        for user in policy.allowed_user_ids | policy.admin_user_ids:
             if await is_user_in_group(update, context, user):
                 logging.info(f'{user} is a member. Allowing group chat message...')
                 return True
@@ -187,25 +188,17 @@ def is_admin(config, user_id: int, log_no_admin=False) -> bool:
     Checks if the user is the admin of the bot.
     The first user in the user list is the admin.
     """
-    if config['admin_user_ids'] == '-':
+    policy = get_access_policy(config)
+    if not policy.admin_user_ids:
         if log_no_admin:
             logging.info('No admin user defined.')
         return False
-
-    admin_user_ids = config['admin_user_ids'].split(',')
-
-    # Check if user is in the admin user list
-    if str(user_id) in admin_user_ids:
-        return True
-
-    return False
+    return policy.is_admin(user_id)
 
 
 def get_admins(config):
-    if config['admin_user_ids'] == '-':
-        return []
-    admin_user_ids = config['admin_user_ids'].split(',')
-    return admin_user_ids
+    return list(get_access_policy(config).admin_user_ids)
+
 
 def get_user_budget(config, user_id) -> float | None:
     """
@@ -214,30 +207,79 @@ def get_user_budget(config, user_id) -> float | None:
     :param user_id: User id
     :return: The user's budget as a float, or None if the user is not found in the allowed user list
     """
+    return get_access_policy(config).get_user_budget(user_id)
+
+
+def create_usage_tracker(config, user_id, user_name) -> usage_tracker.UsageTracker:
+    """
+    Creates the usage tracker of a user with the usage storage settings of the bot configuration.
+    :param config: The bot configuration object
+    :param user_id: The user id, or the id of a guest usage shard
+    :param user_name: The user name
+    :return: The usage tracker, loaded from its usage log if there is one
+    """
+    return usage_tracker.UsageTracker(user_id, user_name, storage=config['usage_storage'],
+                                      snapshot_interval=config['usage_snapshot_interval'],
+                                      write_debounce_ms=config['usage_write_debounce_ms'],
+                                      history_days=config['usage_store_days'])
+
+
+def is_guest(config, user_id) -> bool:
+    """
+    Checks if the requests of a user count against the shared guest budget.
+    """
+    return get_user_budget(config, user_id) is None
+
+
+def guest_usage_shards(config) -> list[str]:
+    """
+    Returns the ids of the usage trackers guest usage is spread over. The first one is
+    'guests', the tracker used before guest usage was sharded, so its history still counts.
+    """
+    return ['guests'] + [f'guests-{shard}' for shard in range(1, config['guest_usage_shards'])]
 
-    # no budget restrictions for admins and '*'-budget lists
-    if is_admin(config, user_id) or config['user_budgets'] == '*':
-        return float('inf')
-
-    user_budgets = config['user_budgets'].split(',')
-    if config['allowed_user_ids'] == '*':
-        # same budget for all users, use value in first position of budget list
-        if len(user_budgets) > 1:
-            logging.warning('multiple values for budgets set with unrestricted user list '
-                            'only the first value is used as budget for everyone.')
-        return float(user_budgets[0])
-
-    allowed_user_ids = config['allowed_user_ids'].split(',')
-    if str(user_id) in allowed_user_ids:
-        user_index = allowed_user_ids.index(str(user_id))
-        if len(user_budgets) <= user_index:
-            logging.warning(f'No budget set for user id: {user_id}. Budget list shorter than user list.')
-            return 0.0
-        return float(user_budgets[user_index])
-    return None
+
+def is_guest_usage_shard(user_id) -> bool:
+    """
+    Checks if a usage tracker id is a guest usage shard rather than a user,
+    including the shards of a larger GUEST_USAGE_SHARDS configured before.
+    """
+    user_id = str(user_id)
+    return user_id == 'guests' or (user_id.startswith('guests-') and user_id[len('guests-'):].isdigit())
+
+
+def get_guest_usage_tracker(config, usage, user_id) -> usage_tracker.UsageTracker:
+    """
+    Returns the guest usage shard that records the requests of a guest user.
+    Each guest always writes to the same shard, so concurrent guests mostly update different trackers.
+    :param config: The bot configuration object
+    :param usage: The usage tracker object
+    :param user_id: The guest user id
+    :return: The usage tracker of the shard
+    """
+    shard = guest_usage_shards(config)[int(user_id) % config['guest_usage_shards']]
+    if shard not in usage:
+        usage[shard] = create_usage_tracker(config, shard, 'guest users in group chats')
+    return usage[shard]
 
 
-def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
+async def get_guests_cost(config, usage) -> dict:
+    """
+    Merges the current costs of all guest usage shards.
+    :param config: The bot configuration object
+    :param usage: The usage tracker object
+    :return: cost of all guests for the current day, month and all time
+    """
+    guests_cost = {"cost_today": 0.0, "cost_month": 0.0, "cost_all_time": 0.0}
+    for shard in guest_usage_shards(config):
+        if shard not in usage:
+            usage[shard] = create_usage_tracker(config, shard, 'guest users in group chats')
+        for period, cost in (await usage[shard].get_current_cost()).items():
+            guests_cost[period] += cost
+    return guests_cost
+
+
+async def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
     """
     Calculate the remaining budget for a user based on their current usage.
     :param config: The bot configuration object
@@ -246,6 +288,20 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
     :param is_inline: Boolean flag for inline queries
     :return: The remaining budget for the user as a float
     """
+    user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
+    name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
+    return await get_user_remaining_budget(config, usage, user_id, name)
+
+
+async def get_user_remaining_budget(config, usage, user_id, name=None) -> float:
+    """
+    Calculate the remaining budget for a user id based on their current usage.
+    :param config: The bot configuration object
+    :param usage: The usage tracker object
+    :param user_id: The user id
+    :param name: The user name, stored with a new usage tracker
+    :return: The remaining budget for the user as a float
+    """
     # Mapping of budget period to cost period
     budget_cost_map = {
         "monthly": "cost_month",
@@ -253,26 +309,24 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
         "all-time": "cost_all_time"
     }
 
-    user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
-    name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
     if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
+        usage[user_id] = create_usage_tracker(config, user_id, name)
 
     # Get budget for users
     user_budget = get_user_budget(config, user_id)
     budget_period = config['budget_period']
+    if user_budget == float('inf'):
+        return user_budget
     if user_budget is not None:
-        cost = usage[user_id].get_current_cost()[budget_cost_map[budget_period]]
+        cost = (await usage[user_id].get_current_cost())[budget_cost_map[budget_period]]
         return user_budget - cost
 
     # Get budget for guests
-    if 'guests' not in usage:
-        usage['guests'] = UsageTracker('guests', 'all guest users in group chats')
-    cost = usage['guests'].get_current_cost()[budget_cost_map[budget_period]]
-    return config['guest_budget'] - cost
+    cost = (await get_guests_cost(config, usage))[budget_cost_map[budget_period]]
+    return get_access_policy(config).guest_budget - cost
 
 
-def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
+async def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
     """
     Checks if the user reached their usage limit.
     Initializes UsageTracker for user and guest when needed.
@@ -285,12 +339,12 @@ def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
     if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
-    remaining_budget = get_remaining_budget(config, usage, update, is_inline=is_inline)
+        usage[user_id] = create_usage_tracker(config, user_id, name)
+    remaining_budget = await get_remaining_budget(config, usage, update, is_inline=is_inline)
     return remaining_budget > 0
 
 
-def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
+async def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
     """
     Add chat request to usage tracker
     :param usage: The usage tracker object
@@ -302,11 +356,10 @@ def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
         if int(used_tokens) == 0:
             return
         # add chat request to users usage tracker
-        usage[user_id].add_chat_tokens(used_tokens, config['token_price'])
+        await usage[user_id].add_chat_tokens(used_tokens, config['token_price'])
         # add guest chat request to guest usage tracker
-        allowed_user_ids = config['allowed_user_ids'].split(',')
-        if str(user_id) not in allowed_user_ids and 'guests' in usage:
-            usage["guests"].add_chat_tokens(used_tokens, config['token_price'])
+        if is_guest(config, user_id):
+            await get_guest_usage_tracker(config, usage, user_id).add_chat_tokens(used_tokens, config['token_price'])
     except Exception as e:
         logging.warning(f'Failed to add tokens to usage_logs: {str(e)}')
         pass
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the bot modules import each other by their flat names, as when running bot/main.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'bot'))
@@ -0,0 +1,164 @@
+import asyncio
+import datetime
+
+import pytest
+
+from conversation_store import Conversation, MemoryConversationStore, RedisConversationStore, dumps
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def conversation(content='hello', minutes_ago=0):
+    return Conversation([{'role': 'system', 'content': 'sys'}, {'role': 'user', 'content': content}],
+                        last_updated=datetime.datetime.now() - datetime.timedelta(minutes=minutes_ago))
+
+
+def test_memory_store_evicts_least_recently_used_chats():
+    async def scenario():
+        store = MemoryConversationStore(max_chats=2)
+        for chat_id in (1, 2):
+            await store.save(chat_id, conversation())
+        await store.get(1)
+        await store.save(3, conversation())
+        return [await store.get(chat_id) is not None for chat_id in (1, 2, 3)]
+
+    assert run(scenario()) == [True, False, True]
+
+
+def test_memory_store_bounds_serialized_size():
+    async def scenario():
+        store = MemoryConversationStore(max_bytes=200)
+        await store.save(1, conversation('a' * 50))
+        await store.save(2, conversation('b' * 50))
+        await store.append(2, await store.get(2), {'role': 'assistant', 'content': 'c' * 50})
+        return store, [await store.get(chat_id) is not None for chat_id in (1, 2)]
+
+    store, present = run(scenario())
+    assert present == [False, True]
+    assert store.size == len(dumps(store.conversations[2][0].history)) <= 200
+
+
+def test_memory_store_spills_evicted_and_idle_chats(tmp_path):
+    async def scenario():
+        store = MemoryConversationStore(max_chats=2, max_age_minutes=180, spill_after_minutes=30,
+                                        spill_path=str(tmp_path / 'spill.db'))
+        await store.save(1, conversation('evicted'))
+        await store.save(2, conversation('idle', minutes_ago=60))
+        await store.save(3, conversation('expired', minutes_ago=200))
+        expired = await store.sweep()
+        stats = await store.stats()
+        evicted, idle = await store.get(1), await store.get(2)
+        reloaded_stats = await store.stats()
+        await store.close()
+        return expired, stats, evicted, idle, reloaded_stats
+
+    expired, stats, evicted, idle, reloaded_stats = run(scenario())
+    assert expired == 1
+    assert (stats['resident'], stats['spilled']) == (0, 2)
+    assert evicted.history[-1]['content'] == 'evicted'
+    assert idle.history[-1]['content'] == 'idle'
+    assert (reloaded_stats['resident'], reloaded_stats['spilled'], reloaded_stats['reloaded_total']) == (2, 0, 2)
+
+
+@pytest.fixture
+def redis_client():
+    """
+    Returns a function creating clients of one fake Redis server, see requirements-dev.txt.
+    """
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+
+    class RoundTripConnection(fakeredis.FakeAsyncRedisConnection):
+        # every reply takes a turn of the event loop like a round trip to a real server,
+        # so the commands of concurrent clients interleave
+        async def read_response(self, **kwargs):
+            await asyncio.sleep(0)
+            return await super().read_response(**kwargs)
+
+    return lambda: fakeredis.FakeAsyncRedis(server=server, connection_class=RoundTripConnection)
+
+
+@pytest.fixture
+def redis_store(redis_client):
+    return RedisConversationStore(client=redis_client(), max_age_minutes=60)
+
+
+def test_redis_store_round_trip(redis_store):
+    async def scenario():
+        saved = conversation('héllo')
+        saved.vision = True
+        await redis_store.save(1, saved)
+        await redis_store.append(1, saved, {'role': 'user', 'content': [{'type': 'text', 'text': 'look'}]})
+        return saved, await redis_store.get(1), await redis_store.get(2)
+
+    saved, loaded, missing = run(scenario())
+    assert loaded.history == saved.history
+    assert loaded.vision is True
+    assert abs((loaded.last_updated - saved.last_updated).total_seconds()) < 0.001
+    assert missing is None
+
+
+def test_redis_store_save_replaces_history(redis_store):
+    async def scenario():
+        saved = conversation()
+        await redis_store.save(1, saved)
+        saved.history = saved.history[:1]
+        await redis_store.save(1, saved)
+        return await redis_store.get(1)
+
+    assert run(scenario()).history == [{'role': 'system', 'content': 'sys'}]
+
+
+def test_redis_store_refreshes_ttl_on_append(redis_store):
+    async def scenario():
+        saved = conversation()
+        await redis_store.save(1, saved)
+        for key in redis_store.keys(1):
+            await redis_store.client.expire(key, 5)
+        await redis_store.append(1, saved, {'role': 'assistant', 'content': 'hi'})
+        return [await redis_store.client.ttl(key) for key in redis_store.keys(1)]
+
+    assert all(55 * 60 < ttl <= 60 * 60 for ttl in run(scenario()))
+
+
+@pytest.mark.parametrize('store', ['memory', 'redis'])
+def test_replace_prefix_keeps_later_messages_unless_history_changed(store, request):
+    conversations = MemoryConversationStore() if store == 'memory' else request.getfixturevalue('redis_store')
+
+    async def scenario():
+        saved = conversation()
+        prefix = list(saved.history)
+        await conversations.save(1, saved)
+        await conversations.append(1, saved, {'role': 'assistant', 'content': 'later'})
+        summary = [{'role': 'system', 'content': 'sys'}, {'role': 'assistant', 'content': 'summary'}]
+        replaced = await conversations.replace_prefix(1, prefix, summary)
+        replaced_again = await conversations.replace_prefix(1, prefix, summary)
+        missing = await conversations.replace_prefix(2, prefix, summary)
+        return replaced, replaced_again, missing, (await conversations.get(1)).history
+
+    replaced, replaced_again, missing, history = run(scenario())
+    assert (replaced, replaced_again, missing) == (True, False, False)
+    assert [message['content'] for message in history] == ['sys', 'summary', 'later']
+
+
+def test_redis_replace_prefix_is_atomic(redis_store, redis_client):
+    other_instance = RedisConversationStore(client=redis_client())
+
+    async def reset_after(turns):
+        for _ in range(turns):
+            await asyncio.sleep(0)
+        await other_instance.save(1, conversation('after reset'))
+
+    async def scenario(turns):
+        saved = conversation()
+        await redis_store.save(1, saved)
+        # another instance resets the conversation at every point of the swap
+        await asyncio.gather(redis_store.replace_prefix(1, saved.history, [{'role': 'system', 'content': 'summary'}]),
+                             reset_after(turns))
+        return (await redis_store.get(1)).history
+
+    for turns in range(10):
+        # the reset comes last, whether the summary was swapped in before it or dropped
+        assert [message['content'] for message in run(scenario(turns))] == ['sys', 'after reset']
@@ -0,0 +1,108 @@
+import asyncio
+import datetime
+import os
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import func, select
+
+import entities
+from entities import Base, ChatUser, DailyStats, init_database, dispose_database
+
+
+@pytest.fixture
+def database(tmp_path):
+    """
+    Runs a coroutine against a fresh SQLite database with all tables created.
+    """
+
+    def run(coroutine_function, **config):
+        async def main():
+            init_database(config={'database_url': f'sqlite:///{os.path.join(tmp_path, "test.db")}', **config})
+            async with entities.engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+            try:
+                return await coroutine_function()
+            finally:
+                await dispose_database()
+
+        return asyncio.run(main())
+
+    return run
+
+
+def message_update(chat_id):
+    return SimpleNamespace(message=SimpleNamespace(
+        chat_id=chat_id, from_user=SimpleNamespace(username=f'user{chat_id}', first_name='', last_name='')))
+
+
+def test_concurrent_first_messages_create_one_user(database):
+    async def scenario():
+        users = await asyncio.gather(*[entities.create_chat_user_or_get(message_update(42)) for _ in range(5)])
+        async with entities.session_scope() as session:
+            user_rows = await session.scalar(select(func.count()).select_from(ChatUser))
+            stats_rows = await session.scalar(select(func.count()).select_from(DailyStats))
+        return users, user_rows, stats_rows
+
+    users, user_rows, stats_rows = database(scenario)
+    assert [user.chat_id for user in users] == [42] * 5
+    assert users[0].username == '@user42'
+    assert (user_rows, stats_rows) == (1, 1)
+
+
+async def daily_stats_totals(chat_ids):
+    async with entities.session_scope() as session:
+        rows = await session.execute(select(DailyStats.user_id, DailyStats.messages, DailyStats.images)
+                                     .where(DailyStats.user_id.in_(chat_ids), DailyStats.for_day == entities.utc_today()))
+        return {user_id: (messages, images) for user_id, messages, images in rows}
+
+
+@pytest.mark.parametrize('write_behind', [False, True])
+def test_concurrent_update_stats_add_up(database, write_behind):
+    chat_ids = [1, 2, 3]
+    calls = 200
+
+    async def scenario():
+        async with entities.session_scope() as session:
+            session.add_all([ChatUser(chat_id=chat_id) for chat_id in chat_ids])
+        if write_behind:
+            await entities.start_write_behind()
+        await asyncio.gather(*[entities.update_stats(chat_id=chat_ids[call % len(chat_ids)], messages=1,
+                                                     images=call % 2)
+                               for call in range(calls)])
+        if write_behind:
+            # stopping the buffer writes what it still holds
+            await entities.stats_buffer.stop()
+        return await daily_stats_totals(chat_ids)
+
+    # pooled like the bot, so that hundreds of sessions do not contend for the SQLite write lock at once
+    totals = database(scenario, pool_size=5)
+    expected = {chat_id: [0, 0] for chat_id in chat_ids}
+    for call in range(calls):
+        expected[chat_ids[call % len(chat_ids)]][0] += 1
+        expected[chat_ids[call % len(chat_ids)]][1] += call % 2
+    assert totals == {chat_id: tuple(counts) for chat_id, counts in expected.items()}
+    assert sum(messages for messages, _ in totals.values()) == calls
+
+
+def test_buffered_stats_keep_their_day_across_midnight(database, monkeypatch):
+    yesterday, today = datetime.date(2024, 3, 31), datetime.date(2024, 4, 1)
+
+    async def scenario():
+        async with entities.session_scope() as session:
+            session.add(ChatUser(chat_id=1))
+        await entities.start_write_behind()
+        monkeypatch.setattr(entities, 'utc_today', lambda: yesterday)
+        await entities.update_stats(chat_id=1, messages=2)
+        # the flush runs after midnight
+        monkeypatch.setattr(entities, 'utc_today', lambda: today)
+        await entities.update_stats(chat_id=1, messages=1)
+        pending = entities.stats_buffer.get_pending(1)
+        await entities.stats_buffer.stop()
+        async with entities.session_scope() as session:
+            rows = await session.execute(select(DailyStats.for_day, DailyStats.messages).where(DailyStats.user_id == 1))
+            return pending, dict(rows.all())
+
+    pending, messages_per_day = database(scenario)
+    assert pending == (1, 0)
+    assert messages_per_day == {yesterday: 2, today: 1}
@@ -0,0 +1,61 @@
+import datetime
+import json
+
+import pytest
+
+from usage_store import UsageStore, build_usage_store
+from usage_tracker import UsageTracker
+
+PRICES = {'token_price': 1.0, 'image_prices': [0.016, 0.018, 0.02], 'vision_token_price': 0.01,
+          'transcription_price': 0.006, 'tts_prices': [0.015, 0.030]}
+TODAY = datetime.date(2024, 3, 20)
+
+
+def write_usage_log(logs_dir, user_id, chat_tokens: dict):
+    tracker = UsageTracker(user_id, f'user {user_id}', str(logs_dir))
+    tracker.usage['usage_history']['chat_tokens'] = chat_tokens
+    tracker.write_snapshot(json.dumps(tracker.usage), [])
+
+
+@pytest.fixture
+def store(tmp_path):
+    logs_dir, store_dir = tmp_path / 'logs', tmp_path / 'store'
+    logs_dir.mkdir()
+    write_usage_log(logs_dir, 1, {'2024-03-19': 1000})
+    write_usage_log(logs_dir, 2, {'2024-03-20': 3000})
+    write_usage_log(logs_dir, 'guests', {'2024-03-20': 5000})
+    write_usage_log(logs_dir, 'guests-3', {'2024-03-20': 7000})
+    users = build_usage_store(str(logs_dir), str(store_dir), PRICES, {2}, days=7, today=TODAY)
+    usage_store = UsageStore(str(store_dir))
+    assert usage_store.load()
+    return users, usage_store
+
+
+def test_guest_shards_count_in_totals_but_not_as_users(store):
+    users, usage_store = store
+    assert users == 2
+    assert usage_store.totals()['cost'] == pytest.approx(16.0)
+    assert [user_id for user_id, _, _ in usage_store.top_spenders(10)] == ['2', '1']
+    assert usage_store.premium_split() == pytest.approx({'free_users': 1, 'free_cost': 1.0, 'premium_users': 1,
+                                                         'premium_cost': 3.0, 'guest_cost': 12.0})
+
+
+def test_compacted_history_keeps_the_days_of_the_store(tmp_path):
+    logs_dir, store_dir = tmp_path / 'logs', tmp_path / 'store'
+    logs_dir.mkdir()
+    today = datetime.date.today()
+    recent, old = today - datetime.timedelta(days=40), today - datetime.timedelta(days=400)
+    write_usage_log(logs_dir, 1, {str(recent): 1000, str(old): 2000})
+    # the nightly compaction of the bot, with the days of the store
+    tracker = UsageTracker(1, None, str(logs_dir), history_days=60)
+    tracker.flush()
+    with open(logs_dir / '1.json') as file:
+        assert json.load(file)['usage_history']['chat_tokens'] == {str(recent): 1000, str(old)[:7]: 2000}
+
+    build_usage_store(str(logs_dir), str(store_dir), PRICES, set(), days=60, today=today)
+    usage_store = UsageStore(str(store_dir))
+    assert usage_store.load()
+    assert usage_store.totals()['cost'] == pytest.approx(3.0)
+    daily_costs = dict(usage_store.daily_costs(60))
+    assert daily_costs[recent] == pytest.approx(1.0)
+    assert sum(daily_costs.values()) == pytest.approx(1.0)
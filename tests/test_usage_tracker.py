@@ -0,0 +1,95 @@
+import asyncio
+import json
+import threading
+
+import usage_tracker
+from usage_tracker import UsageCache, UsageTracker
+
+
+def test_evicted_tracker_is_written_off_the_loop_and_taken_back(tmp_path, monkeypatch):
+    logs_dir = str(tmp_path)
+    write_started, release_write = threading.Event(), threading.Event()
+    write_snapshot = UsageTracker.write_snapshot
+
+    def slow_write_snapshot(self, data, compacted_journals):
+        write_started.set()
+        release_write.wait(5)
+        write_snapshot(self, data, compacted_journals)
+
+    monkeypatch.setattr(UsageTracker, 'write_snapshot', slow_write_snapshot)
+
+    async def scenario():
+        cache = UsageCache(lambda user_id: UsageTracker(user_id, 'user', logs_dir), max_size=1)
+        tracker = cache[1] = UsageTracker(1, 'user', logs_dir)
+        await tracker.add_chat_tokens(10, 0.002)
+        cache[2] = UsageTracker(2, 'user', logs_dir)
+        assert write_started.wait(5)
+        # the usage file of user 1 is still being written, the cache hands out the evicted tracker
+        taken_back = 1 in cache and cache[1] is tracker
+        release_write.set()
+        cache.flush_all()
+        return taken_back
+
+    assert asyncio.run(scenario())
+    with open(f'{logs_dir}/1.json') as file:
+        assert sum(json.load(file)['usage_history']['chat_tokens'].values()) == 10
+    assert not usage_tracker.write_executor._shutdown
+
+
+def test_compact_usage_logs_folds_cached_and_stored_trackers(tmp_path):
+    logs_dir = str(tmp_path)
+    for user_id in (1, 2):
+        tracker = UsageTracker(user_id, 'user', logs_dir)
+        tracker.usage['usage_history']['chat_tokens'] = {'2020-01-01': 10, '2020-01-02': 20}
+        tracker.write_snapshot(json.dumps(tracker.usage), [])
+
+    async def scenario():
+        cache = UsageCache(lambda user_id: UsageTracker(user_id, 'user', logs_dir))
+        cache[1] = UsageTracker(1, 'user', logs_dir)
+        # the usage file of user 1 is loaded and compacted in the cache, user 2 only on disk
+        cache[1].usage['usage_history']['chat_tokens']['2020-01-03'] = 30
+        compacted = await cache.compact_usage_logs(logs_dir)
+        cache.flush_all()
+        return compacted, cache
+
+    compacted, cache = asyncio.run(scenario())
+    assert compacted == 2
+    assert cache[1].usage['usage_history']['chat_tokens'] == {'2020-01': 60}
+    # compacting does not fill the cache with the trackers of inactive users
+    assert len(cache) == 1
+    with open(f'{logs_dir}/2.json') as file:
+        assert json.load(file)['usage_history']['chat_tokens'] == {'2020-01': 30}
+
+
+def test_cache_counts_one_hit_or_miss_per_access(tmp_path):
+    logs_dir = str(tmp_path)
+    cache = UsageCache(lambda user_id: UsageTracker(user_id, 'user', logs_dir))
+
+    def access(user_id):
+        # the access pattern of the handlers
+        if user_id not in cache:
+            cache[user_id] = UsageTracker(user_id, 'user', logs_dir)
+        return cache[user_id]
+
+    for user_id in (1, 1, 2, 1):
+        access(user_id)
+    # a read without a membership test loads the tracker itself
+    cache[3]
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 3
+
+
+def test_cache_scans_for_expired_trackers_periodically(tmp_path, monkeypatch):
+    logs_dir = str(tmp_path)
+    now = [1000.0]
+    monkeypatch.setattr(usage_tracker.time, 'monotonic', lambda: now[0])
+    cache = UsageCache(lambda user_id: UsageTracker(user_id, 'user', logs_dir), ttl=3600)
+    cache[1] = UsageTracker(1, 'user', logs_dir)
+    now[0] += 3601
+    # idle trackers are only evicted by the next scan, not on every membership test
+    cache.next_expiry_check = now[0] + 1
+    assert 1 in cache
+    now[0] += 3601
+    assert 2 not in cache
+    assert len(cache) == 0
+    assert cache.stats()['evictions'] == 1